@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+集計・推奨のローカルHTTP/JSON API。
+
+画面（Streamlit）を開かずに、累積表・個別2車複の回収表・ゾーン中央値・ワイド切替オッズ・
+推奨フォーメーションを読むためのもの。読み出し専用で、履歴ストアの全レースを累積に使う。
+累積は履歴ストアの共有スナップショット（保存済みの手入力の引継ぎを含む）から作り、
+ストアが更新されたら（SQLite の data_version が変われば）次のリクエストで作り直す。
+更新がない間のリクエストは、作り置きのJSONを返すだけ。
+
+    python perfect4_api.py --db perfect4_history.sqlite3 --port 8765
+
+エンドポイント（GET）：
+  /status                  累積R数・ストアの版・キャッシュ件数
+  /tables/12 | 13 | 23     1→2・1-3・2-3 の評価組み合わせ表（回数・割合%）
+  /nishafuku               個別2車複の累積表（EV診断列つき）
+  /zones                   的中ゾーン分布・ゾーン中央値・仮想回収寄与率
+  /wide?pair=1-2           推奨流れワイドの切替オッズ（pair 省略時は 1-2 / 1-3 / 2-3）
+  /formations              推奨フォーメーション（各ロジックの選定結果）
+  /card?vline=3571246&race=5   そのV評価のレースの判断表（車番）
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from perfect4_core import (
+    CARD_WIDE_SWITCH_PAIRS,
+    DAILY_FIELD_SIZES,
+    FIELD_SIZE,
+    NISHAFUKU_PAIRS,
+    build_axis1_stability_hybrid_formation_summary,
+    build_conditional_tables,
+    build_cross_formation_summary,
+    build_cumulative_totals,
+    build_nishafuku_pairs_frame,
+    build_pair13_combo_tables,
+    build_pair23_combo_tables,
+    build_race_row,
+    build_sanrenpuku_4point_candidate_summary,
+    build_virtual_zone_roi_table,
+    build_zone_median_odds,
+    calculate_ev_metrics,
+    card_decision_context,
+    history_snapshot,
+    new_daily_aggregates,
+    nishafuku_label,
+    race_decision_bundle,
+    wide_pair_switch_stats,
+    zone_row,
+    zone_total_row,
+)
+
+DEFAULT_API_PORT = 8765
+# 作り置きする応答の上限（パス+クエリごと、古く使われていないものから捨てる）。
+API_RESPONSE_CACHE_MAXSIZE = 256
+
+
+def _json_clean(v):
+    """JSON にできない値をそろえる（NaN・無限大は null、numpy の値は Python の値）。"""
+    if isinstance(v, dict):
+        return {k: _json_clean(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_json_clean(x) for x in v]
+    if isinstance(v, (float, np.floating)):
+        return float(v) if np.isfinite(v) else None
+    return v
+
+
+def _json_default(v):
+    if isinstance(v, np.integer):
+        return int(v)
+    if isinstance(v, np.bool_):
+        return bool(v)
+    if isinstance(v, np.ndarray):
+        return _json_clean(v.tolist())
+    if isinstance(v, pd.DataFrame):
+        return frame_records(v)
+    return str(v)
+
+
+def frame_records(df: pd.DataFrame) -> List[Dict]:
+    """DataFrame を JSON にできる行のリストにする（NaN・無限大は null）。"""
+    if df is None or df.empty:
+        return []
+    out = df.astype(object).where(df.notna(), None)
+    return _json_clean(out.to_dict("records"))
+
+
+def to_json_bytes(payload) -> bytes:
+    return json.dumps(_json_clean(payload), ensure_ascii=False, default=_json_default, allow_nan=False).encode("utf-8")
+
+
+# =========================
+# 累積と応答の作り置き
+# =========================
+# 累積（view）はストアの版ごとに1つ作り、丸ごと差し替える。リクエストは差し替え時だけ
+# ロックを取り、応答はその時点の view から作る（作っている間もほかのリクエストは進む）。
+def new_api_state(db_path: str | None = None) -> Dict:
+    """API の状態。読むストアと、いまの版の view。"""
+    return {
+        "path": db_path,
+        "lock": threading.Lock(),
+        "view": None,
+    }
+
+
+def build_api_view(snap: Dict) -> Dict:
+    """スナップショット1つ分の累積・判断材料と、その版の応答の作り置き。"""
+    t0 = time.perf_counter()
+    totals = build_cumulative_totals(new_daily_aggregates(), snap["agg"], snap["carryover"])
+    return {
+        "version": snap["version"],
+        "totals": totals,
+        "zone_sketches": snap["zone_sketches"],
+        "zone_carryover": snap["carryover"].get("zone_median_carryover"),
+        "context": card_decision_context(totals),
+        "responses": OrderedDict(),
+        "responses_lock": threading.Lock(),
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "build_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+    }
+
+
+def refresh_api_state(state: Dict) -> Dict:
+    """ストアの版が変わっていれば view を作り直して差し替える。戻り値はいまの view。"""
+    with state["lock"]:
+        snap = history_snapshot(state["path"])
+        view = state["view"]
+        if view is None or view["version"] != snap["version"]:
+            view = build_api_view(snap)
+            state["view"] = view
+        return view
+
+
+def _cached_response(view: Dict, key: str) -> bytes | None:
+    with view["responses_lock"]:
+        body = view["responses"].get(key)
+        if body is not None:
+            view["responses"].move_to_end(key)
+        return body
+
+
+def _store_response(view: Dict, key: str, body: bytes) -> None:
+    with view["responses_lock"]:
+        view["responses"][key] = body
+        view["responses"].move_to_end(key)
+        while len(view["responses"]) > API_RESPONSE_CACHE_MAXSIZE:
+            view["responses"].popitem(last=False)
+
+
+# =========================
+# エンドポイント
+# =========================
+# 1エンドポイント＝（クエリの読み取り, 応答の組み立て）。
+# 読み取りの ValueError は入力の誤り（400）、組み立ての例外はサーバー側の誤り（500）。
+def _no_query(query: Dict) -> Dict:
+    return {}
+
+
+def _api_status(view: Dict, args: Dict) -> Dict:
+    return {
+        "races": int(view["totals"]["finish_tensor"].sum()),
+        "version": view["version"],
+        "built_at": view["built_at"],
+        "build_ms": view["build_ms"],
+        "cached": len(view["responses"]),
+    }
+
+
+def _api_tables(kind: str):
+    builders = {
+        "12": build_conditional_tables,
+        "13": build_pair13_combo_tables,
+        "23": build_pair23_combo_tables,
+    }
+
+    def _handler(view: Dict, args: Dict) -> Dict:
+        df_counts, df_rates = builders[kind](view["totals"][f"pair{kind}"])
+        return {"counts": frame_records(df_counts), "rates": frame_records(df_rates)}
+
+    return _handler
+
+
+def _api_nishafuku(view: Dict, args: Dict) -> Dict:
+    totals = view["totals"]
+    df = calculate_ev_metrics(build_nishafuku_pairs_frame(totals["payout_nishafuku"], totals["pair12"]), "2車複")
+    return {"rows": frame_records(df)}
+
+
+def _api_zones(view: Dict, args: Dict) -> Dict:
+    payout = view["totals"]["payout_nishafuku"]
+    labels = [nishafuku_label(a, b) for a, b in NISHAFUKU_PAIRS if nishafuku_label(a, b) in payout]
+    zone_rows = [zone_row(label.split(" ", 1)[1], payout[label]) for label in labels]
+    zone_rows.append(zone_total_row([payout[label] for label in labels]))
+    zone_odds, zone_counts, df_medians = build_zone_median_odds(
+        [], NISHAFUKU_PAIRS, view["zone_carryover"], zone_sketches={}, history_sketches=view["zone_sketches"]
+    )
+    return {
+        "zones": zone_rows,
+        "medians": zone_odds,
+        "median_counts": zone_counts,
+        "median_rows": frame_records(df_medians),
+        "virtual_roi": frame_records(build_virtual_zone_roi_table(payout, NISHAFUKU_PAIRS, zone_odds)),
+    }
+
+
+def _parse_rank_pair(text: str) -> Tuple[int, int]:
+    a, b = [int(x) for x in str(text).split("-")]
+    if a == b or not (1 <= a <= FIELD_SIZE and 1 <= b <= FIELD_SIZE):
+        raise ValueError(f"pair は 1〜{FIELD_SIZE} の異なる2つで指定してください: {text!r}")
+    return a, b
+
+
+def _parse_wide(query: Dict) -> Dict:
+    return {"pairs": [_parse_rank_pair(p) for p in query.get("pair", [])] or list(CARD_WIDE_SWITCH_PAIRS)}
+
+
+def _api_wide(view: Dict, args: Dict) -> Dict:
+    totals = view["totals"]
+    return {
+        "rows": [
+            wide_pair_switch_stats(a, b, totals["pair12"], totals["pair13"], totals["pair23"])
+            for a, b in args["pairs"]
+        ]
+    }
+
+
+def _api_formations(view: Dict, args: Dict) -> Dict:
+    totals = view["totals"]
+    df_pairs = calculate_ev_metrics(build_nishafuku_pairs_frame(totals["payout_nishafuku"], totals["pair12"]), "2車複")
+    return {
+        "formations": view["context"]["formations"],
+        "summaries": {
+            "クロスフォーメーション": build_cross_formation_summary(df_pairs, totals["pair12"]),
+            "三連複4点BOX": build_sanrenpuku_4point_candidate_summary(df_pairs),
+            "三連複12-123-12345": build_axis1_stability_hybrid_formation_summary(
+                df_pairs, totals["rank"], totals["pair12"]
+            ),
+        },
+    }
+
+
+def _parse_card(query: Dict) -> Dict:
+    vline = (query.get("vline") or [""])[0]
+    field_n = len(vline.strip())
+    if field_n not in DAILY_FIELD_SIZES:
+        raise ValueError(f"vline は 7 / 6 / 5 桁で指定してください: {vline!r}")
+    row, issues = build_race_row((query.get("race") or [""])[0], field_n, vline, "", 0)
+    if row is None:
+        raise ValueError("、".join(issues) or f"vline を読めません: {vline!r}")
+    return {"row": row}
+
+
+def _api_card(view: Dict, args: Dict) -> Dict:
+    return race_decision_bundle(view["context"], args["row"])
+
+
+API_ROUTES = {
+    "/status": (_no_query, _api_status),
+    "/tables/12": (_no_query, _api_tables("12")),
+    "/tables/13": (_no_query, _api_tables("13")),
+    "/tables/23": (_no_query, _api_tables("23")),
+    "/nishafuku": (_no_query, _api_nishafuku),
+    "/zones": (_no_query, _api_zones),
+    "/wide": (_parse_wide, _api_wide),
+    "/formations": (_no_query, _api_formations),
+    "/card": (_parse_card, _api_card),
+}
+
+
+def api_response(state: Dict, target: str) -> Tuple[int, bytes]:
+    """
+    リクエスト1件を (HTTPステータス, JSONバイト列) にする。
+
+    /status 以外は「パス+クエリ」ごとに作り置き（最大 API_RESPONSE_CACHE_MAXSIZE 件）、
+    ストアの版が変わるまで使い回す。
+    """
+    parts = urlsplit(target)
+    path = parts.path.rstrip("/") or "/"
+    route = API_ROUTES.get(path)
+    if route is None:
+        return 404, to_json_bytes({"error": f"not found: {parts.path}", "routes": sorted(API_ROUTES)})
+    parse, build = route
+    view = refresh_api_state(state)
+    key = f"{path}?{parts.query}"
+    cacheable = build is not _api_status
+    body = _cached_response(view, key) if cacheable else None
+    if body is not None:
+        return 200, body
+    try:
+        args = parse(parse_qs(parts.query))
+    except ValueError as e:
+        return 400, to_json_bytes({"error": str(e)})
+    try:
+        body = to_json_bytes(build(view, args))
+    except Exception as e:
+        return 500, to_json_bytes({"error": f"{type(e).__name__}: {e}"})
+    if cacheable:
+        _store_response(view, key, body)
+    return 200, body
+
+
+def make_handler(state: Dict):
+    """state を読む BaseHTTPRequestHandler（http.server の作法上クラスが要る）。"""
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            status, body = api_response(state, self.path)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) -> None:
+            pass  # 高頻度のポーリングでログが埋まらないように黙らせる
+
+    return _Handler
+
+
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="集計・推奨をローカルHTTP/JSONで返す")
+    ap.add_argument("--db", default=None, help="履歴ストアのパス（既定：perfect4_history.sqlite3）")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=DEFAULT_API_PORT)
+    args = ap.parse_args(argv)
+
+    state = new_api_state(args.db)
+    view = refresh_api_state(state)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print(
+        f"http://{args.host}:{args.port}/ で待ち受けます（累積{int(view['totals']['finish_tensor'].sum())}R）。",
+        file=sys.stderr,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+買い目推奨ロジックのウォークフォワード検証。
+
+履歴ストアのレースを日付順に再生し、各日の推奨は「その日より前の累積」だけで作る。
+推奨した買い目をその日の全レースに当てて、的中・払戻・収支を記録する。
+累積は日ごとの集計を足し込むだけで、毎日作り直さない。
+
+    python perfect4_backtest.py --db perfect4_history.sqlite3 --since 2025-01-01 --out bt.csv
+"""
+
+import argparse
+from contextlib import closing
+from typing import Callable, List, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from perfect4_core import (
+    aggregate_race_arrays,
+    batch_nishafuku_pair,
+    batch_sanrenpuku_key,
+    build_axis1_stability_hybrid_formation_summary,
+    build_cross_formation_summary,
+    build_df_pairs,
+    build_sanrenpuku_4point_candidate_summary,
+    calculate_ev_metrics,
+    cumulative_view,
+    history_connect,
+    history_load_race_records,
+    merge_daily_aggregates,
+    new_daily_aggregates,
+    race_array_count,
+    race_arrays_from_records,
+    split_records_by_date,
+)
+
+
+# =========================
+# 推奨ロジック
+# =========================
+# 各ロジックは (df_pairs, 累積) を受け取り、(券種, 型, 買い目リスト) か None を返す。
+# df_pairs は画面と同じ「個別2車複 累積表 + EV診断列」。
+# 注意：クロスフォーメーションは df_pairs の「判定」列が本線/注のペアを中心にするが、
+# 現状の累積表はこの列を埋めないため、推奨なし（見送り）として記録される。
+def _recommend_cross(df_pairs: pd.DataFrame, cum: Dict) -> Tuple[str, str, List[str]] | None:
+    best = build_cross_formation_summary(df_pairs, cum["pair12"])
+    if not best:
+        return None
+    return "2車複", str(best.get("型", "")), list(best.get("買い目") or [])
+
+
+def _recommend_sanrenpuku_4point(df_pairs: pd.DataFrame, cum: Dict) -> Tuple[str, str, List[str]] | None:
+    best = build_sanrenpuku_4point_candidate_summary(df_pairs)
+    if not best:
+        return None
+    return "3連複", str(best.get("型", "")), list(best.get("買い目") or [])
+
+
+def _recommend_axis1_hybrid(df_pairs: pd.DataFrame, cum: Dict) -> Tuple[str, str, List[str]] | None:
+    best = build_axis1_stability_hybrid_formation_summary(df_pairs, cum["rank"], cum["pair12"])
+    if not best:
+        return None
+    return "3連複", str(best.get("型", "")), list(best.get("買い目") or [])
+
+
+RECOMMENDERS: Dict[str, Callable] = {
+    "クロスフォーメーション": _recommend_cross,
+    "三連複4点BOX": _recommend_sanrenpuku_4point,
+    "三連複12-123-12345": _recommend_axis1_hybrid,
+}
+
+
+# =========================
+# 買い目の当日評価
+# =========================
+def evaluate_bets(races: Dict[str, np.ndarray], bet_type: str, keys: List[str]) -> Dict[str, int]:
+    """
+    評価順位の買い目を、当日の全レースに1点100円で当てる。
+
+    2車複は2車複払戻、3連複は3連複払戻（pay_3f）を使う。
+    3連複は払戻未入力のことが多いので、払戻0の的中は「払戻不明的中」として別に数える。
+    """
+    n = race_array_count(races)
+    ksum_total = np.zeros(n, dtype=np.int64)
+    hit = np.zeros(n, dtype=bool)
+    for key in keys:
+        if bet_type == "2車複":
+            a, b = [int(x) for x in str(key).split("-")]
+            ksum, h = batch_nishafuku_pair(races, a, b)
+        else:
+            ksum, h = batch_sanrenpuku_key(races, key)
+        ksum_total += ksum
+        hit |= h
+    pay = races["pay_2f"] if bet_type == "2車複" else races["pay_3f"]
+    return score_bet_masks(ksum_total, hit, pay)
+
+
+def score_bet_masks(ksum: np.ndarray, hit: np.ndarray, pay: np.ndarray) -> Dict[str, int]:
+    """レースごとの点数・的中マスク・払戻から、1点100円の成績をまとめる。"""
+    played = ksum > 0
+    paid = played & hit & (pay > 0)
+    return {
+        "R数": int(np.count_nonzero(played)),
+        "投資": int(ksum.sum()) * 100,
+        "的中R": int(np.count_nonzero(played & hit)),
+        "払戻": int(pay[paid].sum()),
+        "払戻不明的中": int(np.count_nonzero(played & hit & (pay <= 0))),
+    }
+
+
+# =========================
+# ウォークフォワード
+# =========================
+def load_history_days(
+    conn,
+    since: str | None = None,
+    until: str | None = None,
+) -> List[Tuple[str, Dict[str, np.ndarray]]]:
+    """履歴ストアを日付ごとのレース配列に分けて読む（日付昇順）。"""
+    records = history_load_race_records(conn, since=since, until=until)
+    return [(d, race_arrays_from_records(recs)) for d, recs in split_records_by_date(records)]
+
+
+def walk_forward(
+    days: List[Tuple[str, Dict[str, np.ndarray]]],
+    recommenders: Dict[str, Callable] | None = None,
+    initial_agg: Dict | None = None,
+    min_history_races: int = 50,
+    ev_metrics: Callable = calculate_ev_metrics,
+) -> pd.DataFrame:
+    """
+    日付順に再生して、日×推奨ロジックごとの成績を1行ずつ返す。
+
+    initial_agg：再生開始前から持っている累積（手入力の引継ぎなど）。
+    min_history_races：累積がこのR数に届くまでの日は、推奨せず累積だけ進める。
+    ev_metrics：df_pairs に EV診断列を付ける関数（定数を変えた検証用に差し替え可）。
+    """
+    recommenders = RECOMMENDERS if recommenders is None else recommenders
+    agg = initial_agg if initial_agg is not None else new_daily_aggregates()
+    records = []
+
+    for race_date, races in days:
+        cum = cumulative_view(agg)
+        if cum["races"] >= int(min_history_races) and race_array_count(races) > 0:
+            df_pairs = build_df_pairs(cum, ev_metrics)
+            for name, recommend in recommenders.items():
+                pick = recommend(df_pairs, cum)
+                rec = {"日付": race_date, "方式": name, "累積R": cum["races"]}
+                if pick is None or not pick[2]:
+                    rec.update({"券種": "", "型": "見送り", "買い目": "", "R数": 0, "投資": 0,
+                                "的中R": 0, "払戻": 0, "払戻不明的中": 0})
+                else:
+                    bet_type, form_type, keys = pick
+                    rec.update({"券種": bet_type, "型": form_type, "買い目": " / ".join(keys)})
+                    rec.update(evaluate_bets(races, bet_type, keys))
+                rec["収支"] = rec["払戻"] - rec["投資"]
+                records.append(rec)
+
+        # 当日の結果はここで初めて累積へ入れる（先読みしない）。
+        merge_daily_aggregates(agg, aggregate_race_arrays(races))
+
+    return pd.DataFrame(records, columns=[
+        "日付", "方式", "累積R", "券種", "型", "買い目", "R数", "投資", "的中R", "払戻", "払戻不明的中", "収支",
+    ])
+
+
+def _max_drawdown(pnl: pd.Series) -> int:
+    equity = pnl.cumsum()
+    peak = equity.cummax().clip(lower=0)
+    return int((peak - equity).max()) if len(equity) else 0
+
+
+def summarize_backtest(df: pd.DataFrame) -> pd.DataFrame:
+    """方式ごとの通算成績。回収率は払戻が分かる分だけで計算する。"""
+    rows = []
+    if df is None or df.empty:
+        return pd.DataFrame(rows)
+    for name, g in df.groupby("方式", sort=False):
+        g = g.sort_values("日付")
+        invest = int(g["投資"].sum())
+        races = int(g["R数"].sum())
+        hits = int(g["的中R"].sum())
+        rows.append({
+            "方式": name,
+            "日数": int((g["R数"] > 0).sum()),
+            "見送り日": int((g["型"] == "見送り").sum()),
+            "R数": races,
+            "投資": invest,
+            "的中R": hits,
+            "的中率%": round(100.0 * hits / races, 1) if races > 0 else None,
+            "払戻": int(g["払戻"].sum()),
+            "払戻不明的中": int(g["払戻不明的中"].sum()),
+            "収支": int(g["収支"].sum()),
+            "回収率%": round(100.0 * g["払戻"].sum() / invest, 1) if invest > 0 else None,
+            "最大DD": _max_drawdown(g["収支"]),
+        })
+    return pd.DataFrame(rows)
+
+
+def main(argv: List[str] | None = None) -> None:
+    ap = argparse.ArgumentParser(description="履歴ストアで推奨ロジックをウォークフォワード検証する")
+    ap.add_argument("--db", default=None, help="履歴ストアのパス（既定：perfect4_history.sqlite3）")
+    ap.add_argument("--since", default=None, help="この日付以降を再生（YYYY-MM-DD）")
+    ap.add_argument("--until", default=None, help="この日付までを再生（YYYY-MM-DD）")
+    ap.add_argument("--min-history", type=int, default=50, help="推奨を始める累積R数")
+    ap.add_argument("--out", default=None, help="日別明細のCSV出力先")
+    args = ap.parse_args(argv)
+
+    with closing(history_connect(args.db)) as conn:
+        days = load_history_days(conn, since=args.since, until=args.until)
+        # --since より前の履歴は、再生開始時点の累積として使う。
+        initial = None
+        if args.since:
+            initial = aggregate_race_arrays(race_arrays_from_records(history_load_race_records(conn, before=args.since)))
+    df = walk_forward(days, initial_agg=initial, min_history_races=args.min_history)
+    if args.out:
+        df.to_csv(args.out, index=False, encoding="utf-8-sig")
+    print(summarize_backtest(df).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
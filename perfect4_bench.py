@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+合成レースの生成と、集計経路のベンチマーク。
+
+generate_synthetic_races は byrace_rows と同じ形のレースを乱数シード固定で作る。
+頭数（5/6/7）の比率・V評価の当たりやすさ・払戻の分布・未入力の割合を引数で変えられる。
+
+ベンチマークは 100 / 1万 / 100万レースで、画面と検証スクリプトが通る集計経路を計る。
+結果をJSONに保存しておき、次回 --baseline で比べれば遅くなった処理が分かる。
+メモリ表は、1セッション・1プロセスにどれだけ履歴を載せられるかの目安に使う。
+
+    python perfect4_bench.py --sizes 100 10000 1000000 --save bench.json
+    python perfect4_bench.py --baseline bench.json
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import date, timedelta
+from typing import Callable, List, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from perfect4_core import (
+    FIELD_SIZE,
+    NISHAFUKU_PAIRS,
+    aggregate_byrace_rows,
+    aggregate_race_arrays,
+    build_axis1_stability_hybrid_formation_summary,
+    build_conditional_tables,
+    build_conditional_tables_13,
+    build_cross_formation_summary,
+    build_cumulative_totals,
+    build_nishafuku_pairs_frame,
+    build_pair13_combo_tables,
+    build_pair23_combo_tables,
+    build_sanrenpuku_4point_candidate_summary,
+    build_virtual_zone_roi_table,
+    build_zone_median_odds,
+    calculate_ev_metrics,
+    encode_race_arrays,
+    encode_race_records,
+    evaluate_portfolios,
+    pair_counts_from_tensor,
+    race_outcome_distribution,
+    rank_counts_from_tensor,
+    ticket_payoff_matrix,
+)
+
+# 結果キャッシュ付きの関数は元の関数を計る（同じ入力の繰り返しでキャッシュ命中を計らないように）。
+build_conditional_tables = build_conditional_tables.__wrapped__
+build_conditional_tables_13 = build_conditional_tables_13.__wrapped__
+build_pair13_combo_tables = build_pair13_combo_tables.__wrapped__
+build_pair23_combo_tables = build_pair23_combo_tables.__wrapped__
+build_virtual_zone_roi_table = build_virtual_zone_roi_table.__wrapped__
+build_nishafuku_pairs_frame = build_nishafuku_pairs_frame.__wrapped__
+calculate_ev_metrics = calculate_ev_metrics.__wrapped__
+
+DEFAULT_SIZES = (100, 10_000, 1_000_000)
+
+
+# =========================
+# 合成レース
+# =========================
+def generate_synthetic_races(
+    n: int,
+    seed: int = 0,
+    field_sizes: Tuple[int, ...] = (7, 6, 5),
+    field_weights: Tuple[float, ...] = (0.70, 0.20, 0.10),
+    skill: float = 0.35,
+    takeout: float = 0.75,
+    payout_sigma: float = 0.35,
+    pay_2t_rate: float = 0.5,
+    pay_3f_rate: float = 0.3,
+    partial_finish_rate: float = 0.01,
+    off_card_rate: float = 0.005,
+    races_per_day: int = 12,
+    start_date: str | None = None,
+) -> List[Dict]:
+    """
+    byrace_rows と同じ形の合成レースを n 件作る。
+
+    着順はV評価順位 r の強さを exp(-skill×(r-1)) とした Plackett-Luce で引く（skill=0 で完全ランダム）。
+    払戻は「その着順の理論確率」から takeout / p を基準オッズにし、対数正規のゆらぎを掛けて10円単位に丸める。
+    2車単・3連複の払戻は pay_2t_rate / pay_3f_rate の割合だけ入力済みにする（残りは0＝未入力）。
+    partial_finish_rate：着順が2つしか入っていないレースの割合。
+    off_card_rate：1着がV評価にない車番（"9"）のレースの割合。
+    start_date を渡すと races_per_day ごとに日付を進めた "date" 列を付ける（履歴ストア投入用）。
+    """
+    n = int(n)
+    rng = np.random.default_rng(seed)
+    sizes = np.asarray(field_sizes, dtype=np.int64)
+    weights = np.asarray(field_weights, dtype=float)
+    field_n = rng.choice(sizes, size=n, p=weights / weights.sum())
+
+    # 評価順位ごとの強さ。出走していない枠は強さ0。
+    pos = np.arange(FIELD_SIZE)
+    strength = np.exp(-float(skill) * pos)[None, :].repeat(n, axis=0)
+    strength[pos[None, :] >= field_n[:, None]] = 0.0
+
+    # Gumbel 最大で Plackett-Luce の着順（評価順位の並び）を一度に引く。
+    with np.errstate(divide="ignore"):
+        keys = np.log(strength) + rng.gumbel(size=strength.shape)
+    order = np.argsort(-keys, axis=1)[:, :3]
+    total = strength.sum(axis=1)
+    w = np.take_along_axis(strength, order, axis=1)
+    w1, w2, w3 = w[:, 0], w[:, 1], w[:, 2]
+
+    def _p_ordered(a, b):
+        return (a / total) * (b / (total - a))
+
+    p_2t = _p_ordered(w1, w2)
+    p_2f = p_2t + _p_ordered(w2, w1)
+    p_3f = np.zeros(n)
+    for x, y, z in ((w1, w2, w3), (w1, w3, w2), (w2, w1, w3), (w2, w3, w1), (w3, w1, w2), (w3, w2, w1)):
+        p_3f += _p_ordered(x, y) * (z / (total - x - y))
+
+    def _pay(p, rate):
+        odds = float(takeout) / np.maximum(p, 1e-9) * rng.lognormal(0.0, float(payout_sigma), size=n)
+        pay = np.maximum(100, np.round(odds * 10.0) * 10).astype(np.int64)
+        return np.where(rng.random(n) < float(rate), pay, 0)
+
+    pay_2t = _pay(p_2t, pay_2t_rate)
+    pay_2f = _pay(p_2f, 1.0)
+    pay_3f = _pay(p_3f, pay_3f_rate)
+    partial = rng.random(n) < float(partial_finish_rate)
+    off_card = rng.random(n) < float(off_card_rate)
+    pay_3f[partial] = 0
+
+    # 車番はレースごとに並べ替え、V評価＝車番を評価順に並べたものにする。
+    cars = np.argsort(rng.random((n, FIELD_SIZE)), axis=1) + 1
+
+    start = date.fromisoformat(start_date) if start_date else None
+    per_day = max(1, int(races_per_day))
+    rows = []
+    for i in range(n):
+        fn = int(field_n[i])
+        vorder = [str(c) for c in cars[i] if c <= fn]
+        finish = [vorder[r] for r in order[i]]
+        if off_card[i]:
+            finish[0] = "9"
+        if partial[i]:
+            finish = finish[:2]
+        row = {
+            "race": i % per_day + 1,
+            "field_n": fn,
+            "vorder": vorder,
+            "finish": finish,
+            "pay_2t": int(pay_2t[i]),
+            "pay_2f": int(pay_2f[i]),
+            "pay_3f": int(pay_3f[i]),
+        }
+        if start is not None:
+            row["date"] = (start + timedelta(days=i // per_day)).isoformat()
+        rows.append(row)
+    return rows
+
+
+# =========================
+# ベンチマーク
+# =========================
+def _bench_context(rows: List[Dict]) -> Dict:
+    """各ケースが使う入力を一度だけ作る（作る時間は計測に入れない）。"""
+    races = encode_race_arrays(rows)
+    agg = aggregate_race_arrays(races)
+    tensor = agg["finish_tensor"]
+    pair12 = pair_counts_from_tensor(tensor, "12")
+    df_base = build_nishafuku_pairs_frame(agg["payout_nishafuku"], pair12)
+    return {
+        "rows": rows,
+        "races": races,
+        "agg": agg,
+        "pair12": pair12,
+        "pair13": pair_counts_from_tensor(tensor, "13"),
+        "pair23": pair_counts_from_tensor(tensor, "23"),
+        "rank": rank_counts_from_tensor(tensor),
+        "df_base": df_base,
+        "df_pairs": calculate_ev_metrics(df_base, "2車複"),
+    }
+
+
+# ポートフォリオ評価のケース：1レース分の払戻行列を作り、賭け金の組を300通り評価する。
+_BENCH_TICKETS = [("2車複", "1-2"), ("2車複", "1-3"), ("2車複", "2-3"), ("ワイド", "1-2"),
+                  ("3連複", "1-2-3"), ("3連複", "1-2-4"), ("3連複", "1-3-4"), ("3連複", "2-3-4")]
+_BENCH_TICKET_ODDS = [3.5, 5.0, 9.0, 1.6, 7.5, 14.0, 22.0, 40.0]
+_BENCH_STAKE_SETS = np.random.default_rng(0).integers(0, 4, size=(300, len(_BENCH_TICKETS))) * 100
+
+
+def _bench_portfolios(ctx: Dict) -> object:
+    dist = race_outcome_distribution(ctx["agg"]["finish_tensor"], FIELD_SIZE, prior=0.5)
+    payoff = ticket_payoff_matrix(dist, _BENCH_TICKETS, _BENCH_TICKET_ODDS)
+    return evaluate_portfolios(dist, payoff, _BENCH_STAKE_SETS)
+
+
+# (ケース名, 区分, 関数)。区分「集計」はレース数に比例する処理、「表」は累積表からの処理。
+BENCH_CASES: List[Tuple[str, str, Callable[[Dict], object]]] = [
+    ("encode_race_arrays", "集計", lambda c: encode_race_arrays(c["rows"])),
+    ("encode_race_records", "集計", lambda c: encode_race_records(c["rows"])),
+    ("aggregate_byrace_rows", "集計", lambda c: aggregate_byrace_rows(c["rows"])),
+    ("aggregate_race_arrays", "集計", lambda c: aggregate_race_arrays(c["races"])),
+    ("build_cumulative_totals", "集計", lambda c: build_cumulative_totals(c["agg"], c["agg"])),
+    ("build_zone_median_odds（走査）", "集計", lambda c: build_zone_median_odds(c["rows"], NISHAFUKU_PAIRS)),
+    ("build_zone_median_odds（スケッチ）", "表", lambda c: build_zone_median_odds(
+        c["rows"], NISHAFUKU_PAIRS, zone_sketches=c["agg"]["zone_sketches"])),
+    ("build_conditional_tables", "表", lambda c: build_conditional_tables(c["pair12"])),
+    ("build_conditional_tables_13", "表", lambda c: build_conditional_tables_13(c["pair13"])),
+    ("build_pair13_combo_tables", "表", lambda c: build_pair13_combo_tables(c["pair13"])),
+    ("build_pair23_combo_tables", "表", lambda c: build_pair23_combo_tables(c["pair23"])),
+    ("build_virtual_zone_roi_table", "表", lambda c: build_virtual_zone_roi_table(
+        c["agg"]["payout_nishafuku"], NISHAFUKU_PAIRS)),
+    ("build_nishafuku_pairs_frame", "表", lambda c: build_nishafuku_pairs_frame(
+        c["agg"]["payout_nishafuku"], c["pair12"])),
+    ("calculate_ev_metrics", "表", lambda c: calculate_ev_metrics(c["df_base"], "2車複")),
+    ("build_cross_formation_summary", "表", lambda c: build_cross_formation_summary(c["df_pairs"], c["pair12"])),
+    ("build_sanrenpuku_4point_candidate_summary", "表", lambda c: build_sanrenpuku_4point_candidate_summary(
+        c["df_pairs"])),
+    ("build_axis1_stability_hybrid_formation_summary", "表", lambda c: build_axis1_stability_hybrid_formation_summary(
+        c["df_pairs"], c["rank"], c["pair12"])),
+    ("evaluate_portfolios（300組）", "表", _bench_portfolios),
+]
+
+
+def _time_case(fn: Callable[[Dict], object], ctx: Dict, repeat: int, max_total_sec: float, warmup: bool) -> Tuple[float, float, int]:
+    """最速と平均（ミリ秒）と実行回数。1回で max_total_sec を超える重い処理は繰り返さない。"""
+    if warmup:
+        fn(ctx)
+    times = []
+    total = 0.0
+    for _ in range(max(1, int(repeat))):
+        t0 = time.perf_counter()
+        fn(ctx)
+        dt = time.perf_counter() - t0
+        times.append(dt)
+        total += dt
+        if total >= max_total_sec:
+            break
+    return min(times) * 1000.0, sum(times) / len(times) * 1000.0, len(times)
+
+
+def _rows_bytes(rows: List[Dict], sample: int = 2000) -> int:
+    """byrace_rows のおおよそのメモリ量（先頭 sample 件の実測から比例で出す）。"""
+    if not rows:
+        return 0
+    part = rows[:sample]
+    size = 0
+    for row in part:
+        size += sys.getsizeof(row)
+        for v in row.values():
+            size += sys.getsizeof(v)
+            if isinstance(v, list):
+                size += sum(sys.getsizeof(x) for x in v)
+    return int(size * len(rows) / len(part))
+
+
+def run_benchmarks(
+    sizes=DEFAULT_SIZES,
+    seed: int = 0,
+    repeat: int = 5,
+    max_total_sec: float = 2.0,
+    cases: List[Tuple[str, str, Callable[[Dict], object]]] | None = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    サイズごとに合成レースを作って全ケースを計る。
+
+    戻り値は（時間表, メモリ表）。時間表の「μs/R」は区分「集計」のケースだけ出す。
+    """
+    cases = BENCH_CASES if cases is None else cases
+    time_rows, mem_rows = [], []
+    for n in sizes:
+        t0 = time.perf_counter()
+        rows = generate_synthetic_races(int(n), seed=seed)
+        gen_sec = time.perf_counter() - t0
+        ctx = _bench_context(rows)
+
+        rows_bytes = _rows_bytes(rows)
+        arrays_bytes = int(sum(v.nbytes for v in ctx["races"].values()))
+        records_bytes = int(encode_race_records(rows).nbytes)
+        mem_rows.append({
+            "レース数": int(n),
+            "生成秒": round(gen_sec, 2),
+            "byrace_rows MB": round(rows_bytes / 1e6, 1),
+            "レース配列 MB": round(arrays_bytes / 1e6, 2),
+            "レース記録 MB": round(records_bytes / 1e6, 2),
+            "byrace_rows B/R": round(rows_bytes / max(1, int(n))),
+            "レース配列 B/R": round(arrays_bytes / max(1, int(n))),
+            "レース記録 B/R": round(records_bytes / max(1, int(n))),
+        })
+
+        for name, kind, fn in cases:
+            # 「表」のケースは軽いので、初回呼び出しのぶれを避けて1回空回ししてから計る。
+            best_ms, mean_ms, runs = _time_case(fn, ctx, repeat, max_total_sec, warmup=(kind == "表"))
+            time_rows.append({
+                "ケース": name,
+                "区分": kind,
+                "レース数": int(n),
+                "最速ms": round(best_ms, 3),
+                "平均ms": round(mean_ms, 3),
+                "回数": runs,
+                "μs/R": round(best_ms * 1000.0 / int(n), 3) if kind == "集計" and int(n) > 0 else None,
+            })
+        del ctx, rows
+    return pd.DataFrame(time_rows), pd.DataFrame(mem_rows)
+
+
+def compare_to_baseline(df: pd.DataFrame, baseline: List[Dict], tolerance: float = 1.5, min_ms: float = 5.0) -> pd.DataFrame:
+    """
+    保存済みの結果と最速msを比べる。
+
+    基準の tolerance 倍より遅いものを「遅化」とする。基準が min_ms 未満のケースは誤差が大きいので判定しない。
+    """
+    base = {(r["ケース"], int(r["レース数"])): float(r["最速ms"]) for r in baseline}
+    rows = []
+    for _, r in df.iterrows():
+        key = (r["ケース"], int(r["レース数"]))
+        if key not in base:
+            continue
+        ratio = float(r["最速ms"]) / base[key] if base[key] > 0 else None
+        if base[key] < min_ms or ratio is None:
+            status = "対象外"
+        elif ratio > tolerance:
+            status = "遅化"
+        else:
+            status = "OK"
+        rows.append({
+            "ケース": key[0],
+            "レース数": key[1],
+            "基準ms": base[key],
+            "今回ms": float(r["最速ms"]),
+            "倍率": round(ratio, 2) if ratio is not None else None,
+            "判定": status,
+        })
+    return pd.DataFrame(rows, columns=["ケース", "レース数", "基準ms", "今回ms", "倍率", "判定"])
+
+
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="合成レースで集計経路の処理時間を計る")
+    ap.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="レース数（複数可）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repeat", type=int, default=5, help="1ケースの最大繰り返し回数")
+    ap.add_argument("--save", default=None, help="結果をJSONで保存する")
+    ap.add_argument("--baseline", default=None, help="保存済みJSONと比べ、遅化があれば終了コード1")
+    ap.add_argument("--tolerance", type=float, default=1.5, help="遅化とみなす倍率")
+    args = ap.parse_args(argv)
+
+    df_time, df_mem = run_benchmarks(args.sizes, seed=args.seed, repeat=args.repeat)
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(df_time.to_string(index=False))
+        print()
+        print(df_mem.to_string(index=False))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"time": df_time.to_dict("records"), "memory": df_mem.to_dict("records")}, f, ensure_ascii=False, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("time", [])
+        df_cmp = compare_to_baseline(df_time, baseline, tolerance=args.tolerance)
+        print()
+        print(df_cmp.to_string(index=False))
+        if (df_cmp["判定"] == "遅化").any():
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,6148 @@
+# -*- coding: utf-8 -*-
+"""
+ヴェロビ復習の計算部分（Streamlitなし）。
+
+入力の解析・日次/履歴の集計・EV診断・買い目候補・ゾーン中央値・履歴ストアをまとめる。
+画面は perfect4.py（streamlit run perfect4.py）で、ここを import して表示だけ行う。
+夜間の一括集計や検証スクリプトからは、このモジュールだけを import すればよい。
+"""
+
+import copy
+import csv
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import closing, contextmanager
+from datetime import date, datetime
+from functools import lru_cache, wraps
+from itertools import product
+from typing import Callable, List, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# =========================
+# 処理時間の計測
+# =========================
+# 画面の1回の実行で、build_* / render_* / 集計がそれぞれ何ms・何行だったかを記録する。
+# 入れ子の呼び出し（render_* の中の build_* など）は depth で表し、self_ms は子を除いた時間。
+# 計測する関数には @perf_timed を付け、perf_activate でそのスレッドの記録先を決める。
+# 記録先が無い間（API・CLI・ベンチ）は、関数をそのまま呼ぶだけ。
+PERF_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "perfect4_perf.jsonl")
+_PERF_ACTIVE = threading.local()
+
+
+def new_perf_log() -> Dict:
+    return {"started": time.perf_counter(), "records": [], "stack": []}
+
+
+def perf_activate(log: Dict | None) -> None:
+    """このスレッドで @perf_timed の関数を log へ記録する。None で止める。"""
+    _PERF_ACTIVE.log = log
+
+
+def perf_active() -> Dict | None:
+    return getattr(_PERF_ACTIVE, "log", None)
+
+
+def perf_total_ms(log: Dict) -> float:
+    """計測開始（new_perf_log）からの経過ms。"""
+    return (time.perf_counter() - log["started"]) * 1000.0
+
+
+def perf_rows(value) -> int | None:
+    """記録する行数。DataFrame はその行数、DataFrame を含むタプルは先頭の DataFrame、リストは件数。"""
+    if isinstance(value, pd.DataFrame):
+        return int(len(value))
+    if isinstance(value, tuple):
+        for v in value:
+            if isinstance(v, pd.DataFrame):
+                return int(len(v))
+        return None
+    if isinstance(value, list):
+        return len(value)
+    return None
+
+
+@contextmanager
+def perf_section(log: Dict | None, name: str, kind: str = "処理", rows: int | None = None):
+    """
+    with の中の処理時間を1件記録する。yield した dict の "rows" に行数を入れられる。
+    log が None なら何もしない。
+    """
+    rec = {"name": str(name), "kind": str(kind), "rows": rows}
+    if log is None:
+        yield rec
+        return
+    rec["seq"] = len(log["records"])
+    rec["depth"] = len(log["stack"])
+    log["records"].append(rec)
+    log["stack"].append(0.0)
+    t0 = time.perf_counter()
+    try:
+        yield rec
+    finally:
+        ms = (time.perf_counter() - t0) * 1000.0
+        child_ms = log["stack"].pop()
+        if log["stack"]:
+            log["stack"][-1] += ms
+        rec["ms"] = ms
+        rec["self_ms"] = max(0.0, ms - child_ms)
+
+
+def _perf_call(log: Dict, name: str, kind: str, fn: Callable, args, kwargs):
+    with perf_section(log, name, kind) as rec:
+        out = fn(*args, **kwargs)
+        rows = perf_rows(out)
+        if rows is None:
+            inputs = [v for v in (*args, *kwargs.values()) if isinstance(v, (pd.DataFrame, list))]
+            rows = perf_rows(inputs[0]) if inputs else None
+        rec["rows"] = rows
+    return out
+
+
+def perf_wrap(log: Dict, fn: Callable, kind: str | None = None) -> Callable:
+    """
+    関数を perf_section で包む。区分は関数名の接頭辞（build_ / render_ / aggregate_ など）から決める。
+    行数は戻り値から取り、取れなければ最初の DataFrame／リスト引数の行数にする。
+    """
+    name = getattr(fn, "__name__", str(fn))
+    kind = kind or name.split("_", 1)[0]
+
+    @wraps(fn)
+    def _wrapped(*args, **kwargs):
+        return _perf_call(log, name, kind, fn, args, kwargs)
+
+    return _wrapped
+
+
+def perf_timed(fn: Callable | None = None, *, kind: str | None = None) -> Callable:
+    """
+    perf_activate で決めた記録先へ、呼び出しごとの時間を記録するデコレータ（perf_wrap と同じ記録）。
+
+    @content_cached の外側に付ければキャッシュ命中も記録される。
+    __wrapped__ は中の関数のものを引き継ぐので、キャッシュ抜きの元の関数はこれまでどおり呼べる。
+    """
+    def _decorate(func: Callable) -> Callable:
+        name = getattr(func, "__name__", str(func))
+        k = kind or name.split("_", 1)[0]
+
+        @wraps(func)
+        def _timed(*args, **kwargs):
+            log = getattr(_PERF_ACTIVE, "log", None)
+            if log is None:
+                return func(*args, **kwargs)
+            return _perf_call(log, name, k, func, args, kwargs)
+
+        _timed.__wrapped__ = getattr(func, "__wrapped__", func)
+        return _timed
+
+    return _decorate(fn) if fn is not None else _decorate
+
+
+def perf_log_frame(log: Dict) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    （呼び出し順の明細, 処理別の合計）を返す。
+
+    全体比% は実行開始からの経過時間に対する割合。処理別の合計は self_ms の降順で、
+    入れ子の重複を除いた「その処理自身の時間」で並べる。
+    """
+    total_ms = perf_total_ms(log)
+    rows = []
+    for rec in log["records"]:
+        ms = rec.get("ms")
+        if ms is None:
+            continue
+        rows.append({
+            "順": rec["seq"] + 1,
+            "区分": rec["kind"],
+            "処理": "　" * int(rec["depth"]) + rec["name"],
+            "ms": round(ms, 1),
+            "自身ms": round(rec["self_ms"], 1),
+            "行数": rec.get("rows"),
+            "全体比%": round(100.0 * ms / total_ms, 1) if total_ms > 0 else None,
+        })
+    df_calls = pd.DataFrame(rows, columns=["順", "区分", "処理", "ms", "自身ms", "行数", "全体比%"])
+    df_calls["行数"] = df_calls["行数"].astype("Int64")
+
+    by_name: Dict[str, Dict] = {}
+    for rec in log["records"]:
+        if rec.get("ms") is None:
+            continue
+        item = by_name.setdefault(rec["name"], {"区分": rec["kind"], "処理": rec["name"], "回数": 0, "合計ms": 0.0, "自身ms": 0.0})
+        item["回数"] += 1
+        item["合計ms"] += rec["ms"]
+        item["自身ms"] += rec["self_ms"]
+    summary = sorted(by_name.values(), key=lambda x: -x["自身ms"])
+    for item in summary:
+        item["自身比%"] = round(100.0 * item["自身ms"] / total_ms, 1) if total_ms > 0 else None
+        item["合計ms"] = round(item["合計ms"], 1)
+        item["自身ms"] = round(item["自身ms"], 1)
+    df_summary = pd.DataFrame(summary, columns=["区分", "処理", "回数", "合計ms", "自身ms", "自身比%"])
+    return df_calls, df_summary
+
+
+def perf_append_jsonl(log: Dict, path: str | None = None, meta: Dict | None = None) -> None:
+    """1回の実行分を1行のJSONとして追記する。"""
+    total_ms = perf_total_ms(log)
+    line = {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "total_ms": round(total_ms, 3),
+        "meta": meta or {},
+        "records": [
+            {
+                "seq": rec["seq"],
+                "depth": rec["depth"],
+                "kind": rec["kind"],
+                "name": rec["name"],
+                "ms": round(rec["ms"], 3),
+                "self_ms": round(rec["self_ms"], 3),
+                "rows": rec.get("rows"),
+            }
+            for rec in log["records"]
+            if rec.get("ms") is not None
+        ],
+    }
+    with open(path or PERF_LOG_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+# =========================
+# 基本設定（7車ベース）
+# =========================
+FIELD_SIZE = 7
+WINNER_RANKS = tuple(range(1, 8))
+PATTERN_AXES = (1,)
+AXIS1_TARGETS = (2, 3)
+INDIVIDUAL_AXIS1_TARGETS = (2, 3)
+AXIS2_TARGETS = ()
+AXIS3_TARGETS = ()
+
+# 2車複：個別引継ぎ用ペア。
+# 既存の1軸・2軸に加えて、評価3軸・評価4軸の下位絡みを検証するため、
+# 3-4/5/6/7 と 4-5/6/7 も累積対象に入れます。
+NISHAFUKU_PAIRS = [
+    # 軸1に必要なペア
+    (1, 2), (1, 3), (1, 4),
+    (1, 5), (1, 6), (1, 7),
+
+    # 軸2に必要なペア
+    (2, 3), (2, 4),
+    (2, 5), (2, 6), (2, 7),
+
+    # 評価3軸・4軸の追加検証ペア
+    (3, 4), (3, 5), (3, 6), (3, 7),
+    (4, 5), (4, 6), (4, 7),
+
+    # 正確性確認用：下位同士の残りペア
+    (5, 6), (5, 7), (6, 7),
+]
+NISHAFUKU_EXTRA_PAIRS = []
+
+# 小倉ミッドナイトA級7車・直近2年ベースのペア別平均配当（100円あたり）。
+# 必要に応じて画面上で上書きできます。
+PAIR_BASE_AVG_PAY_DEFAULTS = {
+    "1-2": 271,
+    "1-3": 436,
+    "1-4": 654,
+    "1-5": 1059,
+    "1-6": 1754,
+    "1-7": 1519,
+    "2-3": 881,
+    "2-4": 1333,
+    "2-5": 1869,
+    "2-6": 1657,
+    "2-7": 4092,
+}
+
+# 小倉ミッドナイトA級7車・直近2年ベースの固定想定的中率（%）。
+# 母数738R：1-2=167回、1-3=105回、1-4=78回、1-5=38回、1-6=26回、1-7=35回、
+# 2-3=46回、2-4=42回、2-5=27回、2-6=15回、2-7=22回。
+# 現在入力中の的中率とは独立した「想定ペア的%」として使用します。
+PAIR_BASE_HIT_RATE_DEFAULTS = {
+    "1-2": 22.6,
+    "1-3": 14.2,
+    "1-4": 10.6,
+    "1-5": 5.1,
+    "1-6": 3.5,
+    "1-7": 4.7,
+    "2-3": 6.2,
+    "2-4": 5.7,
+    "2-5": 3.7,
+    "2-6": 2.0,
+    "2-7": 3.0,
+}
+
+# 3連複 1-2-全の固定想定値。
+# 小倉ミッドナイトA級7車・直近2年の3連複全集計より、
+# 1-2-3=101回/平均378円、1-2-4=88回/537円、
+# 1-2-5=57回/1053円、1-2-6=44回/1136円、1-2-7=30回/1545円。
+TRIO_12_ALL_BASE_COUNTS = {
+    "1-2-3": 101,
+    "1-2-4": 88,
+    "1-2-5": 57,
+    "1-2-6": 44,
+    "1-2-7": 30,
+}
+TRIO_12_ALL_BASE_AVG_PAYS = {
+    "1-2-3": 378,
+    "1-2-4": 537,
+    "1-2-5": 1053,
+    "1-2-6": 1136,
+    "1-2-7": 1545,
+}
+
+# 小倉ミッドナイトA級7車・直近2年の3連複全集計。
+# 候補（評価3～7）の基準複勝率を作るために使用します。
+# 3-5-7は表に出ていないため0回として扱います。
+TRIO_FULL_BASE_COUNTS = {
+    "1-2-3": 101,
+    "1-2-4": 88,
+    "1-2-5": 57,
+    "1-3-5": 48,
+    "1-2-6": 44,
+    "1-3-4": 43,
+    "1-2-7": 30,
+    "1-4-5": 29,
+    "1-3-6": 24,
+    "2-4-5": 23,
+    "2-3-4": 21,
+    "2-3-5": 20,
+    "1-4-7": 19,
+    "1-5-6": 19,
+    "1-4-6": 19,
+    "3-4-5": 16,
+    "2-3-6": 13,
+    "2-4-6": 13,
+    "1-6-7": 11,
+    "2-5-6": 11,
+    "1-3-7": 11,
+    "2-3-7": 10,
+    "3-4-7": 9,
+    "3-4-6": 9,
+    "4-5-7": 8,
+    "2-4-7": 8,
+    "1-5-7": 7,
+    "2-5-7": 7,
+    "2-6-7": 6,
+    "3-5-6": 5,
+    "3-5-7": 0,
+    "4-6-7": 2,
+    "3-6-7": 2,
+    "4-5-6": 2,
+    "5-6-7": 1,
+}
+# 小倉ミッドナイトA級7車・直近2年の3連複平均配当（100円あたり）。
+TRIO_FULL_BASE_AVG_PAYS = {
+    "1-2-3": 378,
+    "1-2-4": 537,
+    "1-2-5": 1053,
+    "1-3-5": 985,
+    "1-2-6": 1136,
+    "1-3-4": 619,
+    "1-2-7": 1545,
+    "1-4-5": 2019,
+    "1-3-6": 2749,
+    "2-4-5": 2441,
+    "2-3-4": 2258,
+    "2-3-5": 1824,
+    "1-4-7": 3296,
+    "1-5-6": 3177,
+    "1-4-6": 1519,
+    "3-4-5": 2789,
+    "2-3-6": 4772,
+    "2-4-6": 2102,
+    "1-6-7": 6155,
+    "2-5-6": 4138,
+    "1-3-7": 2146,
+    "2-3-7": 5106,
+    "3-4-7": 5373,
+    "3-4-6": 2188,
+    "4-5-7": 6251,
+    "2-4-7": 3241,
+    "1-5-7": 3550,
+    "2-5-7": 3524,
+    "2-6-7": 5575,
+    "3-5-6": 1102,
+    "3-5-7": 0,
+    "4-6-7": 19765,
+    "3-6-7": 7830,
+    "4-5-6": 3250,
+    "5-6-7": 14080,
+}
+
+# 小倉2年分の3連複集計母数。
+# 2車複基準と揃えるため738Rを基準にします。
+TRIO_BASE_TOTAL_RACES = 738
+
+TRIO_BASE_PLACE_COUNTS = {r: 0 for r in range(1, FIELD_SIZE + 1)}
+for _trio_key, _cnt in TRIO_FULL_BASE_COUNTS.items():
+    for _r in [int(x) for x in _trio_key.split("-")]:
+        TRIO_BASE_PLACE_COUNTS[_r] += int(_cnt)
+
+# 小倉2年分3連複全集計から逆算した評価別基準複勝率。
+# 3連複1-2個別表では、1・2は軸として固定済みなので、評価3～7だけ補正に使います。
+TRIO_BASE_PLACE_RATES = {
+    r: round(100.0 * cnt / TRIO_BASE_TOTAL_RACES, 1)
+    for r, cnt in TRIO_BASE_PLACE_COUNTS.items()
+}
+
+
+def place_state(diff) -> str:
+    """評価別3着内率の基準差を状態表示する。"""
+    if diff is None:
+        return ""
+    try:
+        d = float(diff)
+    except Exception:
+        return ""
+    if d >= 5.0:
+        return "来すぎ"
+    if d <= -5.0:
+        return "基準未満"
+    return "中庸"
+
+TRIO_12_ALL_EXPECTED_AVG_PAY = round(
+    sum(TRIO_12_ALL_BASE_COUNTS[k] * TRIO_12_ALL_BASE_AVG_PAYS[k] for k in TRIO_12_ALL_BASE_COUNTS)
+    / max(1, sum(TRIO_12_ALL_BASE_COUNTS.values())),
+    1,
+)
+
+# 3連複は実データの回数から想定率を置く。
+# 以前の「2車複1-2×3」は理論近似だが、実測の3連複基準では高く出すぎるため使わない。
+TRIO_12_INDIVIDUAL_EXPECTED_HIT_RATES = {
+    k: round(100.0 * v / TRIO_BASE_TOTAL_RACES, 1)
+    for k, v in TRIO_12_ALL_BASE_COUNTS.items()
+}
+TRIO_12_ALL_EXPECTED_HIT_RATE = round(
+    100.0 * sum(TRIO_12_ALL_BASE_COUNTS.values()) / TRIO_BASE_TOTAL_RACES,
+    1,
+)
+TRIO_12_ALL_EXPECTED_ROI = round((TRIO_12_ALL_EXPECTED_HIT_RATE / 100.0) * TRIO_12_ALL_EXPECTED_AVG_PAY / 500.0 * 100.0, 1)
+TRIO_12_INDIVIDUAL_EXPECTED_ROIS = {
+    k: round(TRIO_12_INDIVIDUAL_EXPECTED_HIT_RATES[k] * TRIO_12_ALL_BASE_AVG_PAYS[k] / 100.0, 1)
+    for k in TRIO_12_ALL_BASE_COUNTS
+}
+
+TRIO_FULL_EXPECTED_HIT_RATES = {
+    k: round(100.0 * v / TRIO_BASE_TOTAL_RACES, 1)
+    for k, v in TRIO_FULL_BASE_COUNTS.items()
+}
+TRIO_FULL_EXPECTED_ROIS = {
+    k: round(TRIO_FULL_EXPECTED_HIT_RATES[k] * TRIO_FULL_BASE_AVG_PAYS.get(k, 0) / 100.0, 1)
+    for k in TRIO_FULL_BASE_COUNTS
+}
+
+
+# 実運用で3連複の軸候補にする2車複ペア。
+# 現実的に使うのは、想定ペア的中率が高く、軸として成立しやすい5候補まで。
+# これ以外の2車複本線が出ても、3連複軸には使わない。
+TRIO_AXIS_ALLOWED_KEYS = ["1-2", "1-3", "1-4", "2-3", "2-4"]
+
+
+def _trio_key_from_parts(a: int, b: int, c: int) -> str:
+    return "-".join(str(x) for x in sorted([int(a), int(b), int(c)]))
+
+
+def _build_trio_used_keys(axis_keys):
+    keys = []
+    seen = set()
+    for axis_key in axis_keys:
+        try:
+            a, b = [int(x) for x in axis_key.split("-")]
+        except Exception:
+            continue
+        for target in range(1, FIELD_SIZE + 1):
+            if target in (a, b):
+                continue
+            key = _trio_key_from_parts(a, b, target)
+            if key in TRIO_FULL_BASE_COUNTS and key not in seen:
+                keys.append(key)
+                seen.add(key)
+    return keys
+
+
+# 実運用で累積転記する3連複キー。
+# 小倉基準計算には全35通りを使うが、手入力・引継ぎは上記5軸から派生する目だけに絞る。
+TRIO_USED_KEYS = _build_trio_used_keys(TRIO_AXIS_ALLOWED_KEYS)
+
+
+RANK_SYMBOLS = {
+    1: "評価１",
+    2: "評価２",
+    3: "評価３",
+    4: "評価４",
+    5: "評価５",
+    6: "評価６",
+    7: "評価７",
+}
+
+
+def rank_symbol(r: int) -> str:
+    return RANK_SYMBOLS.get(r, f"評価{r}")
+
+
+PairKey = Tuple[int, int]  # (winner_eval, second_eval)
+
+
+def parse_rankline(s: str, expected_len: int) -> List[str]:
+    if not s:
+        return []
+    s = s.replace("-", "").replace(" ", "").replace("/", "").replace(",", "")
+    if not s.isdigit() or len(s) != expected_len:
+        return []
+    if any(ch not in "1234567" for ch in s):
+        return []
+    if len(set(s)) != len(s):
+        return []
+    return list(s)
+
+
+def parse_finish(s: str) -> List[str]:
+    if not s:
+        return []
+    s = s.replace("-", "").replace(" ", "").replace("/", "").replace(",", "")
+    s = "".join(ch for ch in s if ch in "1234567")
+    out: List[str] = []
+    for ch in s:
+        if ch not in out:
+            out.append(ch)
+        if len(out) == 3:
+            break
+    return out
+
+
+DAILY_FIELD_SIZES = (7, 6, 5)
+
+
+def build_race_row(rid, field_n: int, vline: str, fin: str, pay_2f: int, pay_2t: int = 0, pay_3f: int = 0) -> tuple[Dict | None, List[str]]:
+    """
+    日次入力1行を byrace_rows の1件にする。フォーム入力・一括取り込み共通。
+
+    戻り値は（行 or None, 確認メッセージ）。未入力行は（None, []）。
+    V評価の桁数不足は取り込まない。着順がV評価にない車番は警告だけ出して取り込む。
+    """
+    vline = str(vline or "")
+    fin = str(fin or "")
+    field_n = int(field_n)
+    pay_2f = int(pay_2f or 0)
+    vorder = parse_rankline(vline, field_n)
+    finish = parse_finish(fin)
+
+    if not any([vline.strip(), fin.strip(), pay_2f > 0]):
+        return None, []
+    if not vorder:
+        return None, [f"R{rid}: 頭数{field_n}なので、V評価は{field_n}桁で入力してください。"]
+    if len(str(rid)) > RACE_ID_MAX_LEN:
+        return None, [f"R{rid}: Rは{RACE_ID_MAX_LEN}文字までで入力してください。"]
+
+    issues = []
+    vset = set(vorder)
+    invalid_finish = [x for x in finish if x not in vset]
+    if invalid_finish:
+        issues.append(
+            f"R{rid}: 着順 {''.join(invalid_finish)} がV評価（出走車）に含まれていません。"
+            " 欠車/入力ミスの可能性があります。"
+        )
+
+    return {
+        "race": rid,
+        "field_n": field_n,
+        "vorder": vorder,
+        "finish": finish,
+        "pay_2t": int(pay_2t or 0),
+        "pay_2f": pay_2f,
+        "pay_3f": int(pay_3f or 0),
+    }, issues
+
+
+def _split_bulk_line(line: str) -> List[str]:
+    """タブ区切り・カンマ区切り（CSV）・空白区切りのどれでも1行を列に分ける。"""
+    if "\t" in line:
+        return [x.strip() for x in line.split("\t")]
+    if "," in line:
+        return [x.strip() for x in next(csv.reader([line]))]
+    return line.split()
+
+
+@perf_timed
+def parse_bulk_races(text: str) -> tuple[List[Dict], List[Dict]]:
+    """
+    貼り付けテキスト / CSV をまとめて byrace_rows にする。
+
+    1行1レース：R, 頭数, V評価, 着順, 2車複払戻（払戻は省略可）。
+    先頭が数字で始まらない行（見出し行）と空行は読み飛ばす。
+    戻り値は（byrace_rows, 確認一覧）。確認一覧は1件ずつ {"行", "R", "内容"}。
+    """
+    rows: List[Dict] = []
+    issues: List[Dict] = []
+    seen_rids = set()
+
+    for line_no, raw in enumerate(str(text or "").splitlines(), start=1):
+        line = raw.strip().lstrip("\ufeff")
+        if not line:
+            continue
+        cols = _split_bulk_line(line)
+        if not cols or not cols[0][:1].isdigit():
+            continue
+        rid = cols[0]
+
+        if len(cols) < 4:
+            issues.append({"行": line_no, "R": rid, "内容": "列が足りません（R, 頭数, V評価, 着順, 2車複払戻）。"})
+            continue
+        try:
+            field_n = int(cols[1])
+        except Exception:
+            field_n = None
+        if field_n not in DAILY_FIELD_SIZES:
+            issues.append({"行": line_no, "R": rid, "内容": f"頭数「{cols[1]}」は 7 / 6 / 5 のどれかで入力してください。"})
+            continue
+        pay_text = cols[4] if len(cols) >= 5 and cols[4] != "" else "0"
+        try:
+            pay_2f = int(float(pay_text.replace("円", "").replace(",", "")))
+        except Exception:
+            pay_2f = -1
+        if pay_2f < 0:
+            issues.append({"行": line_no, "R": rid, "内容": f"2車複払戻「{pay_text}」が数値ではありません。"})
+            continue
+        if rid in seen_rids:
+            issues.append({"行": line_no, "R": rid, "内容": f"R{rid}が重複しています。後の行は取り込みません。"})
+            continue
+
+        row, row_issues = build_race_row(rid, field_n, cols[2], cols[3], pay_2f)
+        for msg in row_issues:
+            issues.append({"行": line_no, "R": rid, "内容": msg})
+        if row is not None:
+            rows.append(row)
+            seen_rids.add(rid)
+
+    return rows, issues
+
+
+# 日次入力グリッド（st.data_editor）の列。
+DAILY_GRID_COLUMNS = ["R", "頭数", "V評価", "着順", "2車複"]
+
+
+def new_daily_grid_frame(n_rows: int = 12) -> pd.DataFrame:
+    """日次入力グリッドの初期表。Rだけ 1..n_rows を入れておく。"""
+    return pd.DataFrame({
+        "R": [str(i) for i in range(1, n_rows + 1)],
+        "頭数": [DAILY_FIELD_SIZES[0]] * n_rows,
+        "V評価": [""] * n_rows,
+        "着順": [""] * n_rows,
+        "2車複": [0] * n_rows,
+    })
+
+
+def _grid_cell_text(v) -> str:
+    try:
+        if v is None or pd.isna(v):
+            return ""
+    except Exception:
+        pass
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    return str(v).strip()
+
+
+@perf_timed
+def build_byrace_rows_from_frame(df: pd.DataFrame) -> tuple[List[Dict], List[Dict]]:
+    """
+    日次入力グリッドの表を byrace_rows にする。
+
+    行ごとに build_race_row を通すので、フォーム入力・一括取り込みと同じ判定になる。
+    Rが空欄の行は表の行番号をRとして使う。同じRは一括取り込みと同じく先の行だけ取り込む
+    （履歴ストアは日付＋Rで1件なので、後の行は保存時に黙って落ちる）。戻り値は（byrace_rows, 確認一覧）。
+    """
+    rows: List[Dict] = []
+    issues: List[Dict] = []
+    seen_rids = set()
+    if df is None or df.empty:
+        return rows, issues
+
+    for line_no, rec in enumerate(df.to_dict("records"), start=1):
+        rid = _grid_cell_text(rec.get("R")) or str(line_no)
+        field_text = _grid_cell_text(rec.get("頭数")) or str(DAILY_FIELD_SIZES[0])
+        try:
+            field_n = int(float(field_text))
+        except Exception:
+            field_n = None
+        if field_n not in DAILY_FIELD_SIZES:
+            issues.append({"行": line_no, "R": rid, "内容": f"頭数「{field_text}」は 7 / 6 / 5 のどれかで入力してください。"})
+            continue
+        try:
+            pay_2f = int(float(_grid_cell_text(rec.get("2車複")) or 0))
+        except Exception:
+            pay_2f = 0
+        if rid in seen_rids:
+            issues.append({"行": line_no, "R": rid, "内容": f"R{rid}が重複しています。後の行は取り込みません。"})
+            continue
+
+        row, row_issues = build_race_row(
+            rid,
+            field_n,
+            _grid_cell_text(rec.get("V評価")),
+            _grid_cell_text(rec.get("着順")),
+            max(0, pay_2f),
+        )
+        issues.extend({"行": line_no, "R": rid, "内容": msg} for msg in row_issues)
+        if row is not None:
+            rows.append(row)
+            seen_rids.add(rid)
+
+    return rows, issues
+
+
+# =========================
+# 結果キャッシュ（内容ハッシュ・LRU）
+# =========================
+# 入力の集計が同じなら、表の組み立てをやり直さない。キーは引数の内容ハッシュ。
+# モジュール単位（プロセス全体）で持つので、Streamlitの別セッション・再実行の間でも共有される。
+# 返すのは毎回コピーで、呼び出し側が結果を書き換えてもキャッシュは汚れない。
+CONTENT_CACHE_MAXSIZE = 64
+
+_CONTENT_CACHES: Dict[str, Dict] = {}
+_CONTENT_CACHE_LOCK = threading.Lock()
+
+
+def content_hash(obj) -> str:
+    """
+    引数の内容ハッシュ（pickle のバイト列の BLAKE2b）。
+
+    pickle は内容から一意に決まるので、違う内容が同じキーになることはない。
+    同じ内容でも作り方（dictの挿入順など）が違えば別キーになり、その場合は計算し直すだけ。
+    pickle できない引数（lambda を持つ defaultdict など）は TypeError。
+    """
+    try:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        raise TypeError(f"内容ハッシュにできない引数: {e}") from e
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _copy_cached_result(value):
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, tuple):
+        return tuple(_copy_cached_result(v) for v in value)
+    if isinstance(value, (list, dict, np.ndarray)):
+        return copy.deepcopy(value)
+    return value
+
+
+def content_cached(
+    fn: Callable | None = None,
+    *,
+    maxsize: int = CONTENT_CACHE_MAXSIZE,
+    key: Callable | None = None,
+) -> Callable:
+    """
+    引数の内容ハッシュをキーにした LRU キャッシュ（純粋関数専用）。
+
+    key を渡すと、引数そのものではなく key(*args, **kwargs) の戻り値をハッシュする。
+    大きな引数（累積・履歴の行リスト）をそのまま pickle すると計算と同じくらい重いので、
+    その引数を一意に決める小さな版（ストアの版など）に置き換えるために使う。
+    ハッシュにできない引数が来たときは、キャッシュせずにそのまま計算する
+    （content_cache_info の「素通り」に数え、最後の理由を残す）。
+    元の関数は __wrapped__ で呼べる（ベンチマーク・検証用）。
+    """
+    def _decorate(func: Callable) -> Callable:
+        name = f"{func.__module__}.{func.__qualname__}"
+        with _CONTENT_CACHE_LOCK:
+            cache = _CONTENT_CACHES.setdefault(
+                name,
+                {"entries": OrderedDict(), "maxsize": int(maxsize), "hits": 0, "misses": 0, "bypassed": 0, "reason": ""},
+            )
+
+        @wraps(func)
+        def _cached(*args, **kwargs):
+            try:
+                digest = content_hash(key(*args, **kwargs) if key is not None else (args, sorted(kwargs.items())))
+            except TypeError as e:
+                # キーを作れない呼び出しは計算だけする。黙って素通りしないよう回数と理由を残す。
+                with _CONTENT_CACHE_LOCK:
+                    cache["bypassed"] += 1
+                    cache["reason"] = str(e)
+                return func(*args, **kwargs)
+            with _CONTENT_CACHE_LOCK:
+                entries = cache["entries"]
+                if digest in entries:
+                    entries.move_to_end(digest)
+                    cache["hits"] += 1
+                    value = entries[digest]
+                    return _copy_cached_result(value)
+            value = func(*args, **kwargs)
+            with _CONTENT_CACHE_LOCK:
+                cache["misses"] += 1
+                entries[digest] = value
+                entries.move_to_end(digest)
+                while len(entries) > cache["maxsize"]:
+                    entries.popitem(last=False)
+            return _copy_cached_result(value)
+
+        return _cached
+
+    return _decorate(fn) if fn is not None else _decorate
+
+
+def content_cache_info() -> pd.DataFrame:
+    """関数ごとの命中・計算・素通り（キーを作れずキャッシュしなかった）回数と保持件数。"""
+    with _CONTENT_CACHE_LOCK:
+        rows = [
+            {
+                "関数": name.rsplit(".", 1)[-1],
+                "命中": c["hits"],
+                "計算": c["misses"],
+                "素通り": c["bypassed"],
+                "保持": len(c["entries"]),
+                "上限": c["maxsize"],
+                "素通りの理由": c["reason"],
+            }
+            for name, c in _CONTENT_CACHES.items()
+        ]
+    return pd.DataFrame(rows, columns=["関数", "命中", "計算", "素通り", "保持", "上限", "素通りの理由"])
+
+
+def content_cache_clear() -> None:
+    with _CONTENT_CACHE_LOCK:
+        for c in _CONTENT_CACHES.values():
+            c["entries"].clear()
+            c["hits"] = 0
+            c["misses"] = 0
+
+
+@perf_timed
+@content_cached
+def build_conditional_tables(pair_counts: Dict[PairKey, int]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    cols = list(range(1, FIELD_SIZE + 1))
+    count_rows = []
+    pct_rows = []
+
+    for wr in WINNER_RANKS:
+        total = 0
+        for rr in cols:
+            if rr == wr:
+                continue
+            total += int(pair_counts.get((wr, rr), 0))
+
+        row_c = {"1着の評価": wr, "N": total}
+        for rr in cols:
+            row_c[str(rr)] = None if rr == wr else int(pair_counts.get((wr, rr), 0))
+        count_rows.append(row_c)
+
+        row_p = {"1着の評価": wr, "N": total}
+        for rr in cols:
+            if rr == wr:
+                row_p[str(rr)] = None
+            else:
+                v = int(pair_counts.get((wr, rr), 0))
+                row_p[str(rr)] = round(100.0 * v / total, 1) if total > 0 else 0.0
+        pct_rows.append(row_p)
+
+    return pd.DataFrame(count_rows), pd.DataFrame(pct_rows)
+
+
+def rate(x: int, n: int):
+    return round(100.0 * x / n, 1) if n > 0 else None
+
+
+def fmt_1decimal_safe(x):
+    """Streamlit/Pandas Styler用。None/NaN/文字列混在でも小数1桁表示で落とさない。"""
+    try:
+        if x is None or pd.isna(x):
+            return ""
+    except Exception:
+        if x is None:
+            return ""
+    try:
+        return f"{float(x):.1f}"
+    except Exception:
+        if str(x).strip() in ("None", "nan", "NaN"):
+            return ""
+        return str(x)
+
+
+def payout_zone_key(pay: int) -> str | None:
+    """2車複払戻（100円あたり）を的中ゾーンへ分類する。"""
+    try:
+        pay = int(pay)
+    except Exception:
+        return None
+    if pay <= 0:
+        return None
+    odds = pay / 100.0
+    if odds <= 3.0:
+        return "Z3"
+    if odds <= 6.0:
+        return "Z6"
+    if odds <= 10.0:
+        return "Z10"
+    if odds <= 20.0:
+        return "Z20"
+    return "Z20P"
+
+
+def zone_text(count: int, total_h: int) -> str:
+    count = int(count or 0)
+    total_h = int(total_h or 0)
+    if total_h <= 0:
+        return "0/0%"
+    return f"{count}/{round(100.0 * count / total_h, 1)}%"
+
+
+def zone_row(pair: str, rec: Dict[str, int]) -> Dict:
+    H = int(rec.get("H", 0))
+    z3 = int(rec.get("Z3", 0))
+    z6 = int(rec.get("Z6", 0))
+    z10 = int(rec.get("Z10", 0))
+    z20 = int(rec.get("Z20", 0))
+    z20p = int(rec.get("Z20P", 0))
+    zsum = z3 + z6 + z10 + z20 + z20p
+    return {
+        "ペア": pair,
+        "的中H": H,
+        "〜3倍": zone_text(z3, H),
+        "3.1〜6倍": zone_text(z6, H),
+        "6.1〜10倍": zone_text(z10, H),
+        "10.1〜20倍": zone_text(z20, H),
+        "20.1倍〜": zone_text(z20p, H),
+        "ゾーン確認": "OK" if (H == 0 or zsum == H) else f"不一致({zsum}/{H})",
+    }
+
+
+def zone_total_row(recs: List[Dict[str, int]]) -> Dict:
+    """個別2車複 的中ゾーン分布の総合行。全ペアの的中Hを合算して比率を出す。"""
+    total = new_payout_rec()
+    for rec in recs:
+        for k in ("H", "Z3", "Z6", "Z10", "Z20", "Z20P"):
+            total[k] = int(total.get(k, 0)) + int(rec.get(k, 0))
+    H = int(total.get("H", 0))
+    z3 = int(total.get("Z3", 0))
+    z6 = int(total.get("Z6", 0))
+    z10 = int(total.get("Z10", 0))
+    z20 = int(total.get("Z20", 0))
+    z20p = int(total.get("Z20P", 0))
+    zsum = z3 + z6 + z10 + z20 + z20p
+    return {
+        "ペア": "総合",
+        "的中H": H,
+        "〜3倍": zone_text(z3, H),
+        "3.1〜6倍": zone_text(z6, H),
+        "6.1〜10倍": zone_text(z10, H),
+        "10.1〜20倍": zone_text(z20, H),
+        "20.1倍〜": zone_text(z20p, H),
+        "ゾーン確認": "OK" if (H == 0 or zsum == H) else f"不一致({zsum}/{H})",
+    }
+
+
+# =========================
+# 個別2車複：ゾーン別 仮想回収寄与率
+# =========================
+# 旧累積は実払戻明細を持たないため、各ゾーンは中央値で仮想払戻を計算する。
+# 中央値は今日入力分の実払戻から作り、サンプルがないゾーンだけ固定中央値へ戻す。
+#
+# 重要：現状の入力データには「外れた時に、そのペアがどのオッズ帯だったか」が存在しない。
+# そのため、ここで出せるのは厳密な「ゾーン別回収率」ではなく、
+#   ・そのペアを全対象Rで1点買いした場合、
+#   ・各的中ゾーンが回収率に何％分貢献したか
+# を示す「仮想回収寄与率」。
+# 厳密なゾーン別回収率を出すには、非的中分も含めたゾーン対象Nが必要。
+# → 2車複オッズ記録（odds_2f）があるレースは build_exact_zone_roi_table で厳密に出せる。
+ZONE_DEFAULT_ODDS = {
+    "Z3": 2.5,
+    "Z6": 4.5,
+    "Z10": 8.0,
+    "Z20": 15.0,
+    "Z20P": 25.0,
+}
+ZONE_LABELS = {
+    "Z3": "〜3倍",
+    "Z6": "3.1〜6倍",
+    "Z10": "6.1〜10倍",
+    "Z20": "10.1〜20倍",
+    "Z20P": "20.1倍〜",
+}
+ZONE_KEYS_ORDER = ("Z3", "Z6", "Z10", "Z20", "Z20P")
+
+
+# ゾーン別払戻スケッチ。
+# 2車複払戻（100円あたり）を10円刻みの固定ビンで数えるヒストグラム。
+# 実際の払戻は10円単位なので、中央値・分位点は全払戻明細から出した値と一致する。
+# ビン数は払戻の種類数で頭打ちになるため、何シーズン貯めてもメモリは増えない。
+# 日ごとのスケッチを足し合わせるだけで累積になる（マージ可能）。
+PAYOUT_SKETCH_BIN_YEN = 10
+
+
+def new_payout_sketch() -> Dict[int, int]:
+    """{ビン代表払戻(円): 回数} の空スケッチ。"""
+    return {}
+
+
+def payout_sketch_add(sketch: Dict[int, int], pay: int, count: int = 1) -> None:
+    """払戻1件（円）をスケッチへ入れる。count<0 で取り消し。"""
+    try:
+        pay = int(pay)
+    except Exception:
+        return
+    if pay <= 0:
+        return
+    key = int(round(pay / PAYOUT_SKETCH_BIN_YEN)) * PAYOUT_SKETCH_BIN_YEN
+    n = int(sketch.get(key, 0)) + int(count)
+    if n > 0:
+        sketch[key] = n
+    else:
+        sketch.pop(key, None)
+
+
+def merge_payout_sketches(dst: Dict[int, int], src: Dict[int, int]) -> Dict[int, int]:
+    """src を dst へ足し込む。dst を返す。"""
+    for key, n in (src or {}).items():
+        dst[int(key)] = int(dst.get(int(key), 0)) + int(n)
+    return dst
+
+
+def payout_sketch_count(sketch: Dict[int, int]) -> int:
+    return int(sum(int(n) for n in (sketch or {}).values()))
+
+
+def payout_sketch_quantile(sketch: Dict[int, int], q: float) -> float | None:
+    """
+    スケッチから分位点（倍率）を出す。pandas の quantile（線形補間）と同じ定義。
+    q=0.5 なら中央値。件数0ならNone。
+    """
+    items = sorted((int(k), int(n)) for k, n in (sketch or {}).items() if int(n) > 0)
+    total = sum(n for _, n in items)
+    if total <= 0:
+        return None
+    pos = float(q) * (total - 1)
+    lo_idx = int(pos)
+    hi_idx = min(lo_idx + 1, total - 1)
+    frac = pos - lo_idx
+
+    lo_val = hi_val = None
+    seen = 0
+    for pay, n in items:
+        if lo_val is None and lo_idx < seen + n:
+            lo_val = pay
+        if hi_idx < seen + n:
+            hi_val = pay
+            break
+        seen += n
+    lo_odds = lo_val / 100.0
+    hi_odds = hi_val / 100.0
+    if frac == 0.0 or lo_val == hi_val:
+        return lo_odds
+    return lo_odds + (hi_odds - lo_odds) * frac
+
+
+def payout_sketch_to_json(sketch: Dict[int, int]) -> str:
+    return json.dumps({str(k): int(v) for k, v in sorted((sketch or {}).items())}, separators=(",", ":"))
+
+
+def payout_sketch_from_json(text: str) -> Dict[int, int]:
+    try:
+        raw = json.loads(text or "{}")
+    except Exception:
+        return new_payout_sketch()
+    return {int(k): int(v) for k, v in raw.items() if int(v) > 0}
+
+
+def new_zone_sketches() -> Dict[str, Dict[int, int]]:
+    return {k: new_payout_sketch() for k in ZONE_KEYS_ORDER}
+
+
+def _collect_zone_sketches(byrace_rows: List[Dict], pairs: List[Tuple[int, int]]) -> Dict[str, Dict[int, int]]:
+    """指定ペアが的中したレースの2車複実払戻をゾーン別スケッチに集める。"""
+    pair_set = {tuple(sorted((int(a), int(b)))) for a, b in pairs}
+    sketches = new_zone_sketches()
+
+    for row in byrace_rows or []:
+        norm = normalize_race(row)
+        if norm is None or norm["field_n"] <= 0 or norm["pay_2f"] <= 0:
+            continue
+        finish_ranks = norm["finish_ranks"]
+        if len(finish_ranks) < 2 or finish_ranks[0] is None or finish_ranks[1] is None:
+            continue
+
+        pkey = tuple(sorted((int(finish_ranks[0]), int(finish_ranks[1]))))
+        if pkey not in pair_set:
+            continue
+
+        pay_2f = int(norm["pay_2f"])
+        zkey = payout_zone_key(pay_2f)
+        if zkey in sketches:
+            payout_sketch_add(sketches[zkey], pay_2f)
+
+    return sketches
+
+
+@perf_timed
+def build_zone_median_odds(
+    byrace_rows: List[Dict],
+    pairs: List[Tuple[int, int]],
+    carryover: Dict[str, Dict[str, float]] | None = None,
+    zone_sketches: Dict[str, Dict[int, int]] | None = None,
+    history_sketches: Dict[str, Dict[int, int]] | None = None,
+) -> tuple[Dict[str, float], Dict[str, int], pd.DataFrame]:
+    """
+    ゾーン別の使用中央値オッズを作る。
+
+    履歴ストアのゾーン別スケッチ（history_sketches）と今日入力分のスケッチを足し合わせ、
+    そこから累積中央値を厳密に出す。
+
+    優先順位：
+      1) 履歴+今日の厳密中央値（手入力の引継ぎ中央値もあればN加重でつなぐ）
+      2) 手入力の引継ぎ中央値のみ
+      3) 固定中央値
+
+    手入力の引継ぎ（carryover）は履歴ストア導入前の分だけの近似。
+    zone_sketches を渡した場合（aggregate_byrace_rows の "zone_sketches"）は、
+    byrace_rows を再走査せずにそれを今日入力分として使う。
+    """
+    carryover = carryover or {}
+    history_sketches = history_sketches or {}
+    if zone_sketches is None:
+        zone_sketches = _collect_zone_sketches(byrace_rows, pairs)
+
+    zone_odds: Dict[str, float] = {}
+    zone_counts: Dict[str, int] = {}
+    rows = []
+    for zkey in ZONE_KEYS_ORDER:
+        today_sketch = zone_sketches.get(zkey, {}) or {}
+        hist_sketch = history_sketches.get(zkey, {}) or {}
+        today_n = payout_sketch_count(today_sketch)
+        today_med = payout_sketch_quantile(today_sketch, 0.5)
+        hist_n = payout_sketch_count(hist_sketch)
+
+        merged = merge_payout_sketches(merge_payout_sketches(new_payout_sketch(), hist_sketch), today_sketch)
+        merged_n = hist_n + today_n
+        merged_med = payout_sketch_quantile(merged, 0.5)
+
+        carry = carryover.get(zkey, {}) or {}
+        try:
+            carry_n = int(carry.get("N", 0) or 0)
+        except Exception:
+            carry_n = 0
+        try:
+            carry_med = float(carry.get("median", 0.0) or 0.0)
+        except Exception:
+            carry_med = 0.0
+        if carry_med <= 0:
+            carry_n = 0
+            carry_med = 0.0
+
+        if carry_n > 0 and merged_n > 0 and merged_med is not None:
+            med = (carry_n * carry_med + merged_n * merged_med) / (carry_n + merged_n)
+            use_n = carry_n + merged_n
+            source = "引継ぎ+履歴・今日（N加重）"
+        elif merged_n > 0 and merged_med is not None:
+            med = merged_med
+            use_n = merged_n
+            source = "履歴+今日（厳密）" if hist_n > 0 else "今日入力中央値"
+        elif carry_n > 0:
+            med = carry_med
+            use_n = carry_n
+            source = "引継ぎ中央値"
+        else:
+            med = float(ZONE_DEFAULT_ODDS[zkey])
+            use_n = 0
+            source = "固定中央値"
+
+        q25 = payout_sketch_quantile(merged, 0.25)
+        q75 = payout_sketch_quantile(merged, 0.75)
+
+        zone_counts[zkey] = int(use_n)
+        zone_odds[zkey] = round(float(med), 2)
+        rows.append({
+            "オッズ帯": ZONE_LABELS[zkey],
+            "引継ぎN": carry_n,
+            "引継ぎ中央値": round(carry_med, 2) if carry_n > 0 else None,
+            "履歴N": hist_n,
+            "今日入力N": today_n,
+            "今日中央値": round(today_med, 2) if today_med is not None else None,
+            "使用N": int(use_n),
+            "使用中央値": round(float(med), 2),
+            "25%点": round(q25, 2) if q25 is not None else None,
+            "75%点": round(q75, 2) if q75 is not None else None,
+            "採用": source,
+        })
+
+    return zone_odds, zone_counts, pd.DataFrame(rows)
+
+
+# 旧名互換：内部呼び出しが残っても動くようにする。
+def build_daily_zone_median_odds(byrace_rows: List[Dict], pairs: List[Tuple[int, int]]) -> tuple[Dict[str, float], Dict[str, int], pd.DataFrame]:
+    return build_zone_median_odds(byrace_rows, pairs, None)
+
+def _virtual_zone_contrib_values(rec: Dict[str, int], zone_key: str, zone_odds: Dict[str, float] | None = None) -> tuple[int, float | None]:
+    """
+    ゾーン別の仮想回収寄与率を計算する。
+
+    寄与率 = そのゾーン的中N × ゾーン中央値 × 100円 ÷ そのペアを全対象Rで1点買いした投資額
+    """
+    N = int(rec.get("N", 0) or 0)
+    H = int(rec.get(zone_key, 0) or 0)
+    odds_map = zone_odds or ZONE_DEFAULT_ODDS
+    odds = float(odds_map.get(zone_key, ZONE_DEFAULT_ODDS.get(zone_key, 0.0)))
+    virtual_sum = H * odds * 100.0
+    invest = N * 100.0
+    contrib = round(100.0 * virtual_sum / invest, 1) if invest > 0 else None
+    return H, contrib
+
+
+def _virtual_zone_contrib_cell(rec: Dict[str, int], zone_key: str, zone_odds: Dict[str, float] | None = None) -> str:
+    """元の的中ゾーン分布と対応するセル表示。例：4本 / +40.0%"""
+    H, contrib = _virtual_zone_contrib_values(rec, zone_key, zone_odds)
+    if contrib is None:
+        return "0本 / —"
+    return f"{H}本 / +{contrib:.1f}%"
+
+
+def _virtual_total_roi(rec: Dict[str, int], zone_odds: Dict[str, float] | None = None) -> float | None:
+    """中央値置換で、そのペアを全対象Rで1点買いした場合の仮想合計回収率。"""
+    N = int(rec.get("N", 0) or 0)
+    if N <= 0:
+        return None
+    virtual_sum = 0.0
+    for zone_key in ZONE_KEYS_ORDER:
+        H = int(rec.get(zone_key, 0) or 0)
+        odds_map = zone_odds or ZONE_DEFAULT_ODDS
+        odds = float(odds_map.get(zone_key, ZONE_DEFAULT_ODDS.get(zone_key, 0.0)))
+        virtual_sum += H * odds * 100.0
+    return round(100.0 * virtual_sum / (N * 100.0), 1)
+
+
+def _virtual_roi_judgement(roi: float | None) -> str:
+    if roi is None:
+        return ""
+    if roi >= 100.0:
+        return "100%超"
+    if roi >= 90.0:
+        return "90%超"
+    return ""
+
+
+@perf_timed
+@content_cached
+def build_virtual_zone_roi_table(payout_total: Dict[str, Dict[str, int]], pairs: List[Tuple[int, int]], zone_odds: Dict[str, float] | None = None) -> pd.DataFrame:
+    """
+    個別2車複ゾーン別 仮想回収寄与率表。
+
+    元表と同じく「ペアを行、ゾーンを列」にする。
+    各ゾーンセルは厳密なゾーン別回収率ではなく、そのゾーンの回収寄与率。
+    右側に、中央値置換で見たペア別の仮想合計回収率を出す。
+    """
+    rows = []
+
+    for a, b in pairs:
+        label = nishafuku_label(a, b)
+        if label not in payout_total:
+            continue
+        pair_key = f"{a}-{b}"
+        rec = payout_total[label]
+        total_roi = _virtual_total_roi(rec, zone_odds)
+
+        row = {
+            "ペア": pair_key,
+            "対象N": int(rec.get("N", 0) or 0),
+            "仮想合計回収率%": total_roi,
+            "判定": _virtual_roi_judgement(total_roi),
+        }
+        for zone_key in ZONE_KEYS_ORDER:
+            row[ZONE_LABELS[zone_key]] = _virtual_zone_contrib_cell(rec, zone_key, zone_odds)
+        rows.append(row)
+
+    # 総合行は入れない。
+    # 全ペアのNを合算すると「全ペアを全R買った場合」の寄与率になり、
+    # 元表との対応確認や買い目評価として誤解を生むため。
+    return pd.DataFrame(rows)
+
+
+@content_cached
+def build_conditional_tables_13(pair_counts: Dict[PairKey, int]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    cols = list(range(1, FIELD_SIZE + 1))
+    count_rows = []
+    pct_rows = []
+
+    for wr in WINNER_RANKS:
+        total = 0
+        for rr in cols:
+            if rr == wr:
+                continue
+            total += int(pair_counts.get((wr, rr), 0))
+
+        row_c = {"1着の評価": wr, "N": total}
+        row_p = {"1着の評価": wr, "N": total}
+        for rr in cols:
+            col = f"3着={rr}"
+            if rr == wr:
+                row_c[col] = None
+                row_p[col] = None
+            else:
+                v = int(pair_counts.get((wr, rr), 0))
+                row_c[col] = v
+                row_p[col] = round(100.0 * v / total, 1) if total > 0 else 0.0
+        count_rows.append(row_c)
+        pct_rows.append(row_p)
+
+    return pd.DataFrame(count_rows), pd.DataFrame(pct_rows)
+
+
+def pair13_combo_key(a: int, b: int) -> str:
+    """1着評価と3着評価の組み合わせを順不同キーにする。例：1→3 と 3→1 はどちらも 1-3。"""
+    a, b = sorted((int(a), int(b)))
+    if a == b:
+        return ""
+    return f"{a}-{b}"
+
+
+def _pair13_combo_count(pair13_counts: Dict[PairKey, int], a: int, b: int) -> int:
+    """1着評価と3着評価の順不同ペア回数。前日入力が順不同、日次が方向付きでも合算できる形。"""
+    a, b = int(a), int(b)
+    if a == b:
+        return 0
+    return int(pair13_counts.get((a, b), 0)) + int(pair13_counts.get((b, a), 0))
+
+
+@perf_timed
+@content_cached
+def build_pair13_combo_tables(pair13_counts: Dict[PairKey, int]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    1着と3着の評価組み合わせを、1→2着評価分布と同じ形式で出す。
+    行＝組み合わせの片方の評価、列＝相手評価。
+    例：行1・列3は、1着評価1/3着評価3 と 1着評価3/3着評価1 の合算。
+    Nは、その評価が1着=3着ペアの片方として出た総数。
+    """
+    cols = list(range(1, FIELD_SIZE + 1))
+    count_rows = []
+    pct_rows = []
+
+    for a in cols:
+        total = sum(_pair13_combo_count(pair13_counts, a, b) for b in cols if b != a)
+        row_c = {"評価": a, "N": total}
+        row_p = {"評価": a, "N": total}
+        for b in cols:
+            col = str(b)
+            if b == a:
+                row_c[col] = None
+                row_p[col] = None
+            else:
+                cnt = _pair13_combo_count(pair13_counts, a, b)
+                row_c[col] = cnt
+                row_p[col] = round(100.0 * cnt / total, 1) if total > 0 else 0.0
+        count_rows.append(row_c)
+        pct_rows.append(row_p)
+
+    return pd.DataFrame(count_rows), pd.DataFrame(pct_rows)
+
+
+def _pair23_combo_count(pair23_counts: Dict[PairKey, int], a: int, b: int) -> int:
+    """2着評価と3着評価の順不同ペア回数。例：2着1・3着3 と 2着3・3着1 を合算。"""
+    a, b = int(a), int(b)
+    if a == b:
+        return 0
+    return int(pair23_counts.get((a, b), 0)) + int(pair23_counts.get((b, a), 0))
+
+
+@perf_timed
+@content_cached
+def build_pair23_combo_tables(pair23_counts: Dict[PairKey, int]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    2着と3着の評価組み合わせを、1→2着評価分布と同じ形式で出す。
+    行＝組み合わせの片方の評価、列＝相手評価。
+    例：行1・列3は、2着評価1/3着評価3 と 2着評価3/3着評価1 の合算。
+    Nは、その評価が2着=3着ペアの片方として出た総数。
+    """
+    cols = list(range(1, FIELD_SIZE + 1))
+    count_rows = []
+    pct_rows = []
+
+    for a in cols:
+        total = sum(_pair23_combo_count(pair23_counts, a, b) for b in cols if b != a)
+        row_c = {"評価": a, "N": total}
+        row_p = {"評価": a, "N": total}
+        for b in cols:
+            col = str(b)
+            if b == a:
+                row_c[col] = None
+                row_p[col] = None
+            else:
+                cnt = _pair23_combo_count(pair23_counts, a, b)
+                row_c[col] = cnt
+                row_p[col] = round(100.0 * cnt / total, 1) if total > 0 else 0.0
+        count_rows.append(row_c)
+        pct_rows.append(row_p)
+
+    return pd.DataFrame(count_rows), pd.DataFrame(pct_rows)
+
+
+def new_payout_rec() -> Dict[str, int]:
+    # Z3   : 的中払戻 〜3.0倍（〜300円）
+    # Z6   : 的中払戻 3.1〜6.0倍（310〜600円）
+    # Z10  : 的中払戻 6.1〜10.0倍（610〜1000円）
+    # Z20  : 的中払戻 10.1〜20.0倍（1010〜2000円）
+    # Z20P : 的中払戻 20.1倍〜（2010円〜）
+    return {
+        "N": 0, "KSUM": 0, "H": 0, "SUM": 0,
+        "Z3": 0, "Z6": 0, "Z10": 0, "Z20": 0, "Z20P": 0,
+    }
+
+
+def add_rec(dst: Dict[str, int], src: Dict[str, int]):
+    for k in ("N", "KSUM", "H", "SUM", "Z3", "Z6", "Z10", "Z20", "Z20P"):
+        dst[k] += int(src.get(k, 0))
+
+
+def combine_recs(recs: List[Dict[str, int]]) -> Dict[str, int]:
+    """
+    同じレース群に対する複数買い目の合算。
+    Nは足さず、最大Nを使う。
+    KSUM/H/SUMは合算する。
+    """
+    out = new_payout_rec()
+    out["N"] = max((int(r.get("N", 0)) for r in recs), default=0)
+    for rec in recs:
+        out["KSUM"] += int(rec.get("KSUM", 0))
+        out["H"] += int(rec.get("H", 0))
+        out["SUM"] += int(rec.get("SUM", 0))
+    return out
+
+
+def ksum_sanrenpuku_12_all(field_n: int) -> int:
+    """3連複：評価1-評価2-全。7車なら5点、6車なら4点、5車なら3点。"""
+    try:
+        return max(0, int(field_n) - 2)
+    except Exception:
+        return 0
+
+
+def hit_sanrenpuku_12_all(vorder: List[str], finish: List[str], field_n: int) -> bool:
+    """3連複 1-2-全：評価1と評価2がともに3着内なら的中。"""
+    if ksum_sanrenpuku_12_all(field_n) <= 0:
+        return False
+    if not vorder or len(finish) < 3:
+        return False
+    car_to_rank = {car: i + 1 for i, car in enumerate(vorder)}
+    finish_ranks = {car_to_rank.get(car) for car in finish[:3]}
+    return 1 in finish_ranks and 2 in finish_ranks
+
+
+def sanrenpuku12_key(a: int, b: int, c: int) -> str:
+    vals = sorted([int(a), int(b), int(c)])
+    return f"{vals[0]}-{vals[1]}-{vals[2]}"
+
+
+def ksum_sanrenpuku_12_individual(target: int, field_n: int) -> int:
+    """3連複：評価1-評価2-target の1点。"""
+    try:
+        target = int(target)
+        field_n = int(field_n)
+    except Exception:
+        return 0
+    if field_n < 3:
+        return 0
+    if target in (1, 2):
+        return 0
+    if target > field_n:
+        return 0
+    return 1
+
+
+def hit_sanrenpuku_12_individual(target: int, vorder: List[str], finish: List[str], field_n: int) -> bool:
+    """3連複：評価1・評価2・target が3着内にそろえば的中。"""
+    if ksum_sanrenpuku_12_individual(target, field_n) <= 0:
+        return False
+    if not vorder or len(finish) < 3:
+        return False
+    car_to_rank = {car: i + 1 for i, car in enumerate(vorder)}
+    finish_ranks = {car_to_rank.get(car) for car in finish[:3]}
+    return {1, 2, int(target)}.issubset(finish_ranks)
+
+
+def ksum_sanrenpuku_key(key: str, field_n: int) -> int:
+    """3連複：評価キー（例 2-4-7）の1点。欠車時は存在する評価だけ有効。"""
+    try:
+        vals = [int(x) for x in str(key).split("-")]
+        field_n = int(field_n)
+    except Exception:
+        return 0
+    if len(vals) != 3 or len(set(vals)) != 3:
+        return 0
+    if field_n < 3:
+        return 0
+    if any(v < 1 or v > field_n for v in vals):
+        return 0
+    return 1
+
+
+def hit_sanrenpuku_key(key: str, vorder: List[str], finish: List[str], field_n: int) -> bool:
+    """3連複：指定評価3つが3着内にそろえば的中。"""
+    if ksum_sanrenpuku_key(key, field_n) <= 0:
+        return False
+    if not vorder or len(finish) < 3:
+        return False
+    try:
+        vals = {int(x) for x in str(key).split("-")}
+    except Exception:
+        return False
+    car_to_rank = {car: i + 1 for i, car in enumerate(vorder)}
+    finish_ranks = {car_to_rank.get(car) for car in finish[:3]}
+    return vals.issubset(finish_ranks)
+
+
+def sanrenpuku_individual_row(label: str, rec: Dict[str, int], key: str) -> Dict:
+    """任意3連複個別用の表示行。小倉基準で想定差・回収差を見る。"""
+    row = payout_row(label, rec)
+    exp_rate = TRIO_FULL_EXPECTED_HIT_RATES.get(key)
+    exp_avg_pay = TRIO_FULL_BASE_AVG_PAYS.get(key)
+    exp_roi = TRIO_FULL_EXPECTED_ROIS.get(key)
+
+    row["目"] = key
+    row["想定的中率%"] = exp_rate
+    row["基準平均配当"] = exp_avg_pay
+    row["想定回収率%"] = exp_roi
+
+    hit_rate = row.get("的中率%")
+    avg_pay = row.get("平均配当")
+    roi = row.get("回収率%")
+
+    if hit_rate is not None and pd.notna(hit_rate) and exp_rate is not None:
+        row["想定差"] = round(float(hit_rate) - float(exp_rate), 1)
+    else:
+        row["想定差"] = None
+    row["状態"] = diff_status(row.get("想定差"), exp_rate)
+
+    if avg_pay is not None and pd.notna(avg_pay) and exp_avg_pay:
+        row["配当係数"] = round(float(avg_pay) / float(exp_avg_pay), 2)
+        row["平均配当差"] = round(float(avg_pay) - float(exp_avg_pay), 1)
+        if row["配当係数"] < 0.80:
+            row["配当位置"] = "安すぎ"
+            row["配当戻り余地"] = "あり"
+        elif row["配当係数"] <= 1.30:
+            row["配当位置"] = "基準付近"
+            row["配当戻り余地"] = "中庸"
+        else:
+            row["配当位置"] = "高すぎ"
+            row["配当戻り余地"] = "上振れ警戒"
+    else:
+        row["配当係数"] = None
+        row["平均配当差"] = None
+        row["配当位置"] = "未回収"
+        row["配当戻り余地"] = ""
+
+    if roi is not None and pd.notna(roi) and exp_roi is not None:
+        row["回収差"] = round(float(roi) - float(exp_roi), 1)
+    else:
+        row["回収差"] = None
+
+    reasons = []
+    if row.get("的中H", 0) == 0:
+        reasons.append("未回収除外")
+    if row.get("状態") == "当たりすぎ":
+        reasons.append("的中率過熱除外")
+    if row.get("配当位置") == "高すぎ":
+        reasons.append("配当上振れ警戒")
+    if row.get("回収差") is not None and row.get("回収差") > 20:
+        reasons.append("後追い除外")
+    if not reasons:
+        if row.get("配当位置") == "安すぎ":
+            reasons.append("歪み枠")
+        elif row.get("状態") == "中庸":
+            reasons.append("中庸枠")
+        else:
+            reasons.append("候補")
+    row["総合候補理由"] = "／".join(reasons)
+    return row
+
+
+def sanrenpuku12_individual_row(label: str, rec: Dict[str, int], key: str) -> Dict:
+    """3連複1-2個別用の表示行。2車複表と同じように想定差・回収差を見る。"""
+    row = payout_row(label, rec)
+    exp_rate = TRIO_12_INDIVIDUAL_EXPECTED_HIT_RATES.get(key)
+    exp_avg_pay = TRIO_12_ALL_BASE_AVG_PAYS.get(key)
+    exp_roi = TRIO_12_INDIVIDUAL_EXPECTED_ROIS.get(key)
+
+    row["目"] = key
+    row["想定的中率%"] = exp_rate
+    row["基準平均配当"] = exp_avg_pay
+    row["想定回収率%"] = exp_roi
+
+    hit_rate = row.get("的中率%")
+    avg_pay = row.get("平均配当")
+    roi = row.get("回収率%")
+
+    if hit_rate is not None and pd.notna(hit_rate) and exp_rate is not None:
+        row["想定差"] = round(float(hit_rate) - float(exp_rate), 1)
+    else:
+        row["想定差"] = None
+    row["状態"] = diff_status(row.get("想定差"), exp_rate)
+
+    if avg_pay is not None and pd.notna(avg_pay) and exp_avg_pay:
+        row["配当係数"] = round(float(avg_pay) / float(exp_avg_pay), 2)
+        row["平均配当差"] = round(float(avg_pay) - float(exp_avg_pay), 1)
+        if row["配当係数"] < 0.80:
+            row["配当位置"] = "安すぎ"
+            row["配当戻り余地"] = "あり"
+        elif row["配当係数"] <= 1.30:
+            row["配当位置"] = "基準付近"
+            row["配当戻り余地"] = "中庸"
+        else:
+            row["配当位置"] = "高すぎ"
+            row["配当戻り余地"] = "上振れ警戒"
+    else:
+        row["配当係数"] = None
+        row["平均配当差"] = None
+        row["配当位置"] = "未回収"
+        row["配当戻り余地"] = ""
+
+    if roi is not None and pd.notna(roi) and exp_roi is not None:
+        row["回収差"] = round(float(roi) - float(exp_roi), 1)
+    else:
+        row["回収差"] = None
+
+    # 2車複と同じ考え方で、後追い・過熱・未回収を避ける。
+    h = float(row.get("的中H") or 0)
+    diff = row.get("想定差")
+    coef = row.get("配当係数")
+    roi_diff = row.get("回収差")
+    if h <= 0:
+        reason = "未回収除外"
+    elif diff is not None and diff >= 5.0:
+        reason = "的中率過熱除外"
+    elif roi_diff is not None and roi_diff >= 25.0:
+        reason = "後追い除外"
+    elif coef is not None and coef > 1.30:
+        reason = "配当上振れ警戒"
+    elif coef is not None and coef < 0.80:
+        reason = "歪み枠"
+    elif diff is not None and abs(float(diff)) <= 3.0:
+        reason = "中庸枠"
+    else:
+        reason = "監視"
+    row["総合候補理由"] = reason
+    row["判定"] = ""
+    return row
+
+def sanrenpuku12_expected_rate(pair12_rate: float | None = None) -> float | None:
+    """2車複1-2想定率×3で、1-2両方3着内率を概算。上限は100%。"""
+    try:
+        if pair12_rate is None:
+            return float(TRIO_12_ALL_EXPECTED_HIT_RATE)
+        return round(min(100.0, float(pair12_rate) * 3.0), 1)
+    except Exception:
+        return None
+
+
+def sanrenpuku12_row(label: str, rec: Dict[str, int]) -> Dict:
+    """3連複1-2-全用の表示行。小倉2年分3連複集計を固定想定として併記。"""
+    row = payout_row(label, rec)
+    exp_rate = sanrenpuku12_expected_rate()
+    exp_avg_pay = float(TRIO_12_ALL_EXPECTED_AVG_PAY)
+    exp_roi = float(TRIO_12_ALL_EXPECTED_ROI)
+
+    row["想定1-2両方3着内率%"] = exp_rate
+    row["想定平均配当"] = exp_avg_pay
+    row["ゾーン想定回収率%"] = exp_roi
+
+    if exp_rate and exp_rate > 0:
+        row["7車5点_損益分岐平均配当"] = round((5.0 * 100.0) / (exp_rate / 100.0), 1)
+    else:
+        row["7車5点_損益分岐平均配当"] = None
+
+    avg_pay = row.get("平均配当")
+    roi = row.get("回収率%")
+    hit_rate = row.get("的中率%")
+
+    if avg_pay is not None and pd.notna(avg_pay):
+        row["平均配当差"] = round(float(avg_pay) - exp_avg_pay, 1)
+    else:
+        row["平均配当差"] = None
+
+    if roi is not None and pd.notna(roi):
+        row["ゾーン回収差"] = round(float(roi) - exp_roi, 1)
+    else:
+        row["ゾーン回収差"] = None
+
+    if hit_rate is not None and pd.notna(hit_rate) and exp_rate is not None:
+        row["的中率差"] = round(float(hit_rate) - float(exp_rate), 1)
+    else:
+        row["的中率差"] = None
+
+    return row
+
+
+def nishafuku12_base_row(label: str, rec: Dict[str, int]) -> Dict:
+    """2車複1-2そのものの基礎集計。1-2ゾーンの土台確認用。"""
+    row = payout_row(label, rec)
+
+    exp_rate = float(PAIR_BASE_HIT_RATE_DEFAULTS.get("1-2", 0.0))
+    exp_avg_pay = float(PAIR_BASE_AVG_PAY_DEFAULTS.get("1-2", 0.0))
+    exp_roi = round(exp_rate * exp_avg_pay / 100.0, 1) if exp_avg_pay > 0 else None
+
+    row["想定的中率%"] = round(exp_rate, 1)
+    row["基準平均配当"] = round(exp_avg_pay, 1)
+    row["想定回収率%"] = exp_roi
+
+    hit_rate = row.get("的中率%")
+    avg_pay = row.get("平均配当")
+    roi = row.get("回収率%")
+
+    if hit_rate is not None and pd.notna(hit_rate):
+        row["的中率差"] = round(float(hit_rate) - exp_rate, 1)
+    else:
+        row["的中率差"] = None
+
+    if avg_pay is not None and pd.notna(avg_pay):
+        row["平均配当差"] = round(float(avg_pay) - exp_avg_pay, 1)
+    else:
+        row["平均配当差"] = None
+
+    if roi is not None and pd.notna(roi) and exp_roi is not None:
+        row["回収差"] = round(float(roi) - float(exp_roi), 1)
+    else:
+        row["回収差"] = None
+
+    return row
+
+
+def targets_for_pattern(axis: int, field_n: int) -> List[int]:
+    """
+    2車単固定型の相手評価。
+    評価1→23
+    評価2→13
+    欠車対応：存在する評価だけ返す。
+    """
+    if axis == 1:
+        base = AXIS1_TARGETS
+    elif axis == 2:
+        base = AXIS2_TARGETS
+    else:
+        base = ()
+
+    return [r for r in base if r <= field_n]
+
+
+def ksum_2t_pattern(axis: int, field_n: int) -> int:
+    """2車単固定型の点数。"""
+    if axis > field_n:
+        return 0
+    return len(targets_for_pattern(axis, field_n))
+
+
+def hit_2t_pattern(axis: int, win_rank: int, sec_rank: int, field_n: int) -> bool:
+    """2車単固定型の的中判定。"""
+    if axis > field_n:
+        return False
+    return win_rank == axis and sec_rank in targets_for_pattern(axis, field_n)
+
+
+def pattern_label(axis: int) -> str:
+    if axis == 1:
+        return "2車単 1→23"
+    if axis == 2:
+        return "2車単 2→13"
+    return f"2車単 評価{axis}"
+
+
+def pair_target_label(axis: int, target: int) -> str:
+    return f"2車単 {axis}→{target}"
+
+
+def ksum_axis_to_target(axis: int, target: int, field_n: int) -> int:
+    """2車単：axis→target の点数。存在する評価だけ1点として扱う。"""
+    if field_n < 2:
+        return 0
+    if axis > field_n or target > field_n:
+        return 0
+    if axis == target:
+        return 0
+    return 1
+
+
+def hit_axis_to_target(axis: int, target: int, win_rank: int, sec_rank: int, field_n: int) -> bool:
+    """2車単：axis→target の的中判定。"""
+    if ksum_axis_to_target(axis, target, field_n) <= 0:
+        return False
+    return win_rank == axis and sec_rank == target
+
+
+def nishafuku_label(a: int, b: int) -> str:
+    return f"2車複 {a}-{b}"
+
+
+NISHAFUKU_SET_DEFS = {
+    # 標準棚：軸1・2のみ
+    "標準 1-234": [nishafuku_label(1, 2), nishafuku_label(1, 3), nishafuku_label(1, 4)],
+    "標準 2-134": [nishafuku_label(1, 2), nishafuku_label(2, 3), nishafuku_label(2, 4)],
+
+    # 穴棚：軸1・2のみ
+    "穴 1-567": [nishafuku_label(1, 5), nishafuku_label(1, 6), nishafuku_label(1, 7)],
+    "穴 2-567": [nishafuku_label(2, 5), nishafuku_label(2, 6), nishafuku_label(2, 7)],
+}
+
+agg_payout_nishafuku_set_manual: Dict[str, Dict[str, int]] = {
+    set_label: new_payout_rec() for set_label in NISHAFUKU_SET_DEFS
+}
+
+# 34-12 2車複フォメ専用集計。
+# 推奨流れ（V評価入力順）の「3番手・4番手」×「1番手・2番手」を2車複4点で買う形。
+# 例：推奨流れ 3→5→7→1→2→4→6
+#     2車複 7=3 / 7=5 / 1=3 / 1=5
+NISHAFUKU_3412_LABEL = "34-12 2車複フォメ"
+NISHAFUKU_3412_RANK_PAIRS = [(3, 1), (3, 2), (4, 1), (4, 2)]
+NISHAFUKU_3412_FORMATION = "2車複 34-12 @4"
+# 引継ぎ分は、既存の「個別2車複 引継ぎ入力（累積）」から自動合算する。
+# 34-12 = 推奨流れの3・4番手 × 1・2番手 = 1-3 / 2-3 / 1-4 / 2-4
+NISHAFUKU_3412_SOURCE_LABELS = [
+    nishafuku_label(1, 3),
+    nishafuku_label(2, 3),
+    nishafuku_label(1, 4),
+    nishafuku_label(2, 4),
+]
+
+# 推奨流れ1-2ワイド集計から、1-2-全三連複の必要合成オッズを出すための固定値。
+# サイドバー入力ではなく、既存の全体累積表から自動集計します。
+WIDE12_TARGET_EV = 1.10
+WIDE12_SAFETY_FACTOR = 1.15
+
+
+@perf_timed
+def wide_pair_switch_stats(
+    a: int,
+    b: int,
+    pair12_total: Dict[PairKey, int],
+    pair13_total: Dict[PairKey, int],
+    pair23_total: Dict[PairKey, int],
+    target_ev: float | None = None,
+    safety_factor: float | None = None,
+) -> Dict:
+    """
+    推奨流れa-bワイドの的中数と切替オッズを、既存3集計から自動計算する。
+
+    対象：
+      ・1着-2着がa-b
+      ・1着-3着がa-b
+      ・2着-3着がa-b
+    上記3つを合算し、a番手・b番手が3着以内に同時に入った回数として扱う。
+    target_ev / safety_factor の既定は WIDE12_TARGET_EV / WIDE12_SAFETY_FACTOR。
+    """
+    target_ev = WIDE12_TARGET_EV if target_ev is None else float(target_ev)
+    safety_factor = WIDE12_SAFETY_FACTOR if safety_factor is None else float(safety_factor)
+    a = int(a)
+    b = int(b)
+    one_two_ab = int(pair12_total.get((a, b), 0))
+    one_two_ba = int(pair12_total.get((b, a), 0))
+    one_two = one_two_ab + one_two_ba
+    one_three = int(_pair13_combo_count(pair13_total, a, b))
+    two_three = int(_pair23_combo_count(pair23_total, a, b))
+    hit = one_two + one_three + two_three
+
+    total_races = int(sum(int(v) for v in pair12_total.values()))
+    rate_value = (hit / total_races) if total_races > 0 else 0.0
+
+    if rate_value > 0:
+        break_even_odds = 1.00 / rate_value
+        ev_required_odds = target_ev / rate_value
+        recommended_min_odds = ev_required_odds * safety_factor
+    else:
+        break_even_odds = None
+        ev_required_odds = None
+        recommended_min_odds = None
+
+    return {
+        "a": a,
+        "b": b,
+        "label": f"{a}-{b}",
+        "one_two_ab": one_two_ab,
+        "one_two_ba": one_two_ba,
+        "one_two": one_two,
+        "one_three": one_three,
+        "two_three": two_three,
+        "hit": hit,
+        "total_races": total_races,
+        "rate": rate_value,
+        "break_even_odds": break_even_odds,
+        "ev_required_odds": ev_required_odds,
+        "recommended_min_odds": recommended_min_odds,
+    }
+
+
+def ksum_nishafuku_3412(field_n: int) -> int:
+    """34-12 2車複フォメの点数。推奨流れの1～4番手が存在する時だけ4点。"""
+    try:
+        field_n = int(field_n)
+    except Exception:
+        return 0
+    if field_n < 4:
+        return 0
+    return len(NISHAFUKU_3412_RANK_PAIRS)
+
+
+def hit_nishafuku_3412(win_rank: int, sec_rank: int, field_n: int) -> bool:
+    """34-12 2車複フォメの的中判定。1→2着評価順位が3/4番手×1/2番手なら的中。"""
+    if ksum_nishafuku_3412(field_n) <= 0:
+        return False
+    actual = {int(win_rank), int(sec_rank)}
+    for a, b in NISHAFUKU_3412_RANK_PAIRS:
+        if actual == {a, b}:
+            return True
+    return False
+
+
+def nishafuku_3412_bets_from_order(vorder: List[str]) -> List[str]:
+    """入力された推奨流れ順から、34-12の実車番買い目を表示用に作る。"""
+    if not vorder or len(vorder) < 4:
+        return []
+    rank_to_car = {i + 1: str(car) for i, car in enumerate(vorder)}
+    bets = []
+    for a, b in NISHAFUKU_3412_RANK_PAIRS:
+        ca = rank_to_car.get(a)
+        cb = rank_to_car.get(b)
+        if ca is None or cb is None:
+            continue
+        bets.append(f"{ca}={cb}")
+    return bets
+
+
+# 123-123-4 三連複3点の推定集計。
+# 実三連複配当は入力していないため、N/H/的中率だけを出す。金額・回収率は出さない。
+# 1→2着評価分布と評価別3着回数から、3着を条件付き按分して推定する。
+TRIO_1231234_LABEL = "123-123-4 三連複3点"
+TRIO_1231234_KEYS = ["1-2-4", "1-3-4", "2-3-4"]
+TRIO_1231234_TOP_SET = {1, 2, 3}
+TRIO_1231234_TARGET = 4
+
+TRIO_1241243_LABEL = "124-124-3 三連複3点"
+TRIO_1241243_KEYS = ["1-2-3", "1-3-4", "2-3-4"]
+TRIO_1241243_TOP_SET = {1, 2, 4}
+TRIO_1241243_TARGET = 3
+
+
+def _trio_1231234_is_hit_ranks(ranks) -> bool:
+    """評価順位3つが 1-2-4 / 1-3-4 / 2-3-4 のどれかなら的中。"""
+    try:
+        s = {int(x) for x in ranks}
+    except Exception:
+        return False
+    return TRIO_1231234_TARGET in s and len(s & TRIO_1231234_TOP_SET) >= 2
+
+
+def hit_trio_1231234(vorder: List[str], finish: List[str], field_n: int) -> bool:
+    """日次入力から、123-123-4三連複3点の実的中だけ判定する。"""
+    try:
+        field_n = int(field_n)
+    except Exception:
+        return False
+    if field_n < 4 or not vorder or len(finish) < 3:
+        return False
+    car_to_rank = {car: i + 1 for i, car in enumerate(vorder)}
+    finish_ranks = [car_to_rank.get(car) for car in finish[:3]]
+    if any(x is None for x in finish_ranks):
+        return False
+    return _trio_1231234_is_hit_ranks(finish_ranks)
+
+
+def estimate_trio_1231234_from_pair12_and_rank(pair12_counts: Dict[PairKey, int], rank_counts: Dict[int, Dict[str, int]]) -> Dict:
+    """
+    123-123-4三連複3点を、既存の2車複ブロックと評価別3着回数から推定する。
+
+    実3連複配当がないため、払戻SUMは出さない。
+    推定方法：
+      1着→2着の各評価ペアごとに、残り評価の3着回数比で3着評価を按分。
+      その3着評価を加えた3つの評価が 1-2-4 / 1-3-4 / 2-3-4 なら推定Hに加算。
+    """
+    total_n = sum(int(v) for v in pair12_counts.values())
+    ksum = int(total_n) * len(TRIO_1231234_KEYS)
+
+    c3_by_rank = {r: int(rank_counts.get(r, {}).get("C3", 0)) for r in range(1, FIELD_SIZE + 1)}
+    est_h = 0.0
+    detail_rows = []
+
+    for (wr, sr), cnt in sorted(pair12_counts.items()):
+        cnt = int(cnt)
+        if cnt <= 0 or wr == sr:
+            continue
+
+        remaining = [r for r in range(1, FIELD_SIZE + 1) if r not in (int(wr), int(sr))]
+        denom = sum(c3_by_rank.get(r, 0) for r in remaining)
+        if denom <= 0:
+            continue
+
+        pair_est_h = 0.0
+        hit_third_parts = []
+        for tr in remaining:
+            if not _trio_1231234_is_hit_ranks([wr, sr, tr]):
+                continue
+            add = cnt * (c3_by_rank.get(tr, 0) / denom)
+            pair_est_h += add
+            hit_third_parts.append(f"{tr}:{add:.1f}")
+
+        if pair_est_h > 0:
+            est_h += pair_est_h
+            detail_rows.append({
+                "1着評価": int(wr),
+                "2着評価": int(sr),
+                "回数": cnt,
+                "推定的中H": round(pair_est_h, 1),
+                "的中3着按分": " / ".join(hit_third_parts),
+            })
+
+    hit_rate = round(100.0 * est_h / total_n, 1) if total_n > 0 else None
+    return {
+        "型": TRIO_1231234_LABEL,
+        "対象N": int(total_n),
+        "総点数KSUM": int(ksum),
+        "推定H": round(est_h, 1),
+        "推定的中率%": hit_rate,
+        "構成": " / ".join(TRIO_1231234_KEYS),
+        "detail_rows": detail_rows,
+    }
+
+
+def trio_1231234_daily_row(rec: Dict[str, int]) -> Dict:
+    """日次入力だけは実着順から的中Hを出す。配当入力なしなのでSUM/回収率は出さない。"""
+    N = int(rec.get("N", 0))
+    KSUM = int(rec.get("KSUM", 0))
+    H = int(rec.get("H", 0))
+    hit_rate = round(100.0 * H / N, 1) if N > 0 else None
+    return {
+        "型": "123-123-4｜今日入力・実着順",
+        "対象N": N,
+        "総点数KSUM": KSUM,
+        "的中H": H,
+        "的中率%": hit_rate,
+        "構成": " / ".join(TRIO_1231234_KEYS),
+    }
+
+
+def _trio_1241243_is_hit_ranks(ranks) -> bool:
+    """評価順位3つが 1-2-3 / 1-3-4 / 2-3-4 のどれかなら的中。"""
+    try:
+        s = {int(x) for x in ranks}
+    except Exception:
+        return False
+    return TRIO_1241243_TARGET in s and len(s & TRIO_1241243_TOP_SET) >= 2
+
+
+def hit_trio_1241243(vorder: List[str], finish: List[str], field_n: int) -> bool:
+    """日次入力から、124-124-3三連複3点の実的中だけ判定する。"""
+    try:
+        field_n = int(field_n)
+    except Exception:
+        return False
+    if field_n < 4 or not vorder or len(finish) < 3:
+        return False
+    car_to_rank = {car: i + 1 for i, car in enumerate(vorder)}
+    finish_ranks = [car_to_rank.get(car) for car in finish[:3]]
+    if any(x is None for x in finish_ranks):
+        return False
+    return _trio_1241243_is_hit_ranks(finish_ranks)
+
+
+def estimate_trio_1241243_from_pair12_and_rank(pair12_counts: Dict[PairKey, int], rank_counts: Dict[int, Dict[str, int]]) -> Dict:
+    """
+    124-124-3三連複3点を、既存の2車複ブロックと評価別3着回数から推定する。
+    実3連複配当がないため、払戻SUMは出さない。
+    """
+    total_n = sum(int(v) for v in pair12_counts.values())
+    ksum = int(total_n) * len(TRIO_1241243_KEYS)
+
+    c3_by_rank = {r: int(rank_counts.get(r, {}).get("C3", 0)) for r in range(1, FIELD_SIZE + 1)}
+    est_h = 0.0
+    detail_rows = []
+
+    for (wr, sr), cnt in sorted(pair12_counts.items()):
+        cnt = int(cnt)
+        if cnt <= 0 or wr == sr:
+            continue
+
+        remaining = [r for r in range(1, FIELD_SIZE + 1) if r not in (int(wr), int(sr))]
+        denom = sum(c3_by_rank.get(r, 0) for r in remaining)
+        if denom <= 0:
+            continue
+
+        pair_est_h = 0.0
+        hit_third_parts = []
+        for tr in remaining:
+            if not _trio_1241243_is_hit_ranks([wr, sr, tr]):
+                continue
+            add = cnt * (c3_by_rank.get(tr, 0) / denom)
+            pair_est_h += add
+            hit_third_parts.append(f"{tr}:{add:.1f}")
+
+        if pair_est_h > 0:
+            est_h += pair_est_h
+            detail_rows.append({
+                "1着評価": int(wr),
+                "2着評価": int(sr),
+                "回数": cnt,
+                "推定的中H": round(pair_est_h, 1),
+                "的中3着按分": " / ".join(hit_third_parts),
+            })
+
+    hit_rate = round(100.0 * est_h / total_n, 1) if total_n > 0 else None
+    return {
+        "型": TRIO_1241243_LABEL,
+        "対象N": int(total_n),
+        "総点数KSUM": int(ksum),
+        "推定H": round(est_h, 1),
+        "推定的中率%": hit_rate,
+        "構成": " / ".join(TRIO_1241243_KEYS),
+        "detail_rows": detail_rows,
+    }
+
+
+def trio_1241243_daily_row(rec: Dict[str, int]) -> Dict:
+    """日次入力だけは実着順から的中Hを出す。配当入力なしなのでSUM/回収率は出さない。"""
+    N = int(rec.get("N", 0))
+    KSUM = int(rec.get("KSUM", 0))
+    H = int(rec.get("H", 0))
+    hit_rate = round(100.0 * H / N, 1) if N > 0 else None
+    return {
+        "型": "124-124-3｜今日入力・実着順",
+        "対象N": N,
+        "総点数KSUM": KSUM,
+        "的中H": H,
+        "的中率%": hit_rate,
+        "構成": " / ".join(TRIO_1241243_KEYS),
+    }
+
+
+def ksum_nishafuku_pair(a: int, b: int, field_n: int) -> int:
+    """2車複：評価a-b の点数。存在する評価だけ1点として扱う。"""
+    if field_n < 2:
+        return 0
+    if a > field_n or b > field_n:
+        return 0
+    if a == b:
+        return 0
+    return 1
+
+
+def hit_nishafuku_pair(a: int, b: int, win_rank: int, sec_rank: int, field_n: int) -> bool:
+    """2車複：実際の1着・2着評価順位がa-bなら的中。順不同。"""
+    if ksum_nishafuku_pair(a, b, field_n) <= 0:
+        return False
+    return {win_rank, sec_rank} == {a, b}
+
+
+def payout_row(label: str, rec: Dict[str, int]) -> Dict:
+    N = int(rec["N"])
+    KSUM = int(rec["KSUM"])
+    H = int(rec["H"])
+    SUM = int(rec["SUM"])
+
+    invest = KSUM * 100
+    roi = round(100.0 * SUM / invest, 1) if invest > 0 else None
+    avg_pay = round(SUM / H, 1) if H > 0 else None
+    hit_rate = round(100.0 * H / N, 1) if N > 0 else None
+
+    return {
+        "型": label,
+        "対象N": N,
+        "総点数KSUM": KSUM,
+        "投資額換算": invest,
+        "払戻合計SUM": SUM,
+        "的中H": H,
+        "的中率%": hit_rate,
+        "平均配当": avg_pay,
+        "回収率%": roi,
+        "判定": "",
+    }
+
+
+def rec_for_labels(source: Dict[str, Dict[str, int]], labels: List[str]) -> Dict[str, int]:
+    """指定ラベル群の合算レコード。Nは最大N、KSUM/H/SUMは合算。"""
+    return combine_recs([source[label] for label in labels if label in source])
+
+
+def expected_set_hit_rate_from_pair12(labels: List[str], pair12_counts: Dict[PairKey, int]) -> float | None:
+    """
+    1→2着評価分布から、2車複セットの想定的中率を出す。
+    2車複なので順不同で集計する。
+
+    例：
+      1-234 = 1-2 / 1-3 / 1-4
+      → (1,2)+(2,1)+(1,3)+(3,1)+(1,4)+(4,1)
+    """
+    total = sum(int(v) for v in pair12_counts.values())
+    if total <= 0:
+        return None
+
+    hit = 0
+    for label in labels:
+        # label例: "2車複 1-4"
+        try:
+            pair_part = label.replace("2車複", "").strip()
+            a_str, b_str = pair_part.split("-")
+            a, b = int(a_str), int(b_str)
+        except Exception:
+            continue
+
+        hit += int(pair12_counts.get((a, b), 0))
+        hit += int(pair12_counts.get((b, a), 0))
+
+    return round(100.0 * hit / total, 1)
+
+
+def payout_row_with_expected_set_hit(label: str, rec: Dict[str, int], labels: List[str], pair12_counts: Dict[PairKey, int]) -> Dict:
+    """想定セット的中率と、実的中率との差を併記した行。"""
+    row = payout_row(label, rec)
+
+    expected_hit = expected_set_hit_rate_from_pair12(labels, pair12_counts)
+    row["想定セット的中率%"] = expected_hit
+
+    if row["的中率%"] is not None and expected_hit is not None:
+        row["想定差"] = round(row["的中率%"] - expected_hit, 1)
+    else:
+        row["想定差"] = None
+
+    return row
+
+
+def expected_pair_hit_rate_from_pair12(a: int, b: int, pair12_counts: Dict[PairKey, int]) -> float | None:
+    """1→2着評価分布から、評価a-bの2車複想定的中率を出す。順不同。"""
+    total = sum(int(v) for v in pair12_counts.values())
+    if total <= 0:
+        return None
+    hit = int(pair12_counts.get((a, b), 0)) + int(pair12_counts.get((b, a), 0))
+    return round(100.0 * hit / total, 1)
+
+
+def nishafuku_individual_row(label: str, rec: Dict[str, int], pair12_counts: Dict[PairKey, int]) -> Dict:
+    """個別2車複の累積表示行。3軸・4軸追加ペアも同じ形式で見る。"""
+    row = payout_row(label, rec)
+    pair_part = label.replace("2車複", "").strip()
+    row["ペアキー"] = pair_part
+
+    try:
+        a, b = [int(x) for x in pair_part.split("-")]
+    except Exception:
+        a = b = None
+
+    # 1-2〜2-7は小倉固定基準、追加した3-4以降は1→2着分布からの累積想定率を使う。
+    exp_rate = PAIR_BASE_HIT_RATE_DEFAULTS.get(pair_part)
+    if exp_rate is None and a is not None and b is not None:
+        exp_rate = expected_pair_hit_rate_from_pair12(a, b, pair12_counts)
+
+    exp_avg_pay = PAIR_BASE_AVG_PAY_DEFAULTS.get(pair_part)
+    exp_roi = round(float(exp_rate) * float(exp_avg_pay) / 100.0, 1) if exp_rate is not None and exp_avg_pay else None
+
+    row["想定ペア的%"] = exp_rate
+    row["ペア基準配当"] = exp_avg_pay
+    row["想定回収率%"] = exp_roi
+
+    hit_rate = row.get("的中率%")
+    avg_pay = row.get("平均配当")
+    roi = row.get("回収率%")
+
+    if hit_rate is not None and pd.notna(hit_rate) and exp_rate is not None:
+        row["想定差"] = round(float(hit_rate) - float(exp_rate), 1)
+    else:
+        row["想定差"] = None
+
+    if avg_pay is not None and pd.notna(avg_pay) and exp_avg_pay:
+        row["配当係数"] = round(float(avg_pay) / float(exp_avg_pay), 2)
+        row["平均配当差"] = round(float(avg_pay) - float(exp_avg_pay), 1)
+    else:
+        row["配当係数"] = None
+        row["平均配当差"] = None
+
+    if roi is not None and pd.notna(roi) and exp_roi is not None:
+        row["回収差"] = round(float(roi) - float(exp_roi), 1)
+    else:
+        row["回収差"] = None
+
+    return row
+
+
+@perf_timed
+@content_cached
+def build_nishafuku_pairs_frame(
+    payout_nishafuku: Dict[str, Dict[str, int]],
+    pair12_counts: Dict[PairKey, int],
+    pairs: List[Tuple[int, int]] | None = None,
+) -> pd.DataFrame:
+    """個別2車複の累積表（推奨ロジックの df_pairs の元）。既定は NISHAFUKU_PAIRS。"""
+    return pd.DataFrame([
+        nishafuku_individual_row(nishafuku_label(a, b), payout_nishafuku[nishafuku_label(a, b)], pair12_counts)
+        for a, b in (NISHAFUKU_PAIRS if pairs is None else pairs)
+        if nishafuku_label(a, b) in payout_nishafuku
+    ])
+
+
+def diff_status(diff, expected=None) -> str:
+    """想定差の状態をざっくり表示。想定0%は候補対象外。"""
+    if expected is not None and expected == 0:
+        return "対象外"
+    if diff is None:
+        return ""
+    if diff >= 10:
+        return "当たりすぎ"
+    if diff <= -10:
+        return "当たらなすぎ"
+    return "中庸"
+
+
+def _clean_num_list(values):
+    out = []
+    for v in values:
+        try:
+            if pd.notna(v):
+                out.append(float(v))
+        except Exception:
+            pass
+    return out
+
+
+def _median(values):
+    vals = sorted(_clean_num_list(values))
+    n = len(vals)
+    if n == 0:
+        return None
+    mid = n // 2
+    if n % 2 == 1:
+        return vals[mid]
+    return (vals[mid - 1] + vals[mid]) / 2.0
+
+
+def _deviation_stats(value, values):
+    """平均差・中央値差・偏差値・基準位置を返す。少数候補でも落ちない軽量版。"""
+    try:
+        if value is None or pd.isna(value):
+            return {"平均差": None, "中央値差": None, "偏差値": None, "基準位置": ""}
+        x = float(value)
+    except Exception:
+        return {"平均差": None, "中央値差": None, "偏差値": None, "基準位置": ""}
+
+    vals = _clean_num_list(values)
+    if not vals:
+        return {"平均差": None, "中央値差": None, "偏差値": None, "基準位置": ""}
+
+    mean = sum(vals) / len(vals)
+    med = _median(vals)
+    var = sum((v - mean) ** 2 for v in vals) / len(vals) if len(vals) > 0 else 0.0
+    sd = var ** 0.5
+
+    mean_diff = round(x - mean, 1)
+    med_diff = round(x - med, 1) if med is not None else None
+    if sd > 0:
+        dev = round(50.0 + 10.0 * (x - mean) / sd, 1)
+    else:
+        dev = 50.0
+
+    if dev >= 60:
+        pos = "高すぎ"
+    elif dev >= 55:
+        pos = "やや高い"
+    elif dev <= 40:
+        pos = "低すぎ"
+    elif dev <= 45:
+        pos = "やや低い"
+    else:
+        pos = "中庸"
+
+    return {
+        "平均差": mean_diff,
+        "中央値差": med_diff,
+        "偏差値": dev,
+        "基準位置": pos,
+    }
+
+
+def drop_blank_display_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """表示用：全行が空欄/None/NaNの列だけ削除する。判定列も全空なら削る。"""
+    if df is None or df.empty:
+        return df
+    out = df.copy()
+    drop_cols = []
+    for col in out.columns:
+        s = out[col]
+        # None/NaN または 空文字だけなら空列扱い
+        is_blank = s.apply(lambda v: pd.isna(v) or str(v).strip() == "")
+        if bool(is_blank.all()):
+            drop_cols.append(col)
+    if drop_cols:
+        out = out.drop(columns=drop_cols)
+    return out
+
+
+# =========================
+# 投資EV診断（既存推奨買い目を変えずに診断だけ行う）
+# =========================
+EV_K_MAP = {
+    "2車複": 75,
+    "3連複": 125,
+}
+EV_N0_MAP = {
+    "2車複": 50,
+    "3連複": 40,
+}
+EV_H0_MAP = {
+    "2車複": 5,
+    "3連複": 3,
+}
+
+
+def _safe_float(v, default=None):
+    try:
+        if v is None or pd.isna(v):
+            return default
+        return float(v)
+    except Exception:
+        return default
+
+
+def _pct_to_prob(v):
+    x = _safe_float(v, None)
+    if x is None:
+        return None
+    # 既存表は%表記なので、1.0を超える値は%として扱う。
+    return x / 100.0 if x > 1.0 else x
+
+
+def _odds_from_pay(v):
+    """100円あたり払戻金を倍率に変換。例：315円→3.15倍。"""
+    x = _safe_float(v, None)
+    if x is None or x <= 0:
+        return None
+    return x / 100.0
+
+
+def _heat_penalty_from_ratio(odds_ratio):
+    r = _safe_float(odds_ratio, None)
+    if r is None:
+        return 1.0
+    if r >= 0.90:
+        return 1.00
+    if r >= 0.75:
+        return 0.85
+    if r >= 0.60:
+        return 0.65
+    return 0.00
+
+
+def _single_ev_label(ev, confidence, odds_ratio, is_anchor=False):
+    ev = _safe_float(ev, 0.0)
+    conf = _safe_float(confidence, 0.0)
+    ratio = _safe_float(odds_ratio, 1.0)
+
+    if is_anchor:
+        if ev >= 1.00 and ratio >= 0.85:
+            return "保険採用"
+        if ev >= 0.90:
+            return "低比重保険"
+        return "保険除外"
+
+    if ev >= 1.20 and conf >= 0.70 and ratio >= 0.90:
+        return "強推奨"
+    if ev >= 1.10 and conf >= 0.60 and ratio >= 0.85:
+        return "推奨"
+    if ev >= 1.00:
+        return "監視"
+    return "除外"
+
+
+def _num_column(df: pd.DataFrame, col: str) -> np.ndarray:
+    """列を float 配列にする（_safe_float の列版）。無い列・数値にできない値は NaN。"""
+    if col not in df.columns:
+        return np.full(len(df), np.nan)
+    return pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=float)
+
+
+def _pct_to_prob_column(x: np.ndarray) -> np.ndarray:
+    """_pct_to_prob の列版。1.0を超える値は%として扱う。"""
+    return np.where(x > 1.0, x / 100.0, x)
+
+
+def _odds_from_pay_column(x: np.ndarray) -> np.ndarray:
+    """_odds_from_pay の列版。0以下・欠損は NaN。"""
+    return np.where(x > 0, x / 100.0, np.nan)
+
+
+def _heat_penalty_column(odds_ratio: np.ndarray) -> np.ndarray:
+    """_heat_penalty_from_ratio の列版。"""
+    r = np.nan_to_num(odds_ratio, nan=-1.0)
+    heat = np.select([r >= 0.90, r >= 0.75, r >= 0.60], [1.00, 0.85, 0.65], 0.00)
+    return np.where(np.isnan(odds_ratio), 1.0, heat)
+
+
+def _round_column(values: np.ndarray, ndigits: int) -> np.ndarray:
+    """
+    組み込み round と同じ結果になる列の丸め。
+
+    np.round は 10**ndigits を掛けてから丸めるので、ちょうど半分に近い値（4.755 など）で
+    組み込み round（10進で正しく丸める）と1桁ずれることがある。半分に近い要素だけ組み込み round で直す。
+    """
+    out = np.round(values, ndigits)
+    scaled = values * (10.0 ** ndigits)
+    near_half = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    for i in near_half:
+        out[i] = round(float(values[i]), ndigits)
+    return out
+
+
+def _rounded_or_none(values: np.ndarray, ndigits: int):
+    """
+    NaN（行ごとの版の None）を残して丸める。
+    全部 NaN のときは行ごとの版と同じく None の列（object）にする。
+    """
+    if np.isnan(values).all():
+        return [None] * len(values)
+    return _round_column(values, ndigits)
+
+
+@perf_timed
+@content_cached
+def calculate_ev_metrics(
+    df: pd.DataFrame,
+    bet_type: str,
+    condition_margin: float = 0.90,
+    duplicate_penalty: float = 1.0,
+    k_map: Dict[str, float] | None = None,
+    n0_map: Dict[str, float] | None = None,
+    h0_map: Dict[str, float] | None = None,
+) -> pd.DataFrame:
+    """
+    既存の集計表に投資診断列を追加する。
+
+    重要：この段階では該当レースの現在オッズを入力していないため、
+    EVは確定させない。
+    代わりに、p_safeから必要オッズを逆算して表示する。
+
+    EV = p_safe × current_odds
+    よって、必要odds = 目標EV / p_safe
+
+    k_map / n0_map / h0_map を渡すと EV_K_MAP / EV_N0_MAP / EV_H0_MAP の代わりに使う（定数の検証用）。
+    計算は列ごとにまとめて行う。欠損・数値でない値の扱いは _safe_float / _pct_to_prob / _odds_from_pay と同じ。
+    """
+    if df is None or df.empty:
+        return df
+
+    out = df
+    K = float((EV_K_MAP if k_map is None else k_map).get(bet_type, 100))
+    N0 = float((EV_N0_MAP if n0_map is None else n0_map).get(bet_type, 50))
+    H0 = float((EV_H0_MAP if h0_map is None else h0_map).get(bet_type, 3))
+
+    N = np.nan_to_num(_num_column(out, "対象N"), nan=0.0)
+    hits = np.nan_to_num(_num_column(out, "的中H"), nan=0.0)
+    p_current = np.nan_to_num(_pct_to_prob_column(_num_column(out, "的中率%")), nan=0.0)
+
+    if bet_type == "2車複":
+        p_base = _pct_to_prob_column(_num_column(out, "想定ペア的%"))
+        base_pay = _num_column(out, "ペア基準配当")
+    else:
+        p_base = _pct_to_prob_column(_num_column(out, "想定的中率%"))
+        base_pay = _num_column(out, "基準平均配当")
+    p_base = np.where(np.isnan(p_base), p_current, p_base)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w = np.where((N + K) > 0, N / (N + K), 0.0)
+        p_adj = w * p_current + (1.0 - w) * p_base
+        p_safe = p_adj * float(condition_margin)
+
+        # 該当レースの現在オッズは未入力なので、これは参考値。
+        # 「平均配当が今も出るなら」という参考EVに留める。
+        base_odds = _odds_from_pay_column(base_pay)
+        ref_odds = _odds_from_pay_column(_num_column(out, "平均配当"))
+        ref_odds = np.where(np.isnan(ref_odds), base_odds, ref_odds)
+
+        odds_ratio = ref_odds / base_odds
+        heat_penalty = _heat_penalty_column(odds_ratio)
+
+        ref_ev = p_safe * ref_odds
+        if N0 > 0 and H0 > 0:
+            confidence = np.minimum(1.0, N / N0) * np.minimum(1.0, hits / H0)
+        else:
+            confidence = np.zeros(len(out))
+
+        # 現在オッズ未入力なので、Scoreは参考EVベースの参考スコア。
+        score = ref_ev * heat_penalty * float(duplicate_penalty)
+
+        positive = p_safe > 0
+        req = {target: np.where(positive, target / p_safe, np.nan) for target in (1.00, 1.05, 1.10, 1.20)}
+
+    # 現在オッズ未入力のため、買い/ケンの確定判定はしない。
+    # 1-2だけは必要オッズ確認の保険枠として表示する。
+    keys_a = out["ペアキー"] if "ペアキー" in out.columns else [None] * len(out)
+    keys_b = out["目"] if "目" in out.columns else [None] * len(out)
+    keys = [str(a or b or "").strip() for a, b in zip(keys_a, keys_b)]
+    is_anchor = np.array([bet_type == "2車複" and key == "1-2" for key in keys], dtype=bool)
+
+    new_cols = {
+        "p_adj%": _round_column(p_adj * 100.0, 2),
+        "p_safe%": _round_column(p_safe * 100.0, 2),
+        "参考odds": _rounded_or_none(ref_odds, 2),
+        "基準odds": _rounded_or_none(base_odds, 2),
+        "odds_ratio": _rounded_or_none(odds_ratio, 2),
+        "参考EV": _rounded_or_none(ref_ev, 3),
+        # 画面上で使う買い基準はEV1.10に一本化する。
+        # EV1.00/1.05は損益分岐・弱確認ラインであり、購入判断には使わないため非表示。
+        "最低必要オッズ": _rounded_or_none(req[1.10], 2),
+        "最低必要払戻": _rounded_or_none(req[1.10] * 100.0, 0),
+        "Confidence": _round_column(confidence, 3),
+        "heat_penalty": _round_column(heat_penalty, 2),
+        "Score": _rounded_or_none(score, 3),
+        "EV判定": np.where(is_anchor, "保険必要オッズ確認", "必要オッズ確認").tolist(),
+        "is_anchor": is_anchor,
+        "券種": [bet_type] * len(df),
+    }
+    # 列は1回でまとめて足す（1列ずつの代入は列の挿入コストが行数によらず重い）。
+    # 既にある診断列（再計算のとき）は元の位置のまま上書きする。
+    out = df.copy()
+    for col in [c for c in new_cols if c in out.columns]:
+        out[col] = new_cols.pop(col)
+    if new_cols:
+        out = pd.concat([out, pd.DataFrame(new_cols, index=out.index)], axis=1)
+    return out
+
+
+def calculate_ev_metrics_many(
+    tables,
+    bet_type: str,
+    race_col: str = "レースID",
+    **kwargs,
+) -> pd.DataFrame:
+    """
+    複数レースの候補表を1回で EV 診断する。
+
+    tables は {レースID: 候補表} か候補表のリスト（リストなら1始まりの連番をIDにする）。
+    全レースを縦につないで calculate_ev_metrics を1回だけ呼び、先頭に race_col 列を付けて返す。
+    レースごとに呼んだ結果と同じ値になる（候補表の列構成がそろっている前提）。
+    kwargs は calculate_ev_metrics の condition_margin / duplicate_penalty / k_map などをそのまま渡す。
+    """
+    items = tables.items() if isinstance(tables, dict) else enumerate(tables or [], start=1)
+    parts = [
+        df.assign(**{race_col: rid})
+        for rid, df in items
+        if df is not None and not df.empty
+    ]
+    if not parts:
+        return pd.DataFrame(columns=[race_col])
+    merged = pd.concat(parts, ignore_index=True)
+    merged = merged[[race_col] + [c for c in merged.columns if c != race_col]]
+    return calculate_ev_metrics(merged, bet_type, **kwargs)
+
+
+def _pair_key_norm(a: int, b: int) -> str:
+    """2車複表示用に評価番号を昇順キーへ整える。"""
+    a, b = int(a), int(b)
+    if a == b:
+        return ""
+    x, y = sorted((a, b))
+    return f"{x}-{y}"
+
+
+def _pair_hit_rate_from_pair12_total(pair_key: str, pair12_counts: Dict[PairKey, int]) -> float | None:
+    """1→2着評価分布から、任意2車複キーの現在的中率%を出す。"""
+    try:
+        a, b = [int(x) for x in str(pair_key).split("-")]
+    except Exception:
+        return None
+    total = sum(int(v) for v in pair12_counts.values())
+    if total <= 0 or a == b:
+        return None
+    hit = int(pair12_counts.get((a, b), 0)) + int(pair12_counts.get((b, a), 0))
+    return round(100.0 * hit / total, 1)
+
+
+def _rank_pair_candidate_row(row: pd.Series) -> float:
+    """クロスフォーメーション用のヒモ候補を軽く順位化する。小さいほど優先。"""
+    score = 100.0
+    judge = str(row.get("判定", ""))
+    asset = str(row.get("資産枠", ""))
+    reason = str(row.get("総合候補理由", ""))
+    if judge == "注":
+        score -= 40.0
+    elif judge == "本線":
+        score -= 20.0
+    if asset == "歪み" or "歪み" in reason:
+        score -= 18.0
+    elif asset == "中庸" or "中庸" in reason:
+        score -= 14.0
+    elif asset == "安定" or "安定" in reason:
+        score -= 8.0
+    try:
+        # 配当が戻りやすいものを少し優先。ただし係数が極端なものは既存ロジック側で弾く前提。
+        coef = float(row.get("配当係数"))
+        if pd.notna(coef):
+            score += abs(coef - 0.85) * 6.0
+    except Exception:
+        pass
+    try:
+        exp = float(row.get("想定ペア的%"))
+        if pd.notna(exp):
+            score -= exp / 10.0
+    except Exception:
+        pass
+    try:
+        opp = int(row.get("相手"))
+        score += opp * 0.05
+    except Exception:
+        pass
+    return float(score)
+
+
+@perf_timed
+def build_cross_formation_summary(df_pairs: pd.DataFrame, pair12_counts: Dict[PairKey, int]) -> dict | None:
+    """
+    クロスフォーメーション A◯-B△ を1つだけ作る。
+
+    v11.7方針：
+    - クロスフォーメーションの基準は、既存の2車複「本線・注」ロジックに準じる。
+    - 中心ペアは本線を優先。なければ注。
+    - 注ペアが中心と別に存在する場合は、まず「中心ペア」と「注ペア」を両方内包する4点フォーメーションだけを優先比較する。
+      例：本線1-5、注2-3なら、12-35 または 13-25 のように、1-5と2-3を両方含む型を比較する。
+    - もし中心＋注を両方含める型が作れない場合だけ、中心ペアを含む全候補から選ぶ。
+    - 現在的中率最大ではなく、本線・注・資産枠・配当位置・除外理由など既存推奨基準に沿ったスコアで選ぶ。
+    - 通常表示は型だけ。内部4点は detail へ格納する。
+    """
+    if df_pairs is None or df_pairs.empty:
+        return None
+    work = df_pairs.copy()
+    if "ペアキー" not in work.columns:
+        return None
+
+    # 既存の本線・注をそのまま中心情報として使う。
+    cand_df = work[work.get("判定", "").astype(str).isin(["本線", "注"])].copy()
+    if cand_df.empty:
+        return None
+    cand_df["_center_rank"] = cand_df["判定"].astype(str).map({"本線": 0, "注": 1}).fillna(9)
+    sort_cols = ["_center_rank"]
+    if "_枠内順位" in cand_df.columns:
+        sort_cols.append("_枠内順位")
+    sort_cols.append("ペアキー")
+    cand_df = cand_df.sort_values(sort_cols)
+
+    center_key = str(cand_df.iloc[0].get("ペアキー", "")).strip()
+    try:
+        center_a, center_b = [int(x) for x in center_key.split("-")]
+    except Exception:
+        return None
+    if center_a == center_b:
+        return None
+
+    # 中心とは別の最上位「注」を拾う。中心が注の場合は、次点注を探す。
+    note_key = None
+    note_df = work[(work.get("判定", "").astype(str) == "注")].copy()
+    if not note_df.empty:
+        if "_枠内順位" in note_df.columns:
+            note_df = note_df.sort_values(["_枠内順位", "ペアキー"])
+        else:
+            note_df = note_df.sort_values(["ペアキー"])
+        for _, nr in note_df.iterrows():
+            pk = str(nr.get("ペアキー", "")).strip()
+            if pk and pk != center_key:
+                note_key = pk
+                break
+
+    ranks = [1, 2, 3, 4, 5, 6, 7]
+
+    row_map = {}
+    for _, r in work.iterrows():
+        pk = str(r.get("ペアキー", "")).strip()
+        if pk:
+            row_map[pk] = r
+
+    def current_rate(pk: str) -> float:
+        hr = _pair_hit_rate_from_pair12_total(pk, pair12_counts)
+        return float(hr) if hr is not None else 0.0
+
+    def _str(row: pd.Series | None, col: str) -> str:
+        if row is None:
+            return ""
+        try:
+            v = row.get(col, "")
+        except Exception:
+            return ""
+        if pd.isna(v):
+            return ""
+        return str(v)
+
+    def _num(row: pd.Series | None, col: str, default=None):
+        if row is None:
+            return default
+        try:
+            v = row.get(col, default)
+            if pd.isna(v):
+                return default
+            return float(v)
+        except Exception:
+            return default
+
+    def pair_display_rate(pk: str) -> float:
+        """表示用の想定的中率。既存EV診断のp_safe%があればそれを使う。"""
+        row = row_map.get(pk)
+        if row is not None:
+            v = _num(row, "p_safe%", None)
+            if v is not None:
+                return round(v, 2)
+            v = _num(row, "想定ペア的%", None)
+            if v is not None:
+                return round(v, 2)
+            v = _num(row, "的中率%", None)
+            if v is not None:
+                return round(v, 2)
+        # 既存表にないペアは現在分布だけ。過信しないよう表示用も割引。
+        return round(current_rate(pk) * 0.65, 2)
+
+    def pair_rec_score(pk: str, role: str = "side") -> tuple[float, dict]:
+        """既存の推奨買い目判定に準じたペア評価。"""
+        row = row_map.get(pk)
+        cur = current_rate(pk)
+        p_disp = pair_display_rate(pk)
+        info = {
+            "買い目": pk,
+            "表示想定的中率%": p_disp,
+            "現在的中率%": round(cur, 1),
+            "判定": "",
+            "資産枠": "",
+            "総合候補理由": "",
+            "配当位置": "",
+            "配当戻り余地": "",
+            "ペア評価点": None,
+            "評価メモ": "",
+        }
+
+        if row is None:
+            # 3-4等、既存2車複表にない橋渡しペア。現在分布だけなので控えめ。
+            score = 8.0 + min(cur, 8.0) * 1.2
+            if role not in ("bridge", "note"):
+                score -= 18.0
+            info["ペア評価点"] = round(score, 3)
+            info["評価メモ"] = "既存2車複表なし・現在分布を割引"
+            return score, info
+
+        judge = _str(row, "判定")
+        asset = _str(row, "資産枠")
+        reason = _str(row, "総合候補理由")
+        pay_pos = _str(row, "配当位置")
+        pay_room = _str(row, "配当戻り余地")
+        ev_label = _str(row, "EV判定")
+        rank_score = _num(row, "_枠内順位", None)
+        p_safe = _num(row, "p_safe%", None)
+        expected = _num(row, "想定ペア的%", None)
+        coef = _num(row, "配当係数", None)
+        deviation = _num(row, "偏差値", None)
+
+        score = 50.0
+        memo = []
+
+        if judge == "本線":
+            score += 45.0; memo.append("本線")
+        elif judge == "注":
+            score += 36.0; memo.append("注")
+
+        if asset == "安定":
+            score += 18.0; memo.append("安定")
+        elif asset == "中庸":
+            score += 22.0; memo.append("中庸")
+        elif asset == "歪み":
+            score += 14.0; memo.append("歪み")
+
+        if "安定枠" in reason:
+            score += 16.0
+        if "中庸枠" in reason:
+            score += 18.0
+        if "歪み枠" in reason:
+            score += 10.0
+
+        # 除外理由は減点。本線・注を内包するため、完全排除にはしない。
+        if "未回収除外" in reason:
+            score -= 22.0; memo.append("未回収減点")
+        if "回収率過熱除外" in reason:
+            score -= 26.0; memo.append("回収過熱減点")
+        if "的中率過熱除外" in reason:
+            score -= 22.0; memo.append("的中過熱減点")
+        if "配当過熱除外" in reason:
+            score -= 18.0; memo.append("配当過熱減点")
+        if "後追い除外" in reason:
+            score -= 12.0; memo.append("後追い減点")
+
+        if "基準付近" in pay_pos:
+            score += 14.0; memo.append("基準付近")
+        elif "中庸" in pay_pos:
+            score += 10.0
+        elif "安すぎ" in pay_pos or "低すぎ" in pay_pos:
+            score -= 4.0
+        elif "高すぎ" in pay_pos:
+            score -= 18.0; memo.append("高すぎ減点")
+
+        if "中庸" in pay_room:
+            score += 8.0
+        elif "あり" in pay_room:
+            score += 3.0
+        elif "上振れ警戒" in pay_room:
+            score -= 16.0; memo.append("上振れ警戒")
+
+        if rank_score is not None:
+            score -= min(max(rank_score, 0.0), 80.0) * 0.45
+
+        if p_safe is not None:
+            score += min(p_safe, 12.0) * 1.4
+        elif expected is not None:
+            score += min(expected, 12.0) * 1.0
+        else:
+            score += min(cur, 8.0) * 0.6
+
+        if coef is not None:
+            if 0.80 <= coef <= 1.30:
+                score += 7.0
+            elif coef > 1.30:
+                score -= min((coef - 1.30) * 12.0, 18.0)
+            elif coef < 0.50:
+                score -= 6.0
+
+        if deviation is not None:
+            score -= abs(deviation - 52.0) * 0.10
+
+        if role == "center":
+            score += 30.0
+        elif role == "note":
+            score += 24.0
+        elif role == "bridge":
+            score *= 0.62
+
+        info.update({
+            "判定": judge,
+            "資産枠": asset,
+            "総合候補理由": reason,
+            "配当位置": pay_pos,
+            "配当戻り余地": pay_room,
+            "EV判定": ev_label,
+            "ペア評価点": round(score, 3),
+            "評価メモ": "・".join(memo),
+        })
+        return score, info
+
+    def edges_from_partition(left: tuple[int, int], right: tuple[int, int]) -> list[str]:
+        """2×2のクロスフォーメーションから内部4点を作る。"""
+        return [
+            _pair_key_norm(left[0], right[0]),
+            _pair_key_norm(left[0], right[1]),
+            _pair_key_norm(left[1], right[0]),
+            _pair_key_norm(left[1], right[1]),
+        ]
+
+    def formation_type(left: tuple[int, int], right: tuple[int, int]) -> str:
+        """表示型。各側は昇順、左右はそのまま。"""
+        l = "".join(str(x) for x in sorted(left))
+        r = "".join(str(x) for x in sorted(right))
+        return f"{l}-{r}"
+
+    # 全2×2分割を作る。ただし重複表示を避けるため、最小値を左側に固定する。
+    partitions = []
+    for a in ranks:
+        for b in ranks:
+            if b <= a:
+                continue
+            left = tuple(sorted((a, b)))
+            remaining = [x for x in ranks if x not in left]
+            for c in remaining:
+                for d in remaining:
+                    if d <= c:
+                        continue
+                    right = tuple(sorted((c, d)))
+                    # left/rightの入れ替え重複を避ける。
+                    if min(left) > min(right):
+                        continue
+                    if set(left) & set(right):
+                        continue
+                    partitions.append((left, right))
+
+    def build_candidate(left: tuple[int, int], right: tuple[int, int]) -> dict | None:
+        pair_keys = edges_from_partition(left, right)
+        if len(set(pair_keys)) != 4:
+            return None
+        if center_key not in pair_keys:
+            return None
+
+        has_note = bool(note_key and note_key in pair_keys)
+        details = []
+        scores = []
+        for pk in pair_keys:
+            if pk == center_key:
+                role = "center"
+            elif note_key and pk == note_key:
+                role = "note"
+            else:
+                # 既存表にないペアは橋渡し、あるものはside。
+                role = "bridge" if pk not in row_map else "side"
+            s, d = pair_rec_score(pk, role=role)
+            scores.append(s)
+            details.append(d)
+
+        disp_rates = [float(d.get("表示想定的中率%") or 0.0) for d in details]
+        current_rates = [float(d.get("現在的中率%") or 0.0) for d in details]
+        formation_hit = round(sum(disp_rates), 1)
+        current_total = round(sum(current_rates), 1)
+        non_center_rates = [r for pk, r in zip(pair_keys, disp_rates) if pk != center_key]
+        min_non_center = min(non_center_rates) if non_center_rates else 0.0
+
+        # 低すぎる枝が多いとテンポ補助にならない。
+        low_pen = sum(1 for x in non_center_rates if x < 2.0) * 8.0
+        if non_center_rates and min_non_center < 1.0:
+            low_pen += 10.0
+
+        # 6・7の過剰採用を減点。ただし本線・注内包の方を優先するため控えめ。
+        used = set(left) | set(right)
+        outer_pen = 0.0
+        for r in used:
+            if r == 5:
+                outer_pen += 0.8
+            elif r == 6:
+                outer_pen += 2.5
+            elif r == 7:
+                outer_pen += 5.0
+        if len([r for r in used if r >= 6]) >= 2:
+            outer_pen += 6.0
+
+        # 本線＋注を内包する型を強く優先。中心だけの型は後段のフォールバック。
+        include_bonus = 80.0 if has_note else 0.0
+
+        # 中心・注はすでに強く評価。その他2点は「枝」として評価。
+        selection_score = sum(scores) + formation_hit * 0.80 + include_bonus - low_pen - outer_pen
+
+        # 12-35 と 13-25 のように本線＋注を両方含む型では、合計的中率と非中心最低を重視。
+        sort_score = (
+            1 if has_note else 0,
+            round(selection_score, 3),
+            formation_hit,
+            min_non_center,
+            -sum(used) * 0.001,
+        )
+
+        return {
+            "方式": "クロスフォーメーション",
+            "型": formation_type(left, right),
+            "中心": center_key,
+            "注内包": has_note,
+            "注": note_key or "",
+            "左": "".join(str(x) for x in sorted(left)),
+            "右": "".join(str(x) for x in sorted(right)),
+            "買い目": pair_keys,
+            "想定的中率%": formation_hit,
+            "現在的中率合計%": current_total,
+            "非中心最低的中率%": round(min_non_center, 1),
+            "選択スコア": round(selection_score, 3),
+            "detail": details,
+            "_sort_score": sort_score,
+        }
+
+    candidates = []
+    for left, right in partitions:
+        c = build_candidate(left, right)
+        if c is not None:
+            candidates.append(c)
+
+    if not candidates:
+        return None
+
+    # 注がある場合、中心＋注を両方内包する型を優先比較する。
+    if note_key:
+        preferred = [c for c in candidates if c.get("注内包")]
+        if preferred:
+            candidates_for_select = preferred
+        else:
+            candidates_for_select = candidates
+    else:
+        candidates_for_select = candidates
+
+    candidates_for_select = sorted(candidates_for_select, key=lambda x: x["_sort_score"], reverse=True)
+    best = candidates_for_select[0]
+
+    # 根拠表示には、選択対象の上位と、全体上位を混ぜて確認できるようにする。
+    all_ranked = sorted(candidates, key=lambda x: x["_sort_score"], reverse=True)
+
+    total_hit = best.get("想定的中率%")
+    if total_hit is None:
+        state = ""
+    elif total_hit >= 50.0:
+        state = "テンポ良好"
+    elif total_hit >= 45.0:
+        state = "採用候補"
+    elif total_hit >= 40.0:
+        state = "監視"
+    else:
+        state = "低め"
+
+    if total_hit and total_hit > 0:
+        need_avg_pay_ev110 = round(400.0 * 1.10 / (float(total_hit) / 100.0), 0)
+        need_avg_odds_ev110 = round(need_avg_pay_ev110 / 100.0, 2)
+    else:
+        need_avg_pay_ev110 = None
+        need_avg_odds_ev110 = None
+
+    def _candidate_row(c: dict, selected_pool: str) -> dict:
+        hit = c.get("想定的中率%")
+        if hit and hit > 0:
+            need_pay = round(400.0 * 1.10 / (float(hit) / 100.0), 0)
+        else:
+            need_pay = None
+        return {
+            "型": c.get("型"),
+            "中心": c.get("中心"),
+            "注": c.get("注"),
+            "注内包": c.get("注内包"),
+            "表示想定的中率%": c.get("想定的中率%"),
+            "現在的中率合計%": c.get("現在的中率合計%"),
+            "非中心最低的中率%": c.get("非中心最低的中率%"),
+            "選択スコア": c.get("選択スコア"),
+            "EV1.10必要平均払戻": need_pay,
+            "比較枠": selected_pool,
+        }
+
+    top_rows = []
+    for c in candidates_for_select[:10]:
+        top_rows.append(_candidate_row(c, "中心＋注内包優先" if note_key and any(x.get("注内包") for x in candidates_for_select) else "中心優先"))
+    # 全体上位も参考として少し残す。ただし重複型は避ける。
+    seen = {r["型"] for r in top_rows}
+    for c in all_ranked[:10]:
+        if c.get("型") in seen:
+            continue
+        top_rows.append(_candidate_row(c, "全体参考"))
+        seen.add(c.get("型"))
+        if len(top_rows) >= 12:
+            break
+
+    best.update({
+        "EV1.10必要平均払戻": need_avg_pay_ev110,
+        "EV1.10必要平均オッズ": need_avg_odds_ev110,
+        "状態": state,
+        "candidate_rows": top_rows,
+    })
+    best.pop("_sort_score", None)
+    return best
+
+def race_ev_summary(df: pd.DataFrame, stake_col: str = "stake") -> dict:
+    """
+    選ばれた買い目群のRaceEV/RaceConfidenceを計算する。
+
+    買い目を独立とみなした賭け金加重平均。同じ着順で同時に当たる買い目の重なりや
+    収支のばらつきまで見るときは race_portfolio_summary を使う。
+    """
+    if df is None or df.empty:
+        return {"RaceEV": None, "RaceConfidence": None, "総点数": 0, "投資額": 0, "race_label": "ケン"}
+
+    work = df.copy()
+    if stake_col not in work.columns:
+        work[stake_col] = 100.0
+
+    total_stake = 0.0
+    ev_weighted = 0.0
+    conf_weighted = 0.0
+    count = 0
+
+    for _, r in work.iterrows():
+        stake = _safe_float(r.get(stake_col), 0.0) or 0.0
+        ev = _safe_float(r.get("EV"), None)
+        conf = _safe_float(r.get("Confidence"), 0.0) or 0.0
+        if stake <= 0 or ev is None:
+            continue
+        total_stake += stake
+        ev_weighted += stake * ev
+        conf_weighted += stake * conf
+        count += 1
+
+    if total_stake <= 0:
+        return {"RaceEV": None, "RaceConfidence": None, "総点数": 0, "投資額": 0, "race_label": "ケン"}
+
+    race_ev = ev_weighted / total_stake
+    race_conf = conf_weighted / total_stake
+
+    if race_ev >= 1.10 and race_conf >= 0.70:
+        label = "買い"
+    elif race_ev >= 1.05 and race_conf >= 0.60:
+        label = "小口買い"
+    else:
+        label = "ケン"
+
+    return {
+        "RaceEV": round(race_ev, 3),
+        "RaceConfidence": round(race_conf, 3),
+        "総点数": count,
+        "投資額": int(total_stake),
+        "race_label": label,
+    }
+
+
+@perf_timed
+def build_sanrenpuku_4point_candidate_summary(df_pairs: pd.DataFrame) -> dict | None:
+    """
+    三連複4点候補を作る。
+
+    v11.8c方針：
+    - 評価1・2・3は固定する。
+    - 第4枠Xは 1-4 / 1-5 / 1-6 / 1-7 だけを見る。
+    - 回収差がプラスの候補は「＋につき除外」とする。
+    - 回収差が0以下の候補だけで、安定差 = abs(想定差) + abs(回収差) を比較する。
+    - 安定差が一番小さいXを選び、123XBOXを表示する。
+    - 根拠表示は第4枠選定に必要な列だけに絞る。
+    - 投資系の列（資産枠・配当位置・EV判定など）はこの表に混ぜない。
+    """
+    if df_pairs is None or df_pairs.empty:
+        return None
+    if "ペアキー" not in df_pairs.columns:
+        return None
+
+    work = df_pairs.copy()
+    row_map = {}
+    for _, row in work.iterrows():
+        key = str(row.get("ペアキー", "")).strip()
+        if key:
+            row_map[key] = row
+
+    def _str(row: pd.Series | None, col: str) -> str:
+        if row is None:
+            return ""
+        try:
+            v = row.get(col, "")
+        except Exception:
+            return ""
+        if pd.isna(v):
+            return ""
+        return str(v)
+
+    def _num(row: pd.Series | None, col: str, default=None):
+        if row is None:
+            return default
+        try:
+            v = row.get(col, default)
+            if pd.isna(v):
+                return default
+            return float(v)
+        except Exception:
+            return default
+
+    def classify_one(x: int) -> dict:
+        key = f"1-{int(x)}"
+        row = row_map.get(key)
+
+        hit_diff = _num(row, "想定差", None)
+        roi_diff = _num(row, "回収差", None)
+        hit_abs = abs(float(hit_diff)) if hit_diff is not None else None
+        roi_abs = abs(float(roi_diff)) if roi_diff is not None else None
+
+        if hit_abs is not None and roi_abs is not None:
+            stability_gap = round(hit_abs + roi_abs, 3)
+            # 第4枠は「足りない側」を拾う設計にする。
+            # 回収差がプラスの候補は、安定差が小さくても後追い扱いで除外する。
+            if roi_diff is not None and float(roi_diff) > 0:
+                selectable = False
+                select_reason = "＋につき除外"
+            else:
+                selectable = True
+                select_reason = "安定差計算可"
+        else:
+            stability_gap = None
+            selectable = False
+            select_reason = "差分不足"
+
+        # 表示は「元データ→最終判定値」の順にする。
+        # abs内訳は安定差の計算確認用であり、採用判定の独立条件にはしない。
+        return {
+            "第4枠": int(x),
+            "1軸相手": key,
+            "想定差": hit_diff,
+            "回収差": roi_diff,
+            "安定差": stability_gap,
+            "判定": "",
+            "選択可否": "可" if selectable else "不可",
+            "選択理由": select_reason,
+            "安定差内訳": (
+                f"abs({hit_diff}) + abs({roi_diff}) = {round(hit_abs, 3)} + {round(roi_abs, 3)} = {stability_gap}"
+                if hit_abs is not None and roi_abs is not None else "差分不足"
+            ),
+        }
+
+    candidates_all = [classify_one(x) for x in (4, 5, 6, 7)]
+    selectable = [c for c in candidates_all if c.get("選択可否") == "可"]
+
+    if selectable:
+        selectable = sorted(
+            selectable,
+            key=lambda r: (
+                float(r.get("安定差", 999999.0)),
+                int(r.get("第4枠", 9)),
+            ),
+        )
+        best = selectable[0]
+    else:
+        # 通常は「回収差0以下」が候補になる。
+        # ただし全候補がプラス、または差分不足の場合でも画面が空にならないように例外処理する。
+        calc_candidates = [c for c in candidates_all if c.get("安定差") is not None]
+        if calc_candidates:
+            best = sorted(
+                calc_candidates,
+                key=lambda r: (
+                    float(r.get("安定差", 999999.0)),
+                    int(r.get("第4枠", 9)),
+                ),
+            )[0]
+            best["選択理由"] = "全候補＋または対象外のため例外採用"
+        else:
+            fallback = next((c for c in candidates_all if int(c.get("第4枠", 0)) == 4), None)
+            if fallback is None:
+                return None
+            best = fallback
+            best["選択理由"] = "差分不足のため既定4枠"
+
+    # 採用行・除外行を候補表上で明示する。
+    best_x = int(best["第4枠"])
+    for c in candidates_all:
+        if int(c.get("第4枠", 0)) == best_x:
+            c["判定"] = "◎採用"
+            if c.get("選択可否") == "可":
+                c["選択理由"] = "回収差0以下の中で安定差最小"
+            else:
+                c["選択理由"] = c.get("選択理由") or "例外採用"
+        elif c.get("選択理由") == "＋につき除外":
+            c["判定"] = "＋につき除外"
+            c["選択理由"] = "回収差プラス"
+        elif c.get("選択可否") == "可":
+            c["判定"] = ""
+            c["選択理由"] = "比較候補"
+        else:
+            c["判定"] = ""
+            c["選択理由"] = "差分不足"
+
+    def _candidate_sort_key(r):
+        judge = str(r.get("判定", ""))
+        if judge == "◎採用":
+            rank = 0
+        elif judge == "":
+            rank = 1
+        elif judge == "＋につき除外":
+            rank = 2
+        else:
+            rank = 3
+        return (
+            rank,
+            float(r.get("安定差") if r.get("安定差") is not None else 999999.0),
+            int(r.get("第4枠", 9)),
+        )
+
+    candidates_all = sorted(candidates_all, key=_candidate_sort_key)
+
+    x = best_x
+    trio_keys = [
+        _trio_key_from_parts(1, 2, 3),
+        _trio_key_from_parts(1, 2, x),
+        _trio_key_from_parts(1, 3, x),
+        _trio_key_from_parts(2, 3, x),
+    ]
+    trio_keys = list(dict.fromkeys(trio_keys))
+
+    hit_diff_best = best.get("想定差")
+    roi_diff_best = best.get("回収差")
+    stability_detail = best.get("安定差内訳", "差分不足")
+
+    return {
+        "型": f"123{x}BOX",
+        "第4枠": x,
+        "1軸相手": best.get("1軸相手"),
+        "想定差": hit_diff_best,
+        "回収差": roi_diff_best,
+        "安定差": best.get("安定差"),
+        "安定差内訳": stability_detail,
+        "判定": "◎採用",
+        "選択理由": "回収差0以下の中で安定差最小（回収差プラスは除外）",
+        "買い目": trio_keys,
+        "candidate_rows": candidates_all,
+    }
+
+
+@perf_timed
+def build_axis1_stability_hybrid_formation_summary(
+    df_pairs: pd.DataFrame,
+    rank_total_map: Dict[int, Dict[str, int]] | None = None,
+    pair12_counts: Dict[PairKey, int] | None = None,
+) -> dict | None:
+    """
+    三連複フォーメーションを作る。
+
+    方針：
+    - 役割番号でフォーメーションを作る。
+      1 = 軸（評価1）
+      2 = 安定差1位
+      3 = 1・2を除いた評価上位
+      4 = 安定差2位
+      5 = 1・2・3・4を除いた次の評価上位
+    - 三連複は 12-123-12345（重複除外で7点）。
+    - 3連単オッズゾーンは 12→123→12345（重複除外で12点）。
+    - 2車単は 12→123（重複除外で4点）。
+    - 安定差は abs(想定差) + abs(回収差)。
+    - ここでは回収差プラス除外は使わない。
+
+    重要：
+    - オッズ帯に使う想定的中率は、当日だけの3連複実績では出さない。
+    - 小倉基準も使わない。
+    - 日々引き継いでいる「評価別3着内率」と「1→2着評価分布」を使って、
+      累積評価ベースの三連複想定的中率を作る。
+    """
+    if df_pairs is None or df_pairs.empty:
+        return None
+    if "ペアキー" not in df_pairs.columns:
+        return None
+
+    work = df_pairs.copy()
+    row_map = {}
+    for _, row in work.iterrows():
+        key = str(row.get("ペアキー", "")).strip()
+        if key:
+            row_map[key] = row
+
+    def _num(row: pd.Series | None, col: str, default=None):
+        if row is None:
+            return default
+        try:
+            v = row.get(col, default)
+            if pd.isna(v):
+                return default
+            return float(v)
+        except Exception:
+            return default
+
+    candidates = []
+    for x in range(2, FIELD_SIZE + 1):
+        key = f"1-{int(x)}"
+        row = row_map.get(key)
+        hit_diff = _num(row, "想定差", None)
+        roi_diff = _num(row, "回収差", None)
+        if hit_diff is not None and roi_diff is not None:
+            stability = round(abs(float(hit_diff)) + abs(float(roi_diff)), 3)
+        else:
+            stability = None
+        candidates.append({
+            "相手": int(x),
+            "1軸相手": key,
+            "想定差": hit_diff,
+            "回収差": roi_diff,
+            "安定差": stability,
+            "判定": "",
+            "選択理由": "差分不足" if stability is None else "比較候補",
+        })
+
+    valid = [c for c in candidates if c.get("安定差") is not None]
+    if len(valid) < 2:
+        return None
+
+    valid_sorted = sorted(
+        valid,
+        key=lambda r: (
+            float(r.get("安定差", 999999.0)),
+            int(r.get("相手", 9)),
+        ),
+    )
+
+    # =====================================================
+    # 役割番号の決定
+    # 1 = 軸（評価1）
+    # 2 = 安定差1位
+    # 3 = 1・2を除いた評価上位
+    # 4 = 安定差2位
+    # 5 = 1・2・3・4を除いた次の評価上位
+    # =====================================================
+    axis = 1
+    role2 = int(valid_sorted[0]["相手"])
+
+    role3 = None
+    for r in range(2, FIELD_SIZE + 1):
+        if r not in (axis, role2):
+            role3 = int(r)
+            break
+
+    role4 = None
+    for c in valid_sorted[1:]:
+        cand = int(c["相手"])
+        if cand not in (axis, role2, role3):
+            role4 = cand
+            break
+    if role4 is None and len(valid_sorted) >= 2:
+        role4 = int(valid_sorted[1]["相手"])
+
+    role5 = None
+    for r in range(2, FIELD_SIZE + 1):
+        if r not in (axis, role2, role3, role4):
+            role5 = int(r)
+            break
+
+    roles = [x for x in [axis, role2, role3, role4, role5] if x is not None]
+    if len(roles) < 5:
+        return None
+
+    first_mates = [axis, role2]
+    second_mates = [axis, role2, role3]
+    third_mates = [axis, role2, role3, role4, role5]
+
+    # 三連複：12-123-12345。重複除外・同一組み合わせ重複除外。
+    trio_keys = []
+    seen = set()
+    for a in first_mates:
+        for b in second_mates:
+            for c in third_mates:
+                vals = [int(a), int(b), int(c)]
+                if len(set(vals)) != 3:
+                    continue
+                key = _trio_key_from_parts(vals[0], vals[1], vals[2])
+                if key not in seen:
+                    trio_keys.append(key)
+                    seen.add(key)
+
+    if not trio_keys:
+        return None
+
+    first_code = "".join(str(x) for x in first_mates)
+    second_code = "".join(str(x) for x in second_mates)
+    third_code = "".join(str(x) for x in third_mates)
+    form_type = f"{first_code}-{second_code}-{third_code}"
+
+    role_label_map = {
+        role2: "②安定差1位",
+        role3: "③評価上位",
+        role4: "④安定差2位",
+        role5: "⑤評価上位追加",
+    }
+
+    for c in candidates:
+        x = int(c.get("相手", 0))
+        if x in role_label_map:
+            c["判定"] = role_label_map[x]
+            if x == role2:
+                c["選択理由"] = "安定差1位"
+            elif x == role3:
+                c["選択理由"] = "1・2を除いた評価上位"
+            elif x == role4:
+                c["選択理由"] = "安定差2位"
+            elif x == role5:
+                c["選択理由"] = "1・2・3・4を除いた次の評価上位"
+        elif c.get("安定差") is not None:
+            c["判定"] = ""
+            c["選択理由"] = "比較候補"
+        else:
+            c["判定"] = ""
+            c["選択理由"] = "差分不足"
+
+    def _cand_sort_key(r):
+        judge = str(r.get("判定", ""))
+        if judge.startswith("②"):
+            rank = 0
+        elif judge.startswith("③"):
+            rank = 1
+        elif judge.startswith("④"):
+            rank = 2
+        elif judge.startswith("⑤"):
+            rank = 3
+        else:
+            rank = 4
+        return (
+            rank,
+            float(r.get("安定差") if r.get("安定差") is not None else 999999.0),
+            int(r.get("相手", 9)),
+        )
+
+    candidate_rows = sorted(candidates, key=_cand_sort_key)
+
+    # =====================================================
+    # 累積評価ベースで三連複フォメの想定的中率を作る
+    # =====================================================
+    rank_total_map = rank_total_map or {}
+    pair12_counts = pair12_counts or {}
+
+    def _rank_place_rate(r: int):
+        rec = rank_total_map.get(int(r), {})
+        try:
+            n = int(rec.get("N", 0) or 0)
+            c1 = int(rec.get("C1", 0) or 0)
+            c2 = int(rec.get("C2", 0) or 0)
+            c3 = int(rec.get("C3", 0) or 0)
+        except Exception:
+            return None
+        if n <= 0:
+            return None
+        return 100.0 * (c1 + c2 + c3) / n
+
+    def _pair12_rate(a: int, b: int):
+        try:
+            a = int(a); b = int(b)
+        except Exception:
+            return None
+        total = sum(int(v) for v in pair12_counts.values())
+        if total <= 0 or a == b:
+            return None
+        hit = int(pair12_counts.get((a, b), 0)) + int(pair12_counts.get((b, a), 0))
+        return 100.0 * hit / total
+
+    axis_place = _rank_place_rate(1)
+
+    # =====================================================
+    # 三連複 12-123-12345 の累積評価ベース想定
+    # 評価別3着内率の積で、全3車組の中のフォメカバー率を推定する。
+    # =====================================================
+    all_ranks = [r for r in range(1, FIELD_SIZE + 1)]
+    place_weights = {r: (_rank_place_rate(r) or 0.0) for r in all_ranks}
+    valid_trio_sets = set()
+    for key in trio_keys:
+        vals = tuple(sorted(int(x) for x in str(key).split("-")))
+        if len(vals) == 3:
+            valid_trio_sets.add(vals)
+
+    denom = 0.0
+    numer = 0.0
+    for i, a in enumerate(all_ranks):
+        for j in range(i + 1, len(all_ranks)):
+            b = all_ranks[j]
+            for k in range(j + 1, len(all_ranks)):
+                c = all_ranks[k]
+                w = float(place_weights.get(a, 0.0)) * float(place_weights.get(b, 0.0)) * float(place_weights.get(c, 0.0))
+                denom += w
+                if tuple(sorted((a, b, c))) in valid_trio_sets:
+                    numer += w
+
+    place_cover_rate = (100.0 * numer / denom) if denom > 0 else None
+
+    # 1→2着評価分布側でも、フォメを構成する3車のうち2車が上位2着に入る頻度を見る。
+    valid_edges = set()
+    for key in trio_keys:
+        vals = [int(x) for x in str(key).split("-")]
+        for i, a in enumerate(vals):
+            for b in vals[i + 1:]:
+                valid_edges.add(tuple(sorted((int(a), int(b)))))
+
+    pair_total = sum(int(v) for v in pair12_counts.values())
+    pair_hit = 0
+    if pair_total > 0:
+        for a, b in valid_edges:
+            pair_hit += int(pair12_counts.get((a, b), 0)) + int(pair12_counts.get((b, a), 0))
+        pair_cover_rate = 100.0 * pair_hit / pair_total
+    else:
+        pair_cover_rate = None
+
+    # 三連複の想定的中率は、3着内カバーを主、1→2着分布を弱補助にする。
+    # pair_coverは「2車が上位2着に入る頻度」なので、そのままだと高く出る。
+    if place_cover_rate is not None and pair_cover_rate is not None:
+        cover_rate = 0.85 * place_cover_rate + 0.15 * pair_cover_rate
+        cumulative_hit_rate = round(max(0.0, min(100.0, cover_rate)), 1)
+    elif place_cover_rate is not None:
+        cover_rate = place_cover_rate
+        cumulative_hit_rate = round(max(0.0, min(100.0, cover_rate)), 1)
+    else:
+        cover_rate = None
+        cumulative_hit_rate = None
+
+    points = len(trio_keys)
+    invest_per_race = points * 100
+
+    if cumulative_hit_rate is not None and cumulative_hit_rate > 0:
+        breakeven_avg_pay = round(invest_per_race / (cumulative_hit_rate / 100.0), 1)
+    else:
+        breakeven_avg_pay = None
+
+    basis_n_values = []
+    for r in range(1, FIELD_SIZE + 1):
+        try:
+            n = int(rank_total_map.get(r, {}).get("N", 0) or 0)
+            if n > 0:
+                basis_n_values.append(n)
+        except Exception:
+            pass
+    basis_n = max(basis_n_values) if basis_n_values else 0
+
+    estimate_rows = []
+    for key in trio_keys:
+        vals = [int(x) for x in str(key).split("-")]
+        rates = [_rank_place_rate(v) for v in vals]
+        estimate_rows.append({
+            "買い目": key,
+            "評価1_3着内率%": round(_rank_place_rate(1), 1) if _rank_place_rate(1) is not None else None,
+            "構成評価3着内率%": " / ".join("—" if r is None else f"{r:.1f}" for r in rates),
+            "補助2車複率%": round(sum((_pair12_rate(a, b) or 0.0) for i, a in enumerate(vals) for b in vals[i + 1:]), 1),
+        })
+
+    return {
+        "型": form_type,
+        "評価1軸": 1,
+        "1列目": first_code,
+        "2列目": second_code,
+        "3列目": third_code,
+        "役割1_軸": axis,
+        "役割2_安定差1位": role2,
+        "役割3_評価上位": role3,
+        "役割4_安定差2位": role4,
+        "役割5_評価上位追加": role5,
+        "安定差上位2車": [role2, role4],
+        "評価上位追加2車": [role3, role5],
+        "買い目": trio_keys,
+        "点数": points,
+
+        # 累積評価ベース。購入判断・オッズ帯はこちらを使う。
+        "累積対象N": basis_n,
+        "評価1_3着内率%": round(axis_place, 1) if axis_place is not None else None,
+        "相手3着内カバー率%": round(place_cover_rate, 1) if place_cover_rate is not None else None,
+        "2車複カバー率%": round(pair_cover_rate, 1) if pair_cover_rate is not None else None,
+        "合成カバー率%": round(cover_rate, 1) if cover_rate is not None else None,
+        "累積評価ベース想定的中率%": cumulative_hit_rate,
+        "100%必要平均払戻": breakeven_avg_pay,
+        "累積評価ベース買い目別": estimate_rows,
+
+        # 既存表示との互換用。中身は小倉基準でも本日実績でもなく、累積評価ベース。
+        "想定的中率%": cumulative_hit_rate,
+        "基準平均配当": None,
+        "想定回収率%": None,
+
+        "選択理由": "役割番号：1=軸、2=安定差1位、3=1・2を除いた評価上位、4=安定差2位、5=次の評価上位。三連複は12-123-12345。オッズ帯は累積評価別3着内率と1→2着評価分布から算出。",
+        "candidate_rows": candidate_rows,
+    }
+
+
+# =========================
+# 集計エンジン（byrace_rowsを1回だけ走査）
+# =========================
+# 2車単：1→2 / 1着と3着組み合わせ
+INDIVIDUAL_PAIRS = [(1, target) for target in INDIVIDUAL_AXIS1_TARGETS]
+NISHAFUKU_PAIR_SET = {tuple(sorted((int(a), int(b)))) for a, b in NISHAFUKU_PAIRS}
+TRIO_USED_KEY_RANK_SETS = {k: {int(x) for x in k.split("-")} for k in TRIO_USED_KEYS}
+
+
+# -------------------------
+# 着順カウントテンソル（評価別・1→2・1-3・2-3表の元データ）
+# -------------------------
+# 軸は [頭数, 1着評価, 2着評価, 3着評価]。
+# 着順軸の 0 は「着順入力なし」、FIELD_SIZE+1 は「出走表外の車」。
+# 頭数軸はV評価の桁数（入力検証で頭数と一致させている）で、0は未使用。
+# 2次元表・評価別テーブルは全部このテンソルの周辺和として作るので、
+# 日次・履歴の合算は配列の足し算1回で済む。
+FINISH_RANK_NONE = 0
+FINISH_RANK_OFF = FIELD_SIZE + 1
+FINISH_TENSOR_SHAPE = (FIELD_SIZE + 1, FIELD_SIZE + 2, FIELD_SIZE + 2, FIELD_SIZE + 2)
+_KNOWN = slice(1, FIELD_SIZE + 1)
+
+
+def new_finish_tensor() -> np.ndarray:
+    return np.zeros(FINISH_TENSOR_SHAPE, dtype=np.int64)
+
+
+def finish_tensor_index(norm: Dict) -> Tuple[int, int, int, int]:
+    """正規化済みレースのテンソル上の位置。"""
+    n = int(norm["n_ranked"])
+    if not 0 <= n <= FIELD_SIZE:
+        n = 0
+    idx = [n]
+    finish_ranks = tuple(norm["finish_ranks"])
+    for pos in range(3):
+        if pos >= len(finish_ranks):
+            idx.append(FINISH_RANK_NONE)
+        elif finish_ranks[pos] is None or int(finish_ranks[pos]) > FIELD_SIZE:
+            idx.append(FINISH_RANK_OFF)
+        else:
+            idx.append(int(finish_ranks[pos]))
+    return tuple(idx)
+
+
+def pair_counts_from_tensor(tensor: np.ndarray, kind: str) -> Dict[PairKey, int]:
+    """
+    1→2（"12"）・1着-3着（"13"）・2着-3着（"23"）の回数表をテンソルから作る。
+
+    旧ループと同じく、1着・2着が出走表内のレースだけを対象にする
+    （1-3・2-3はさらに3着が出走表内のもの）。
+    """
+    top2 = tensor[:, _KNOWN, _KNOWN, :]
+    if kind == "12":
+        mat = top2.sum(axis=(0, 3))
+    elif kind == "13":
+        mat = top2[:, :, :, _KNOWN].sum(axis=(0, 2))
+    elif kind == "23":
+        mat = top2[:, :, :, _KNOWN].sum(axis=(0, 1))
+    else:
+        raise ValueError(f"unknown pair kind: {kind}")
+
+    out: Dict[PairKey, int] = defaultdict(int)
+    for i, j in zip(*np.nonzero(mat)):
+        out[(int(i) + 1, int(j) + 1)] = int(mat[i, j])
+    return out
+
+
+def rank_counts_from_tensor(tensor: np.ndarray) -> Dict[int, Dict[str, int]]:
+    """
+    評価別 入賞テーブル（N/C1/C2/C3）をテンソルから作る。
+    Nは「その評価が存在したレース数」＝頭数軸が r 以上のレース数。
+    """
+    races_by_n = tensor.sum(axis=(1, 2, 3))
+    n_at_least = np.cumsum(races_by_n[::-1])[::-1]
+    c1 = tensor.sum(axis=(0, 2, 3))
+    c2 = tensor.sum(axis=(0, 1, 3))
+    c3 = tensor.sum(axis=(0, 1, 2))
+    return {
+        r: {"N": int(n_at_least[r]), "C1": int(c1[r]), "C2": int(c2[r]), "C3": int(c3[r])}
+        for r in range(1, FIELD_SIZE + 1)
+    }
+
+
+def trio_hit_counts_from_tensor(tensor: np.ndarray, keys: List[str], min_field_n: int = 4) -> Dict[str, int]:
+    """
+    三連複の買い目（評価順位キーの集合）の実着順の的中数をテンソルから数える。
+
+    対象Nは頭数 min_field_n 以上で着順3つ入力済みのレース
+    （日次の payout_trio_* と同じ条件）。出走表外の車が絡めば外れ。
+    """
+    key_sets = {frozenset(int(x) for x in k.split("-")) for k in keys}
+    sub = tensor[int(min_field_n):]
+    n = int(sub[:, :, :, FINISH_RANK_NONE + 1:].sum())
+    known = sub[:, _KNOWN, _KNOWN, _KNOWN].sum(axis=0)
+    h = 0
+    for i, j, k in zip(*np.nonzero(known)):
+        if frozenset((int(i) + 1, int(j) + 1, int(k) + 1)) in key_sets:
+            h += int(known[i, j, k])
+    return {"N": n, "KSUM": n * len(keys), "H": h}
+
+
+@perf_timed
+def trio_exact_vs_estimate_rows(
+    tensor: np.ndarray,
+    pair12_counts: Dict[PairKey, int],
+    rank_counts: Dict[int, Dict[str, int]],
+) -> List[Dict]:
+    """
+    123-123-4 / 124-124-3 三連複3点の実着順の的中率（テンソル）と、
+    1→2表＋評価別3着回数からの按分推定を並べる。
+    """
+    rows = []
+    for label, keys, estimate in (
+        (TRIO_1231234_LABEL, TRIO_1231234_KEYS, estimate_trio_1231234_from_pair12_and_rank),
+        (TRIO_1241243_LABEL, TRIO_1241243_KEYS, estimate_trio_1241243_from_pair12_and_rank),
+    ):
+        exact = trio_hit_counts_from_tensor(tensor, keys)
+        est = estimate(pair12_counts, rank_counts)
+        rows.append({
+            "型": label,
+            "構成": " / ".join(keys),
+            "実着順N": exact["N"],
+            "実的中H": exact["H"],
+            "実的中率%": round(100.0 * exact["H"] / exact["N"], 1) if exact["N"] > 0 else None,
+            "推定N": est["対象N"],
+            "推定H": est["推定H"],
+            "推定的中率%": est["推定的中率%"],
+        })
+    return rows
+
+
+
+# -------------------------
+# レース単位のポートフォリオ評価（着順分布×買い目）
+# -------------------------
+# 同じレースの2車複・3連複は同じ着順で一緒に当たる・外れるので、
+# 1点ずつのEVを足し合わせても収支のばらつきや負ける確率は出ない。
+# ここでは累積テンソルの着順分布（評価順位の1着・2着・3着）を全列挙し、
+# 「着順×買い目」の払戻行列を1回作って、買い目の組み合わせを行列積で評価する。
+PORTFOLIO_BET_TYPES = ("2車複", "2車単", "ワイド", "3連複")
+
+
+def race_outcome_distribution(tensor: np.ndarray, field_n: int, prior: float = 0.0) -> Dict:
+    """
+    頭数 field_n のレースの着順分布を累積テンソルから作る。
+
+    着順は評価順位の (1着, 2着, 3着)。出走表外の車は FINISH_RANK_OFF として着順ごとに別の行で持つ
+    （例：(1, 2, OFF) は3着だけ出走表外）。評価順位の買い目は OFF と一致しないので、
+    3着だけ出走表外なら2車複・2車単の1-2や、1・2が入ったワイドは当たりとして数える。
+    着順入力が3着まで揃ったレースだけを数える。
+    prior：出走表内の各順列に足す擬似回数（実績の少ない頭数で0確率の着順を作らないため）。
+    """
+    n = int(field_n)
+    if not 3 <= n <= FIELD_SIZE:
+        raise ValueError(f"field_n must be 3..{FIELD_SIZE}: {field_n}")
+    sub = np.asarray(tensor)[n]
+    ranks = np.append(np.arange(1, n + 1), FINISH_RANK_OFF)
+    w, s, t = np.meshgrid(ranks, ranks, ranks, indexing="ij")
+    # 出走表内の順位は重ならない。OFF（出走表外の車）は2頭以上いてもよい。
+    valid = (
+        ((w != s) | (w == FINISH_RANK_OFF))
+        & ((w != t) | (w == FINISH_RANK_OFF))
+        & ((s != t) | (s == FINISH_RANK_OFF))
+    )
+    outcomes = np.stack([w[valid], s[valid], t[valid]], axis=1)
+
+    counts = sub[outcomes[:, 0], outcomes[:, 1], outcomes[:, 2]].astype(np.float64)
+    entered = int(counts.sum())
+    in_field = (outcomes != FINISH_RANK_OFF).all(axis=1)
+    counts = counts + float(prior) * in_field
+
+    total = counts.sum()
+    p = counts / total if total > 0 else np.zeros(len(counts))
+    return {"field_n": n, "N": entered, "outcomes": outcomes, "p": p}
+
+
+def _ticket_ranks(key) -> List[int]:
+    return [int(x) for x in str(key).replace("→", "-").split("-") if str(x).strip()]
+
+
+def ticket_hit_matrix(outcomes: np.ndarray, tickets: List[Tuple[str, str]]) -> np.ndarray:
+    """
+    着順×買い目の的中行列（bool, 着順数×買い目数）。
+
+    tickets は (券種, 評価順位キー) の並び。2車単は書いた順（"1→2" / "1-2"）を着順とみなす。
+    出走表外（FINISH_RANK_OFF）の着はどの評価順位とも一致しないので、分かっている着だけで判定される。
+    """
+    w, s, t = outcomes[:, 0], outcomes[:, 1], outcomes[:, 2]
+    hit = np.zeros((len(outcomes), len(tickets)), dtype=bool)
+    for j, (bet_type, key) in enumerate(tickets):
+        r = _ticket_ranks(key)
+        if bet_type == "2車複" and len(r) == 2:
+            hit[:, j] = ((w == r[0]) & (s == r[1])) | ((w == r[1]) & (s == r[0]))
+        elif bet_type == "2車単" and len(r) == 2:
+            hit[:, j] = (w == r[0]) & (s == r[1])
+        elif bet_type == "ワイド" and len(r) == 2:
+            in_top3 = [(w == x) | (s == x) | (t == x) for x in r]
+            hit[:, j] = in_top3[0] & in_top3[1]
+        elif bet_type == "3連複" and len(r) == 3:
+            hit[:, j] = np.isin(w, r) & np.isin(s, r) & np.isin(t, r)
+        else:
+            raise ValueError(f"unsupported ticket: {bet_type} {key}")
+    return hit
+
+
+def ticket_payoff_matrix(dist: Dict, tickets: List[Tuple[str, str]], odds) -> np.ndarray:
+    """
+    着順×買い目の払戻行列（1円あたりの払戻＝的中ならオッズ、外れなら0）。
+
+    odds は買い目と同じ順のオッズ。買い目の組み合わせを何通り評価しても、
+    この行列は1レースにつき1回作ればよい。
+    """
+    odds_arr = np.asarray([_safe_float(x, np.nan) for x in odds], dtype=np.float64)
+    if len(odds_arr) != len(tickets):
+        raise ValueError("odds must have the same length as tickets")
+    if np.any(~(odds_arr > 0)):
+        missing = [f"{tickets[j][0]} {tickets[j][1]}" for j in np.nonzero(~(odds_arr > 0))[0]]
+        raise ValueError(f"odds missing: {', '.join(missing)}")
+    return ticket_hit_matrix(dist["outcomes"], tickets) * odds_arr
+
+
+def evaluate_portfolios(dist: Dict, payoff: np.ndarray, stakes) -> Dict[str, np.ndarray]:
+    """
+    買い目の組み合わせ（賭け金ベクトル）ごとの収支分布の要約。
+
+    stakes：賭け金（円）。買い目数の1次元なら1通り、(組数, 買い目数) なら組ごと。
+    返り値は組ごとの配列：投資・期待払戻・RaceEV（期待払戻/投資）・期待収支・
+    標準偏差・損失確率（収支<0）・的中確率（払戻>0）。
+    """
+    p = dist["p"]
+    S = np.atleast_2d(np.asarray(stakes, dtype=np.float64))
+    invest = S.sum(axis=1)
+    ret = payoff @ S.T                       # 着順×組
+    net = ret - invest
+    mean_ret = p @ ret
+    mean_net = mean_ret - invest
+    var = np.maximum(0.0, p @ (net * net) - mean_net * mean_net)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        race_ev = np.where(invest > 0, mean_ret / invest, np.nan)
+    return {
+        "投資": invest,
+        "期待払戻": mean_ret,
+        "RaceEV": race_ev,
+        "期待収支": mean_net,
+        "標準偏差": np.sqrt(var),
+        "損失確率": p @ (net < -1e-9),
+        "的中確率": p @ (ret > 0),
+    }
+
+
+def race_portfolio_summary(
+    df: pd.DataFrame,
+    dist: Dict,
+    stake_col: str = "stake",
+    odds_col: str = "odds",
+    bet_type_col: str = "券種",
+    key_col: str = "目",
+) -> dict:
+    """
+    選ばれた買い目群を1つのポートフォリオとして評価する（race_ev_summary の重なり考慮版）。
+
+    df は1行1買い目（券種・目・オッズ・賭け金）。目がなければペアキーを使う。
+    同じ着順で同時に当たる買い目は、払戻がその着順の収支にまとめて入る。
+    """
+    empty = {"RaceEV": None, "期待収支": None, "標準偏差": None, "損失確率%": None,
+             "的中確率%": None, "総点数": 0, "投資額": 0}
+    if df is None or df.empty:
+        return empty
+    keys = df[key_col] if key_col in df.columns else df.get("ペアキー")
+    if keys is None or bet_type_col not in df.columns or odds_col not in df.columns:
+        return empty
+    stakes = _num_column(df, stake_col) if stake_col in df.columns else np.full(len(df), 100.0)
+    stakes = np.nan_to_num(stakes, nan=0.0)
+    use = stakes > 0
+    if not use.any():
+        return empty
+
+    tickets = [(str(b), str(k)) for b, k in zip(df[bet_type_col][use], keys[use])]
+    payoff = ticket_payoff_matrix(dist, tickets, df[odds_col][use].tolist())
+    st = evaluate_portfolios(dist, payoff, stakes[use])
+    return {
+        "RaceEV": round(float(st["RaceEV"][0]), 3),
+        "期待収支": round(float(st["期待収支"][0]), 1),
+        "標準偏差": round(float(st["標準偏差"][0]), 1),
+        "損失確率%": round(100.0 * float(st["損失確率"][0]), 1),
+        "的中確率%": round(100.0 * float(st["的中確率"][0]), 1),
+        "総点数": int(use.sum()),
+        "投資額": int(stakes[use].sum()),
+    }
+
+
+
+# -------------------------
+# 賭け金の配分（100円単位・レース上限・日上限）
+# -------------------------
+# 買い目ごとに100円ずつ、目的関数が一番伸びる所へ積み増していく（貪欲法）。
+# 目的関数は「期待対数成長（ケリー）」か「期待収支」。どちらも上の払戻行列で
+# 着順ごとの収支を直接見るので、同じ着順で同時に当たる買い目の重なりも入る。
+# 貪欲法なので、離散の賭け金での最適解になる保証はない（良い近似解を手早く出すためのもの）。
+# リスク上限（損失確率・標準偏差）は1単位ごとではなく、レースの配分全体に掛ける。
+STAKE_UNIT_YEN = 100
+STAKE_OBJECTIVES = ("log", "ev")
+
+
+def _new_stake_state(dist: Dict, payoff: np.ndarray) -> Dict:
+    return {
+        "p": dist["p"],
+        "payoff": payoff,
+        "stakes": np.zeros(payoff.shape[1], dtype=np.float64),
+        "ret": np.zeros(payoff.shape[0], dtype=np.float64),
+        "invest": 0.0,
+        "steps": [],
+        "ok_steps": 0,
+        "frozen": False,
+    }
+
+
+def _add_stake_unit(state: Dict, j: int, unit: float) -> None:
+    state["stakes"][j] += unit
+    state["ret"] = state["ret"] + unit * state["payoff"][:, j]
+    state["invest"] += unit
+    state["steps"].append(j)
+
+
+def _stake_within_caps(state: Dict, max_loss_prob: float | None, max_std: float | None) -> bool:
+    """いまのレース配分全体が損失確率・標準偏差の上限に収まっているか。"""
+    p = state["p"]
+    net = state["ret"] - state["invest"]
+    if max_loss_prob is not None and p @ (net < -1e-9) > float(max_loss_prob) + 1e-12:
+        return False
+    if max_std is not None:
+        mean = p @ net
+        if np.sqrt(max(0.0, p @ (net * net) - mean * mean)) > float(max_std):
+            return False
+    return True
+
+
+def _rollback_stakes(state: Dict, unit: float) -> float:
+    """上限に収まっていた最後の配分まで戻し、戻した額を返す。"""
+    steps = state["steps"][:state["ok_steps"]]
+    refund = state["invest"] - unit * len(steps)
+    state["stakes"][:] = 0.0
+    state["ret"] = np.zeros_like(state["ret"])
+    state["invest"] = 0.0
+    state["steps"] = []
+    for j in steps:
+        _add_stake_unit(state, j, unit)
+    return refund
+
+
+def _stake_objective(p: np.ndarray, net: np.ndarray, bankroll: float, objective: str) -> np.ndarray:
+    """着順ごとの収支 net（着順数、または着順×候補）の目的関数値。"""
+    if objective == "ev":
+        return p @ net
+    live = p > 0
+    with np.errstate(divide="ignore"):
+        logw = np.log(np.maximum(bankroll + net[live], 0.0))
+    return p[live] @ logw
+
+
+def _best_stake_step(
+    state: Dict,
+    unit: float,
+    bankroll: float,
+    objective: str,
+) -> Tuple[int, float]:
+    """1単位積み増したときに一番伸びる買い目と伸び幅。積み増せなければ (-1, -inf)。"""
+    p, payoff = state["p"], state["payoff"]
+    if state["frozen"] or payoff.shape[1] == 0:
+        return -1, -np.inf
+    net_now = state["ret"] - state["invest"]
+    net_cand = net_now[:, None] + unit * (payoff - 1.0)          # 着順×買い目
+    gain = _stake_objective(p, net_cand, bankroll, objective) - _stake_objective(p, net_now, bankroll, objective)
+    ok = np.isfinite(gain)
+    if not ok.any():
+        return -1, -np.inf
+    gain = np.where(ok, gain, -np.inf)
+    j = int(np.argmax(gain))
+    return j, float(gain[j])
+
+
+def optimize_card_stakes(
+    races: List[Dict],
+    bankroll: float,
+    day_budget: float,
+    race_budget: float | None = None,
+    objective: str = "log",
+    max_loss_prob: float | None = None,
+    max_std: float | None = None,
+    unit: float = STAKE_UNIT_YEN,
+    min_gain: float = 0.0,
+) -> List[np.ndarray]:
+    """
+    1日分のレースに賭け金を配分する（レースごとの賭け金ベクトルを返す）。
+
+    races：レースごとの {"dist": 着順分布, "payoff": 払戻行列}。
+    objective："log" は bankroll に対する期待対数成長、"ev" は期待収支を最大にする。
+    max_loss_prob / max_std：レースごとの損失確率・収支の標準偏差の上限（リスク上限）。
+    1単位積み増すたびに、全レースの中で一番伸びる買い目を選ぶ。伸びが min_gain 以下になるか、
+    日上限・レース上限に届いたら止める。レース間は独立とみなして目的関数を足す。
+    リスク上限はレースの配分全体に掛ける。途中の配分が上限を超えていても積み増しは続け、
+    止まった時点で上限を超えているレースは、上限に収まっていた最後の配分まで戻して固定し、
+    浮いた予算で残りのレースの積み増しを続ける。貪欲法なので最適解の保証はない。
+    """
+    if objective not in STAKE_OBJECTIVES:
+        raise ValueError(f"unknown objective: {objective}")
+    unit = float(unit)
+    day_budget = float(day_budget)
+    race_budget = day_budget if race_budget is None else float(race_budget)
+    states = [_new_stake_state(r["dist"], r["payoff"]) for r in races]
+    best = [_best_stake_step(st, unit, bankroll, objective) for st in states]
+    spent = 0.0
+
+    while True:
+        while spent + unit <= day_budget + 1e-9:
+            order = sorted(range(len(states)), key=lambda i: best[i][1], reverse=True)
+            pick = next((i for i in order if states[i]["invest"] + unit <= race_budget + 1e-9), None)
+            if pick is None or not best[pick][1] > float(min_gain):
+                break
+            st = states[pick]
+            _add_stake_unit(st, best[pick][0], unit)
+            if _stake_within_caps(st, max_loss_prob, max_std):
+                st["ok_steps"] = len(st["steps"])
+            spent += unit
+            best[pick] = _best_stake_step(st, unit, bankroll, objective)
+
+        over = [i for i, st in enumerate(states) if st["ok_steps"] < len(st["steps"])]
+        if not over:
+            break
+        for i in over:
+            spent -= _rollback_stakes(states[i], unit)
+            states[i]["frozen"] = True
+            best[i] = (-1, -np.inf)
+
+    return [st["stakes"] for st in states]
+
+
+def formation_candidates(summary: Dict | None, bet_type: str, odds: Dict[str, float] | None = None) -> pd.DataFrame:
+    """
+    フォーメーション候補（build_*_formation_summary の返り値）を賭け金配分の候補表にする。
+
+    odds は買い目キー→現在オッズ。分からない買い目は odds 欠損のまま（配分対象外）。
+    """
+    keys = list((summary or {}).get("買い目") or [])
+    odds = odds or {}
+    return pd.DataFrame({
+        "券種": [bet_type] * len(keys),
+        "目": keys,
+        "odds": [odds.get(k) for k in keys],
+    }, columns=["券種", "目", "odds"])
+
+
+def allocate_card_stakes(
+    cards: Dict[str, pd.DataFrame],
+    dists: Dict[str, Dict],
+    bankroll: float,
+    day_budget: float,
+    race_budget: float | None = None,
+    objective: str = "log",
+    max_loss_prob: float | None = None,
+    max_std: float | None = None,
+    odds_col: str = "odds",
+    unit: float = STAKE_UNIT_YEN,
+) -> Dict[str, pd.DataFrame]:
+    """
+    レースID→候補表（券種・目/ペアキー・オッズ）に賭け金列 stake を付けて返す。
+
+    候補表は calculate_ev_metrics の出力や formation_candidates の出力をそのまま使える。
+    odds_col の列がなければ参考odds（平均配当からの参考値）を使う。
+    オッズが無い・対応していない券種の候補は stake 0 のまま残す。
+    """
+    race_ids = [rid for rid in cards if rid in dists]
+    inputs, used = [], {}
+    for rid in race_ids:
+        df = cards[rid]
+        col = odds_col if odds_col in df.columns else "参考odds"
+        keys = df["目"] if "目" in df.columns else df.get("ペアキー")
+        use = np.zeros(len(df), dtype=bool)
+        tickets, odds = [], []
+        if keys is not None and "券種" in df.columns and col in df.columns:
+            for i, (b, k, o) in enumerate(zip(df["券種"], keys, df[col])):
+                o = _safe_float(o, None)
+                if b in PORTFOLIO_BET_TYPES and o is not None and o > 0 and k is not None:
+                    use[i] = True
+                    tickets.append((str(b), str(k)))
+                    odds.append(o)
+        dist = dists[rid]
+        inputs.append({"dist": dist, "payoff": ticket_payoff_matrix(dist, tickets, odds)})
+        used[rid] = use
+
+    stakes = optimize_card_stakes(
+        inputs, bankroll, day_budget, race_budget=race_budget, objective=objective,
+        max_loss_prob=max_loss_prob, max_std=max_std, unit=unit,
+    )
+    out = {}
+    for rid, s in zip(race_ids, stakes):
+        df = cards[rid].copy()
+        col = np.zeros(len(df), dtype=np.int64)
+        col[used[rid]] = s.astype(np.int64)
+        df["stake"] = col
+        out[rid] = df
+    return out
+
+
+def normalize_race(row: Dict) -> Dict | None:
+    """
+    1レースを評価順位ベースに正規化する。
+
+    car_to_rank はここで1回だけ作り、着順を評価順位（出走表外の車はNone）へ置き換える。
+    V評価がないレースはどの集計にも使わないのでNoneを返す。
+    """
+    vorder = row.get("vorder", []) or []
+    finish = row.get("finish", []) or []
+    if not vorder:
+        return None
+    try:
+        field_n = int(row.get("field_n", len(vorder) or 0))
+    except Exception:
+        field_n = 0
+
+    car_to_rank = {car: i + 1 for i, car in enumerate(vorder)}
+
+    def _pay(key: str) -> int:
+        try:
+            return int(row.get(key, 0) or 0)
+        except Exception:
+            return 0
+
+    return {
+        "race": row.get("race"),
+        "field_n": field_n,
+        "n_ranked": len(vorder),
+        "finish_ranks": tuple(car_to_rank.get(car) for car in finish[:3]),
+        "pay_2t": _pay("pay_2t"),
+        "pay_2f": _pay("pay_2f"),
+        "pay_3f": _pay("pay_3f"),
+    }
+
+
+def new_daily_aggregates() -> Dict:
+    """日次集計のアキュムレータ一式。キーは旧ループの変数名に対応。"""
+    payout_nishafuku = {nishafuku_label(a, b): new_payout_rec() for a, b in NISHAFUKU_PAIRS}
+    for a, b in NISHAFUKU_EXTRA_PAIRS:
+        payout_nishafuku[nishafuku_label(a, b)] = new_payout_rec()
+    return {
+        # 評価別・1→2・1-3・2-3 はこのテンソルから周辺和で作る。
+        "finish_tensor": new_finish_tensor(),
+        "payout_2t_pattern": {axis: new_payout_rec() for axis in PATTERN_AXES},
+        "payout_axis_target": {pair: new_payout_rec() for pair in INDIVIDUAL_PAIRS},
+        "payout_nishafuku": payout_nishafuku,
+        "payout_nishafuku_3412": {NISHAFUKU_3412_LABEL: new_payout_rec()},
+        "payout_trio_1231234": {TRIO_1231234_LABEL: new_payout_rec()},
+        "payout_trio_1241243": {TRIO_1241243_LABEL: new_payout_rec()},
+        "payout_sanrenpuku12_all": {"仮想全体": new_payout_rec()},
+        "payout_sanrenpuku12_individual": {"仮想全体": {k: new_payout_rec() for k in TRIO_USED_KEYS}},
+        # 2車複ゾーン中央値用。NISHAFUKU_PAIRSの的中払戻をゾーン別スケッチに貯める。
+        "zone_sketches": new_zone_sketches(),
+    }
+
+
+def _add_nishafuku_hit(rec: Dict[str, int], pay_2f: int, sign: int = 1) -> None:
+    if pay_2f > 0:
+        rec["H"] += sign
+        rec["SUM"] += sign * pay_2f
+        zkey = payout_zone_key(pay_2f)
+        if zkey:
+            rec[zkey] += sign
+
+
+def accumulate_race(agg: Dict, norm: Dict, sign: int = 1) -> None:
+    """
+    正規化済みの1レースを全アキュムレータへ1回で反映する。sign=-1 で反映を取り消す。
+
+    各ブロックの対象条件は旧来の個別ループと同じ：
+      ・着順テンソル：V評価があれば対象（評価別・2次元表はここから作る）
+      ・1→2着系（2車単・2車複・34-12・ゾーン）：1着・2着が出走表内
+      ・三連複系：着順3つ以上（評価順位の欠けは的中判定側で外れ扱い）
+    """
+    field_n = int(norm["field_n"])
+    finish_ranks = norm["finish_ranks"]
+
+    agg["finish_tensor"][finish_tensor_index(norm)] += sign
+
+    if len(finish_ranks) >= 2 and finish_ranks[0] is not None and finish_ranks[1] is not None:
+        _accumulate_top2(agg, norm, int(finish_ranks[0]), int(finish_ranks[1]), sign)
+
+    if len(finish_ranks) >= 3 and field_n > 0:
+        _accumulate_trio(agg, norm, sign)
+
+
+def _accumulate_top2(agg: Dict, norm: Dict, win_rank: int, sec_rank: int, sign: int = 1) -> None:
+    """1着・2着の評価順位が分かるレースの集計。"""
+    field_n = int(norm["field_n"])
+    if field_n <= 0:
+        return
+
+    pay_2t = int(norm["pay_2t"])
+    pay_2f = int(norm["pay_2f"])
+
+    # 2車単：1→23
+    for axis in PATTERN_AXES:
+        ksum = ksum_2t_pattern(axis, field_n)
+        if ksum <= 0:
+            continue
+        rec = agg["payout_2t_pattern"][axis]
+        rec["N"] += sign
+        rec["KSUM"] += sign * ksum
+        if hit_2t_pattern(axis, win_rank, sec_rank, field_n) and pay_2t > 0:
+            rec["H"] += sign
+            rec["SUM"] += sign * pay_2t
+
+    # 2車単：1→2 / 1→3
+    for axis, target in INDIVIDUAL_PAIRS:
+        ksum = ksum_axis_to_target(axis, target, field_n)
+        if ksum <= 0:
+            continue
+        rec = agg["payout_axis_target"][(axis, target)]
+        rec["N"] += sign
+        rec["KSUM"] += sign * ksum
+        if hit_axis_to_target(axis, target, win_rank, sec_rank, field_n) and pay_2t > 0:
+            rec["H"] += sign
+            rec["SUM"] += sign * pay_2t
+
+    # 個別2車複
+    for a, b in list(NISHAFUKU_PAIRS) + list(NISHAFUKU_EXTRA_PAIRS):
+        ksum = ksum_nishafuku_pair(a, b, field_n)
+        if ksum <= 0:
+            continue
+        rec = agg["payout_nishafuku"][nishafuku_label(a, b)]
+        rec["N"] += sign
+        rec["KSUM"] += sign * ksum
+        if hit_nishafuku_pair(a, b, win_rank, sec_rank, field_n):
+            _add_nishafuku_hit(rec, pay_2f, sign)
+
+    # 34-12 2車複フォメ
+    ksum = ksum_nishafuku_3412(field_n)
+    if ksum > 0:
+        rec = agg["payout_nishafuku_3412"][NISHAFUKU_3412_LABEL]
+        rec["N"] += sign
+        rec["KSUM"] += sign * ksum
+        if hit_nishafuku_3412(win_rank, sec_rank, field_n):
+            _add_nishafuku_hit(rec, pay_2f, sign)
+
+    # ゾーン中央値用の実払戻（NISHAFUKU_PAIRSの的中分だけ）
+    if pay_2f > 0 and tuple(sorted((win_rank, sec_rank))) in NISHAFUKU_PAIR_SET:
+        zkey = payout_zone_key(pay_2f)
+        if zkey in agg["zone_sketches"]:
+            payout_sketch_add(agg["zone_sketches"][zkey], pay_2f, sign)
+
+
+def _accumulate_trio(agg: Dict, norm: Dict, sign: int = 1) -> None:
+    """着順3つ以上のレースの三連複系集計。三連複は配当入力なしなので的中Hだけ。"""
+    field_n = int(norm["field_n"])
+    finish_ranks = norm["finish_ranks"]
+    all_known = all(x is not None for x in finish_ranks)
+    finish_rank_set = set(finish_ranks)
+
+    # 123-123-4 / 124-124-3 三連複3点
+    if field_n >= 4:
+        rec = agg["payout_trio_1231234"][TRIO_1231234_LABEL]
+        rec["N"] += sign
+        rec["KSUM"] += sign * len(TRIO_1231234_KEYS)
+        if all_known and _trio_1231234_is_hit_ranks(finish_ranks):
+            rec["H"] += sign
+
+        rec = agg["payout_trio_1241243"][TRIO_1241243_LABEL]
+        rec["N"] += sign
+        rec["KSUM"] += sign * len(TRIO_1241243_KEYS)
+        if all_known and _trio_1241243_is_hit_ranks(finish_ranks):
+            rec["H"] += sign
+
+    # 3連複 1-2-全
+    ksum = ksum_sanrenpuku_12_all(field_n)
+    if ksum <= 0:
+        return
+    rec_all = agg["payout_sanrenpuku12_all"]["仮想全体"]
+    rec_all["N"] += sign
+    rec_all["KSUM"] += sign * ksum
+    if {1, 2}.issubset(finish_rank_set):
+        rec_all["H"] += sign
+
+    # 3連複 個別（実運用対象の1・2絡みだけ、存在する評価ごとに毎回1点仮想購入）
+    for key in TRIO_USED_KEYS:
+        one_ksum = ksum_sanrenpuku_key(key, field_n)
+        if one_ksum <= 0:
+            continue
+        rec_ind = agg["payout_sanrenpuku12_individual"]["仮想全体"][key]
+        rec_ind["N"] += sign
+        rec_ind["KSUM"] += sign * one_ksum
+        if TRIO_USED_KEY_RANK_SETS[key].issubset(finish_rank_set):
+            rec_ind["H"] += sign
+
+
+def aggregate_byrace_rows(byrace_rows: List[Dict]) -> Dict:
+    """byrace_rowsを1回だけ走査して、日次集計を全部まとめて作る。"""
+    agg = new_daily_aggregates()
+    for row in byrace_rows or []:
+        norm = normalize_race(row)
+        if norm is not None:
+            accumulate_race(agg, norm)
+    return agg
+
+
+# -------------------------
+# 日次集計の差分更新（再実行間の持ち越し）
+# -------------------------
+# 画面は操作のたびに全体を再実行する。日次集計は部分和なので、前回の集計を持ち越し、
+# 変わったR（追加・変更・削除）だけ accumulate_race(sign=±1) で足し引きする。
+# 同じRが複数行ある場合は出現順で区別する。
+def _daily_agg_layout() -> tuple:
+    """集計の器の形。定数を変えてコードを再読込したときに、持ち越しを捨てる判定に使う。"""
+    return (
+        FINISH_TENSOR_SHAPE,
+        tuple(PATTERN_AXES),
+        tuple(INDIVIDUAL_PAIRS),
+        tuple(NISHAFUKU_PAIRS),
+        tuple(NISHAFUKU_EXTRA_PAIRS),
+        tuple(TRIO_USED_KEYS),
+        tuple(ZONE_KEYS_ORDER),
+    )
+
+
+def new_incremental_daily_state() -> Dict:
+    """{"agg": 日次集計, "races": {(R, 出現順): (行の内容, 正規化済み)}, "layout": 器の形}"""
+    return {"agg": new_daily_aggregates(), "races": {}, "layout": _daily_agg_layout()}
+
+
+def _race_row_signature(row: Dict) -> tuple:
+    return (
+        row.get("field_n"),
+        tuple(row.get("vorder", []) or []),
+        tuple(row.get("finish", []) or []),
+        row.get("pay_2t", 0),
+        row.get("pay_2f", 0),
+        row.get("pay_3f", 0),
+    )
+
+
+@perf_timed
+def update_incremental_daily(state: Dict, byrace_rows: List[Dict]) -> Dict[str, int]:
+    """
+    state["agg"] を byrace_rows と同じ内容に差分で合わせる。
+
+    結果は aggregate_byrace_rows(byrace_rows) と一致する。
+    戻り値は {"追加": 足したR数, "取消": 引いたR数, "据置": 変更なしのR数}。
+    """
+    if state.get("layout") != _daily_agg_layout():
+        state.clear()
+        state.update(new_incremental_daily_state())
+
+    current: Dict[tuple, Dict] = {}
+    seen: Dict[str, int] = defaultdict(int)
+    for row in byrace_rows or []:
+        rid = str(row.get("race"))
+        current[(rid, seen[rid])] = row
+        seen[rid] += 1
+
+    agg = state["agg"]
+    races = state["races"]
+    removed = 0
+    for key in list(races):
+        sig, norm = races[key]
+        row = current.get(key)
+        if row is not None and _race_row_signature(row) == sig:
+            continue
+        if norm is not None:
+            accumulate_race(agg, norm, -1)
+        del races[key]
+        removed += 1
+
+    added = 0
+    for key, row in current.items():
+        if key in races:
+            continue
+        norm = normalize_race(row)
+        if norm is not None:
+            accumulate_race(agg, norm, 1)
+        races[key] = (_race_row_signature(row), norm)
+        added += 1
+
+    return {"追加": added, "取消": removed, "据置": len(current) - added}
+
+
+# -------------------------
+# 一括評価（NumPy・レース配列）
+# -------------------------
+# 数十万レースの検証用。レースを整数配列にしてから、買い目ごとの
+# 点数（ksum）と的中マスクを全レース分まとめて出す。
+# 判定条件は ksum_* / hit_* の1レース版と同じ。
+# finish の値は着順テンソルと同じ（0=着順なし、1〜7=評価順位、FIELD_SIZE+1=出走表外）。
+_PAYOUT_ZONE_EDGES_YEN = (300, 600, 1000, 2000)
+
+
+def encode_race_arrays(byrace_rows: List[Dict]) -> Dict[str, np.ndarray]:
+    """byrace_rows をレース配列へ変換する。V評価がないレースは落とす。"""
+    norms = [n for n in (normalize_race(row) for row in byrace_rows or []) if n is not None]
+    idx = np.array([finish_tensor_index(n) for n in norms], dtype=np.int8).reshape(-1, 4)
+    return {
+        "field_n": np.array([int(n["field_n"]) for n in norms], dtype=np.int16),
+        "n_ranked": idx[:, 0].astype(np.int16),
+        "finish": np.ascontiguousarray(idx[:, 1:]),
+        "pay_2t": np.array([int(n["pay_2t"]) for n in norms], dtype=np.int64),
+        "pay_2f": np.array([int(n["pay_2f"]) for n in norms], dtype=np.int64),
+        "pay_3f": np.array([int(n["pay_3f"]) for n in norms], dtype=np.int64),
+    }
+
+
+def race_array_count(races: Dict[str, np.ndarray]) -> int:
+    return int(races["field_n"].shape[0])
+
+
+def take_race_arrays(races: Dict[str, np.ndarray], index) -> Dict[str, np.ndarray]:
+    """レース配列の一部（マスク・スライス・添字配列）を取り出す。"""
+    return {k: v[index] for k, v in races.items()}
+
+
+def concat_race_arrays(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    parts = [p for p in parts if p]
+    if not parts:
+        return encode_race_arrays([])
+    return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+
+
+# -------------------------
+# レース記録（構造化配列・1レース100バイト弱）
+# -------------------------
+# 履歴を何シーズン分も持つとき、1レース1dict（文字列リスト＋毎回の {車番: 評価} dict）は
+# メモリも走査時間も重い。ここでは1レースを構造化配列の1行にして、読み込み時に1回だけ解析する。
+#   date / race   ：レース日・R（R は RACE_ID_MAX_LEN 文字まで。長いRは切らずにエラーにする）
+#   field_n / n_ranked：頭数・V評価の桁数
+#   finish        ：1〜3着の評価順位（着順テンソルと同じ番号。0=入力なし、FIELD_SIZE+1=出走表外）
+#   off_car       ：評価順位が出走表外のときだけ、その着の車番（それ以外は0）
+#   cars / vperm  ：V評価に出てくる車番のビット集合と、その並び順の順列番号（レーマー符号）
+#   pay_*         ：払戻（円）
+RACE_ID_MAX_LEN = 16
+RACE_RECORD_DTYPE = np.dtype([
+    ("date", "datetime64[D]"),
+    ("race", f"U{RACE_ID_MAX_LEN}"),
+    ("field_n", np.uint8),
+    ("n_ranked", np.uint8),
+    ("finish", np.uint8, (3,)),
+    ("off_car", np.uint8, (3,)),
+    ("cars", np.uint8),
+    ("vperm", np.uint16),
+    ("pay_2t", np.int32),
+    ("pay_2f", np.int32),
+    ("pay_3f", np.int32),
+])
+_FACTORIALS = [1, 1, 2, 6, 24, 120, 720, 5040, 40320, 362880]
+
+
+@lru_cache(maxsize=None)
+def _vorder_code(vorder: str) -> Tuple[int, int, Tuple[int, ...]]:
+    """V評価の並び（"3571246"）→（車番ビット集合, 順列番号, 車番→評価順位の表）。"""
+    cars = [int(ch) for ch in vorder]
+    mask = 0
+    for car in cars:
+        mask |= 1 << car
+    remaining = sorted(cars)
+    perm = 0
+    for i, car in enumerate(cars):
+        j = remaining.index(car)
+        perm += j * _FACTORIALS[len(cars) - 1 - i]
+        remaining.pop(j)
+    rank_of = [0] * 10
+    for i, car in enumerate(cars):
+        rank_of[car] = i + 1
+    return mask, perm, tuple(rank_of)
+
+
+@lru_cache(maxsize=None)
+def _vorder_decode(mask: int, perm: int) -> str:
+    remaining = [car for car in range(10) if mask >> car & 1]
+    out = []
+    for i in range(len(remaining) - 1, -1, -1):
+        j, perm = divmod(perm, _FACTORIALS[i])
+        out.append(str(remaining.pop(j)))
+    return "".join(out)
+
+
+
+@lru_cache(maxsize=1 << 16)
+def _race_code(vorder: str, finish: str) -> tuple:
+    """V評価と着順（上位3車）の組 →（評価の桁数, 着の評価順位, 出走表外の車番, 車番集合, 順列番号）。"""
+    mask, perm, rank_of = _vorder_code(vorder)
+    fin = [FINISH_RANK_NONE] * 3
+    off = [0] * 3
+    for pos, ch in enumerate(finish):
+        car = int(ch)
+        r = rank_of[car]
+        if r == 0 or r > FIELD_SIZE:
+            fin[pos] = FINISH_RANK_OFF
+            off[pos] = car
+        else:
+            fin[pos] = r
+    n = len(vorder) if len(vorder) <= FIELD_SIZE else 0
+    return n, tuple(fin), tuple(off), mask, perm
+
+
+def _race_record_columns(rows) -> np.ndarray:
+    """(日付, R, 頭数, V評価文字列, 着順文字列, pay_2t, pay_2f, pay_3f) の並びを構造化配列に詰める。"""
+    dates, races, field_ns, n_ranked, fins, offs, masks, perms, pays = [], [], [], [], [], [], [], [], []
+    for race_date, race, field_n, vorder, finish, pay_2t, pay_2f, pay_3f in rows:
+        n, fin, off, mask, perm = _race_code(vorder, finish[:3])
+        rid = str(race if race is not None else "")
+        if len(rid) > RACE_ID_MAX_LEN:
+            raise ValueError(f"race id is longer than {RACE_ID_MAX_LEN} characters: {rid!r}")
+        dates.append(race_date or "NaT")
+        races.append(rid)
+        field_ns.append(field_n)
+        n_ranked.append(n)
+        fins.extend(fin)
+        offs.extend(off)
+        masks.append(mask)
+        perms.append(perm)
+        pays.append((int(pay_2t or 0), int(pay_2f or 0), int(pay_3f or 0)))
+
+    out = np.empty(len(dates), dtype=RACE_RECORD_DTYPE)
+    out["date"] = np.array(dates, dtype="datetime64[D]")
+    out["race"] = races
+    out["field_n"] = field_ns
+    out["n_ranked"] = n_ranked
+    out["finish"] = np.array(fins, dtype=np.uint8).reshape(-1, 3)
+    out["off_car"] = np.array(offs, dtype=np.uint8).reshape(-1, 3)
+    out["cars"] = masks
+    out["vperm"] = perms
+    pay = np.array(pays, dtype=np.int32).reshape(-1, 3)
+    out["pay_2t"], out["pay_2f"], out["pay_3f"] = pay[:, 0], pay[:, 1], pay[:, 2]
+    return out
+
+
+def encode_race_records(byrace_rows: List[Dict], race_date: str | None = None) -> np.ndarray:
+    """
+    byrace_rows を構造化配列へ変換する。V評価がないレースは落とす（encode_race_arrays と同じ）。
+
+    日付は行の "date"（履歴ストアから読んだ行）か、なければ race_date。
+    """
+    def _rows():
+        for row in byrace_rows or []:
+            vorder = "".join(str(x) for x in row.get("vorder", []) or [])
+            if not vorder:
+                continue
+            try:
+                field_n = int(row.get("field_n", len(vorder) or 0))
+            except Exception:
+                field_n = 0
+            yield (
+                row.get("date", race_date), row.get("race"), field_n, vorder,
+                "".join(str(x) for x in row.get("finish", []) or []),
+                row.get("pay_2t", 0), row.get("pay_2f", 0), row.get("pay_3f", 0),
+            )
+
+    return _race_record_columns(_rows())
+
+
+def decode_race_records(records: np.ndarray) -> List[Dict]:
+    """構造化配列を byrace_rows の形へ戻す（表示・書き出し用）。"""
+    rows = []
+    for rec in records:
+        vorder = _vorder_decode(int(rec["cars"]), int(rec["vperm"]))
+        finish = []
+        for r, off in zip(rec["finish"], rec["off_car"]):
+            if r == FINISH_RANK_NONE:
+                break
+            finish.append(str(int(off)) if r == FINISH_RANK_OFF else vorder[int(r) - 1])
+        row = {
+            "race": str(rec["race"]),
+            "field_n": int(rec["field_n"]),
+            "vorder": list(vorder),
+            "finish": finish,
+            "pay_2t": int(rec["pay_2t"]),
+            "pay_2f": int(rec["pay_2f"]),
+            "pay_3f": int(rec["pay_3f"]),
+        }
+        if not np.isnat(rec["date"]):
+            row = {"date": str(rec["date"]), **row}
+        rows.append(row)
+    return rows
+
+
+def race_arrays_from_records(records: np.ndarray) -> Dict[str, np.ndarray]:
+    """構造化配列から、バッチ評価が使うレース配列（encode_race_arrays と同じ列・型）を作る。"""
+    return {
+        "field_n": records["field_n"].astype(np.int16),
+        "n_ranked": records["n_ranked"].astype(np.int16),
+        "finish": records["finish"].astype(np.int8),
+        "pay_2t": records["pay_2t"].astype(np.int64),
+        "pay_2f": records["pay_2f"].astype(np.int64),
+        "pay_3f": records["pay_3f"].astype(np.int64),
+    }
+
+
+def split_records_by_date(records: np.ndarray) -> List[Tuple[str, np.ndarray]]:
+    """日付順に並んだ構造化配列を、日付ごとの区間（ビュー）に分ける。"""
+    if len(records) == 0:
+        return []
+    dates = records["date"]
+    day = dates.view(np.int64)
+    starts = np.flatnonzero(np.r_[True, day[1:] != day[:-1]])
+    ends = np.r_[starts[1:], len(records)]
+    return [(str(dates[s]), records[s:e]) for s, e in zip(starts, ends)]
+
+
+def _top2_known(races: Dict[str, np.ndarray]) -> np.ndarray:
+    """1着・2着がどちらも出走表内（旧ループの1→2着系の対象条件）。"""
+    fin = races["finish"]
+    return (fin[:, 0] >= 1) & (fin[:, 0] <= FIELD_SIZE) & (fin[:, 1] >= 1) & (fin[:, 1] <= FIELD_SIZE)
+
+
+def _trio_entered(races: Dict[str, np.ndarray]) -> np.ndarray:
+    """着順3つ入力済み（旧ループの三連複系の対象条件）。"""
+    return races["finish"][:, 2] != FINISH_RANK_NONE
+
+
+def _ranks_in_top3(races: Dict[str, np.ndarray], ranks) -> np.ndarray:
+    """指定評価が全部3着内にいるか。3着内の評価順位をビット集合にして一度に判定する。"""
+    fin = races["finish"].astype(np.int32)
+    bits = (1 << fin[:, 0]) | (1 << fin[:, 1]) | (1 << fin[:, 2])
+    want = 0
+    for r in ranks:
+        want |= 1 << int(r)
+    return (bits & want) == want
+
+
+def batch_2t_pattern(races: Dict[str, np.ndarray], axis: int) -> tuple[np.ndarray, np.ndarray]:
+    """2車単固定型（例 1→23）の (ksum, hit)。hit は払戻の有無を見ない。"""
+    base = {1: AXIS1_TARGETS, 2: AXIS2_TARGETS}.get(int(axis), ())
+    if not base:
+        n = race_array_count(races)
+        return np.zeros(n, dtype=np.int64), np.zeros(n, dtype=bool)
+    return batch_formation(races, f"2車単 {int(axis)}→{''.join(str(t) for t in base)}")
+
+
+def batch_axis_to_target(races: Dict[str, np.ndarray], axis: int, target: int) -> tuple[np.ndarray, np.ndarray]:
+    """2車単 axis→target の (ksum, hit)。1・2着が分からないレースは買わない（ksum=0）。"""
+    fn = races["field_n"]
+    fin = races["finish"]
+    ok = (fn >= 2) & (axis <= fn) & (target <= fn) & (axis != target) & _top2_known(races)
+    hit = ok & (fin[:, 0] == axis) & (fin[:, 1] == target)
+    return ok.astype(np.int64), hit
+
+
+def batch_nishafuku_pair(races: Dict[str, np.ndarray], a: int, b: int) -> tuple[np.ndarray, np.ndarray]:
+    """2車複 a-b の (ksum, hit)。1・2着が分からないレースは買わない（ksum=0、日次集計と同じ対象）。"""
+    fn = races["field_n"]
+    fin = races["finish"]
+    ok = (fn >= 2) & (a <= fn) & (b <= fn) & (a != b) & _top2_known(races)
+    hit = ok & (
+        ((fin[:, 0] == a) & (fin[:, 1] == b)) | ((fin[:, 0] == b) & (fin[:, 1] == a))
+    )
+    return ok.astype(np.int64), hit
+
+
+def batch_nishafuku_3412(races: Dict[str, np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """34-12 2車複フォメの (ksum, hit)。"""
+    return batch_formation(races, NISHAFUKU_3412_FORMATION)
+
+
+def batch_sanrenpuku_key(races: Dict[str, np.ndarray], key: str) -> tuple[np.ndarray, np.ndarray]:
+    """3連複 評価キー（例 1-2-4）の (ksum, hit)。着順3つが入っていないレースは買わない（ksum=0）。"""
+    fn = races["field_n"]
+    ksum = np.zeros(fn.shape[0], dtype=np.int64)
+    try:
+        vals = [int(x) for x in str(key).split("-")]
+    except Exception:
+        return ksum, ksum.astype(bool)
+    if len(vals) != 3 or len(set(vals)) != 3 or min(vals) < 1:
+        return ksum, ksum.astype(bool)
+    ok = (fn >= 3) & (max(vals) <= fn) & _trio_entered(races)
+    hit = ok & _ranks_in_top3(races, vals)
+    return ok.astype(np.int64), hit
+
+
+def batch_sanrenpuku_pair_all(races: Dict[str, np.ndarray], a: int, b: int) -> tuple[np.ndarray, np.ndarray]:
+    """3連複 a-b-全（推奨流れワイドa-bの三連複版）の (ksum, hit)。"""
+    return batch_formation(races, f"3連複 {int(a)}-{int(b)}-全")
+
+
+def batch_sanrenpuku_12_all(races: Dict[str, np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """3連複 1-2-全 の (ksum, hit)。"""
+    return batch_sanrenpuku_pair_all(races, 1, 2)
+
+
+def batch_trio_formation(races: Dict[str, np.ndarray], keys: List[str], min_field_n: int = 4) -> tuple[np.ndarray, np.ndarray]:
+    """123-123-4 のような三連複フォメ（キーの集合）の (ksum, hit)。"""
+    return batch_formation(races, f"3連複 {' / '.join(keys)} @{int(min_field_n)}")
+
+
+def _batch_payout_rec(
+    ksum: np.ndarray,
+    eligible: np.ndarray,
+    hit: np.ndarray,
+    pay: np.ndarray | None = None,
+) -> Dict[str, int]:
+    """
+    (ksum, hit) を payout_rec へまとめる。
+    pay を渡すと払戻>0の的中だけをH・SUM・ゾーンへ数える（日次集計と同じ）。
+    """
+    rec = new_payout_rec()
+    use = eligible & (ksum > 0)
+    rec["N"] = int(np.count_nonzero(use))
+    rec["KSUM"] = int(np.dot(ksum, use))
+    if pay is None:
+        rec["H"] = int(np.count_nonzero(use & hit))
+        return rec
+    paid = use & hit & (pay > 0)
+    rec["H"] = int(np.count_nonzero(paid))
+    rec["SUM"] = int(np.dot(pay, paid))
+    return rec
+
+
+def _add_batch_zone_counts(rec: Dict[str, int], pays: np.ndarray) -> None:
+    zone_idx = np.digitize(pays, _PAYOUT_ZONE_EDGES_YEN, right=True)
+    counts = np.bincount(zone_idx, minlength=len(ZONE_KEYS_ORDER))
+    for zkey, c in zip(ZONE_KEYS_ORDER, counts):
+        rec[zkey] += int(c)
+
+
+@perf_timed
+def aggregate_race_arrays(races: Dict[str, np.ndarray]) -> Dict:
+    """
+    レース配列から aggregate_byrace_rows と同じ集計を作る。
+    レースごとのPythonループを通さないので、履歴全体の再集計や検証に使う。
+    """
+    agg = new_daily_aggregates()
+    if race_array_count(races) == 0:
+        return agg
+
+    fn = races["field_n"]
+    fin = races["finish"].astype(np.intp)
+    pay_2t = races["pay_2t"]
+    pay_2f = races["pay_2f"]
+
+    np.add.at(agg["finish_tensor"], (races["n_ranked"].astype(np.intp), fin[:, 0], fin[:, 1], fin[:, 2]), 1)
+
+    top2 = _top2_known(races) & (fn > 0)
+    trio = _trio_entered(races) & (fn > 0)
+
+    for axis in PATTERN_AXES:
+        ksum, hit = batch_2t_pattern(races, axis)
+        agg["payout_2t_pattern"][axis] = _batch_payout_rec(ksum, top2, hit, pay_2t)
+
+    for axis, target in INDIVIDUAL_PAIRS:
+        ksum, hit = batch_axis_to_target(races, axis, target)
+        agg["payout_axis_target"][(axis, target)] = _batch_payout_rec(ksum, top2, hit, pay_2t)
+
+    def _nishafuku_rec(ksum: np.ndarray, hit: np.ndarray) -> Dict[str, int]:
+        rec = _batch_payout_rec(ksum, top2, hit, pay_2f)
+        _add_batch_zone_counts(rec, pay_2f[top2 & (ksum > 0) & hit & (pay_2f > 0)])
+        return rec
+
+    for a, b in list(NISHAFUKU_PAIRS) + list(NISHAFUKU_EXTRA_PAIRS):
+        agg["payout_nishafuku"][nishafuku_label(a, b)] = _nishafuku_rec(*batch_nishafuku_pair(races, a, b))
+
+    agg["payout_nishafuku_3412"][NISHAFUKU_3412_LABEL] = _nishafuku_rec(*batch_nishafuku_3412(races))
+
+    # ゾーン中央値用の実払戻（NISHAFUKU_PAIRSの的中分だけ）
+    lo = np.minimum(fin[:, 0], fin[:, 1])
+    hi = np.maximum(fin[:, 0], fin[:, 1])
+    zone_hit = np.zeros(fn.shape[0], dtype=bool)
+    for a, b in NISHAFUKU_PAIR_SET:
+        zone_hit |= (lo == a) & (hi == b)
+    zone_pays = pay_2f[top2 & zone_hit & (pay_2f > 0)]
+    zone_idx = np.digitize(zone_pays, _PAYOUT_ZONE_EDGES_YEN, right=True)
+    for i, zkey in enumerate(ZONE_KEYS_ORDER):
+        if zkey not in agg["zone_sketches"]:
+            continue
+        values, counts = np.unique(zone_pays[zone_idx == i], return_counts=True)
+        for v, c in zip(values, counts):
+            payout_sketch_add(agg["zone_sketches"][zkey], int(v), int(c))
+
+    # 三連複系は配当入力なしなので的中Hだけ。
+    for label, keys, rec_key in (
+        (TRIO_1231234_LABEL, TRIO_1231234_KEYS, "payout_trio_1231234"),
+        (TRIO_1241243_LABEL, TRIO_1241243_KEYS, "payout_trio_1241243"),
+    ):
+        ksum, hit = batch_trio_formation(races, keys)
+        agg[rec_key][label] = _batch_payout_rec(ksum, trio, hit)
+
+    ksum, hit = batch_sanrenpuku_12_all(races)
+    agg["payout_sanrenpuku12_all"]["仮想全体"] = _batch_payout_rec(ksum, trio, hit)
+
+    for key in TRIO_USED_KEYS:
+        ksum, hit = batch_sanrenpuku_key(races, key)
+        agg["payout_sanrenpuku12_individual"]["仮想全体"][key] = _batch_payout_rec(ksum, trio, hit)
+
+    return agg
+
+
+# 手入力の引継ぎ（*_manual）を持てる集計キー。三連複3点・テンソル・スケッチは引継ぎなし。
+CARRYOVER_PAYOUT_KEYS = (
+    "payout_2t_pattern",
+    "payout_axis_target",
+    "payout_nishafuku",
+    "payout_nishafuku_3412",
+    "payout_sanrenpuku12_all",
+)
+
+
+def _add_payout_tables(dst: Dict, src: Dict) -> None:
+    """{ラベル: payout_rec} または {ラベル: {キー: payout_rec}} を同じ形の dst へ足す。"""
+    for label, rec in (src or {}).items():
+        if label not in dst:
+            continue
+        if "N" in rec:
+            add_rec(dst[label], rec)
+        else:
+            _add_payout_tables(dst[label], rec)
+
+
+def merge_daily_aggregates(dst: Dict, src: Dict) -> Dict:
+    """new_daily_aggregates 形式の src を dst へ足し込む（dst を返す）。日ごとの累積更新用。"""
+    dst["finish_tensor"] += src["finish_tensor"]
+    for key, table in src.items():
+        if key.startswith("payout_"):
+            _add_payout_tables(dst[key], table)
+    for zkey, sketch in src["zone_sketches"].items():
+        merge_payout_sketches(dst["zone_sketches"].setdefault(zkey, new_payout_sketch()), sketch)
+    return dst
+
+
+@perf_timed
+def build_cumulative_totals(daily_agg: Dict, history_agg: Dict | None = None, manual: Dict | None = None) -> Dict:
+    """
+    今日入力＋履歴ストア＋手入力の引継ぎを合算した累積を作る。
+
+    manual のキーは new_daily_aggregates と同じ名前（"rank"/"pair12"/"pair13"/"pair23"、
+    CARRYOVER_PAYOUT_KEYS と "payout_sanrenpuku12_individual"）。無いキーは0扱い。
+    評価別・1→2・1-3・2-3 は、日次＋履歴の着順テンソルの周辺和に引継ぎ分を足す。
+    """
+    history_agg = history_agg or new_daily_aggregates()
+    manual = manual or {}
+
+    tensor = daily_agg["finish_tensor"] + history_agg["finish_tensor"]
+    totals: Dict = {"finish_tensor": tensor, "rank": rank_counts_from_tensor(tensor)}
+
+    for r, rec in (manual.get("rank") or {}).items():
+        if r in totals["rank"]:
+            for k in ("N", "C1", "C2", "C3"):
+                totals["rank"][r][k] += int(rec.get(k, 0))
+
+    for kind in ("12", "13", "23"):
+        counts = pair_counts_from_tensor(tensor, kind)
+        for k, v in (manual.get(f"pair{kind}") or {}).items():
+            counts[k] += int(v)
+        totals[f"pair{kind}"] = counts
+
+    empty = new_daily_aggregates()
+    for key in CARRYOVER_PAYOUT_KEYS + (
+        "payout_sanrenpuku12_individual",
+        "payout_trio_1231234",
+        "payout_trio_1241243",
+    ):
+        out = empty[key]
+        for src in (daily_agg, manual, history_agg):
+            _add_payout_tables(out, src.get(key))
+        totals[key] = out
+    return totals
+
+
+def cumulative_view(agg: Dict) -> Dict:
+    """推奨ロジックが読む累積（1→2表・評価別・個別2車複・累積R数）。"""
+    tensor = agg["finish_tensor"]
+    return {
+        "pair12": pair_counts_from_tensor(tensor, "12"),
+        "rank": rank_counts_from_tensor(tensor),
+        "payout_nishafuku": agg["payout_nishafuku"],
+        "races": int(tensor.sum()),
+    }
+
+
+@perf_timed
+def build_df_pairs(cum: Dict, ev_metrics: Callable = calculate_ev_metrics) -> pd.DataFrame:
+    """
+    推奨ロジックへ渡す df_pairs（個別2車複 累積表 + EV診断列）。
+
+    cum は cumulative_view か build_cumulative_totals の戻り値（"payout_nishafuku"/"pair12" を読む）。
+    """
+    df = build_nishafuku_pairs_frame(cum["payout_nishafuku"], cum["pair12"])
+    return ev_metrics(df, "2車複")
+
+
+# =========================
+# 当日カードの事前計算（レース別の判断表）
+# =========================
+# 推奨はすべて「V評価順・頭数・累積表」だけで決まる。累積に依る部分（EV診断・推奨フォーメーション・
+# ワイド切替オッズ）はカード全体で1回だけ作り、レースごとには評価順位→車番の置き換えだけをする。
+# 発走前はレース番号で判断表を引くだけになる。
+CARD_WIDE_SWITCH_PAIRS = ((1, 2), (1, 3), (2, 3))
+
+
+def _car_key(rank_key: str, vorder: List[str]) -> str | None:
+    """評価順位キー（"1-2-4" / "1→2"）を車番キー（"3=5=7" / "3→5"）にする。頭数を超える順位があれば None。"""
+    ranks = _ticket_ranks(rank_key)
+    if not ranks or any(r < 1 or r > len(vorder) for r in ranks):
+        return None
+    cars = [str(vorder[r - 1]) for r in ranks]
+    if "→" in str(rank_key):
+        return "→".join(cars)
+    return "=".join(sorted(cars, key=int))
+
+
+@perf_timed
+def card_decision_context(totals: Dict) -> Dict:
+    """
+    レースに依らない判断材料を作る（カード1枚につき1回）。
+
+    totals は build_cumulative_totals の戻り値（"pair12"/"pair13"/"pair23"/"rank"/"payout_nishafuku"）。
+    """
+    df_pairs = build_df_pairs(totals)
+
+    formations = []
+    for name, bet_type, best in (
+        ("クロスフォーメーション", "2車複", build_cross_formation_summary(df_pairs, totals["pair12"])),
+        ("三連複4点BOX", "3連複", build_sanrenpuku_4point_candidate_summary(df_pairs)),
+        (
+            "三連複12-123-12345",
+            "3連複",
+            build_axis1_stability_hybrid_formation_summary(df_pairs, totals["rank"], totals["pair12"]),
+        ),
+    ):
+        if best:
+            formations.append({
+                "名前": name,
+                "券種": bet_type,
+                "型": str(best.get("型", "")),
+                "買い目": list(best.get("買い目") or []),
+            })
+    formations.append({
+        "名前": NISHAFUKU_3412_LABEL,
+        "券種": "2車複",
+        "型": "34-12",
+        "買い目": formation_keys(NISHAFUKU_3412_FORMATION),
+    })
+
+    required = []
+    for row in df_pairs.to_dict("records"):
+        if row.get("最低必要オッズ") is None:
+            continue
+        required.append({
+            "目": row["ペアキー"],
+            "最低必要オッズ": row["最低必要オッズ"],
+            "p_safe%": row.get("p_safe%"),
+            "参考odds": row.get("参考odds"),
+            "EV判定": row.get("EV判定"),
+        })
+
+    wide = []
+    for a, b in CARD_WIDE_SWITCH_PAIRS:
+        stats = wide_pair_switch_stats(a, b, totals["pair12"], totals["pair13"], totals["pair23"])
+        wide.append({
+            "ワイド": stats["label"],
+            "的中率%": round(stats["rate"] * 100.0, 1) if stats["total_races"] > 0 else None,
+            "損益分岐合成オッズ": round(stats["break_even_odds"], 2) if stats["break_even_odds"] is not None else None,
+            "推奨下限合成オッズ": round(stats["recommended_min_odds"], 2) if stats["recommended_min_odds"] is not None else None,
+        })
+
+    return {"formations": formations, "required": required, "wide": wide, "races": int(totals["finish_tensor"].sum())}
+
+
+def race_decision_bundle(context: Dict, row: Dict) -> Dict:
+    """1レース分の判断表。context の評価順位キーを、このレースの車番に置き換える。"""
+    vorder = [str(c) for c in row.get("vorder", [])]
+    formations = []
+    for f in context["formations"]:
+        cars = [_car_key(k, vorder) for k in f["買い目"]]
+        formations.append({**f, "車番": [c for c in cars if c is not None], "点数": sum(c is not None for c in cars)})
+    required = [
+        {**r, "車番": car}
+        for r in context["required"]
+        if (car := _car_key(r["目"], vorder)) is not None
+    ]
+    wide = [
+        {**w, "車番": car}
+        for w in context["wide"]
+        if (car := _car_key(w["ワイド"], vorder)) is not None
+    ]
+    return {
+        "R": str(row.get("race", "")),
+        "頭数": row.get("field_n"),
+        "V評価": "".join(vorder),
+        "累積R": context["races"],
+        "フォーメーション": formations,
+        "2車複必要オッズ": required,
+        "ワイド切替": wide,
+    }
+
+
+def _precompute_card_key(byrace_rows: List[Dict], totals: Dict, version=None):
+    return (byrace_rows, version) if version is not None else (byrace_rows, totals)
+
+
+@perf_timed
+@content_cached(key=_precompute_card_key)
+def precompute_card(byrace_rows: List[Dict], totals: Dict, version=None) -> Dict[str, Dict]:
+    """
+    当日カード（V評価入力済みのレース）の判断表をまとめて作る。戻り値は {R: 判断表}。
+
+    累積が同じ間は結果キャッシュに当たるので、再実行しても作り直さない。
+    version は totals を一意に決める小さな値（履歴スナップショットの token と引継ぎなど）。
+    渡せば累積そのものはハッシュしない。totals が今日の行から作られていれば、
+    今日の行は byrace_rows 側でキーに入る。
+    """
+    context = card_decision_context(totals)
+    card: Dict[str, Dict] = {}
+    for row in byrace_rows:
+        if row.get("vorder"):
+            card[str(row.get("race", ""))] = race_decision_bundle(context, row)
+    return card
+
+
+def card_bundle_frames(bundle: Dict) -> Dict[str, pd.DataFrame]:
+    """判断表を表示用の表（フォーメーション・2車複必要オッズ・ワイド切替）にする。"""
+    df_form = pd.DataFrame([
+        {
+            "名前": f["名前"],
+            "券種": f["券種"],
+            "型": f["型"],
+            "点数": f["点数"],
+            "車番": " / ".join(f["車番"]),
+        }
+        for f in bundle["フォーメーション"]
+    ])
+    return {
+        "フォーメーション": df_form,
+        "2車複必要オッズ": pd.DataFrame(bundle["2車複必要オッズ"]),
+        "ワイド切替": pd.DataFrame(bundle["ワイド切替"]),
+    }
+
+
+# =========================
+# フォーメーション記法（着順表への展開）
+# =========================
+# "3連複 12-123-12345" のような文字列を、頭数ごとの「点数」と
+# 「着順（評価順位の1着・2着・3着）→的中」の表へ展開する。
+# 的中判定は表を1回引くだけなので、新しい買い方を集計に足すのは文字列1つで済む。
+#
+#   券種 脚-脚(-脚) [BOX] [@最低頭数] [/ 別の脚...]
+#
+# - 券種：2車複 / 2車単 / 3連複 / 3連単。脚の区切りは "-"（"→" も可）。
+# - 脚：評価順位の数字の並び（"123" は評価1・2・3）。"全" は出走表外の車も含む全部
+#   （出走表外の車は点数に数えないが、3着内に来れば的中として拾う）。
+# - BOX：脚1つを券種の頭数ぶん並べたもの（"3連複 1234 BOX" は4点）。
+# - @最低頭数：頭数がこれ未満のレースは買わない（"2車複 34-12 @4"）。フォーメーション全体にかかる。
+# - " / " で区切ると、各部分の買い目の和集合（"3連複 1-2-4 / 1-3-4 / 2-3-4"）。
+#
+# 着順の番号は着順テンソルの後ろ3軸と同じ（0=着順入力なし、FIELD_SIZE+1=出走表外）。
+FORMATION_BET_TYPES = {"2車複": 2, "2車単": 2, "3連複": 3, "3連単": 3}
+FORMATION_OUTCOME_SHAPE = FINISH_TENSOR_SHAPE[1:]
+_FORMATION_ORDERED = {"2車単", "3連単"}
+_FORMATION_ALL = "全"
+
+
+def _parse_formation_part(bet_type: str, part: str) -> Tuple[List[List[int]], int]:
+    tokens = part.split()
+    min_field_n = 0
+    box = False
+    body = []
+    for tok in tokens:
+        if tok.upper() == "BOX":
+            box = True
+        elif tok.startswith("@"):
+            try:
+                min_field_n = int(tok[1:])
+            except ValueError:
+                raise ValueError(f"formation: bad minimum field size: {tok}") from None
+        else:
+            body.append(tok)
+    if len(body) != 1:
+        raise ValueError(f"formation: expected one leg spec: {part!r}")
+
+    legs = []
+    for leg in body[0].replace("→", "-").split("-"):
+        if leg == _FORMATION_ALL:
+            legs.append(list(range(1, FIELD_SIZE + 1)) + [FINISH_RANK_OFF])
+        elif leg.isdigit() and all(1 <= int(ch) <= FIELD_SIZE for ch in leg):
+            legs.append(sorted({int(ch) for ch in leg}))
+        else:
+            raise ValueError(f"formation: bad leg {leg!r} in {part!r}")
+    width = FORMATION_BET_TYPES[bet_type]
+    if box:
+        if len(legs) != 1:
+            raise ValueError(f"formation: BOX takes a single leg: {part!r}")
+        legs = legs * width
+    if len(legs) != width:
+        raise ValueError(f"formation: {bet_type} needs {width} legs: {part!r}")
+    return legs, min_field_n
+
+
+@lru_cache(maxsize=256)
+def compile_formation(text: str) -> Dict:
+    """
+    フォーメーション文字列を展開する。
+
+    返り値：
+      券種・tickets（評価順位の買い目。出走表外を含むものは的中専用）・
+      ksum（頭数→点数、長さ FIELD_SIZE+1）・
+      hit（頭数×着順の的中表。着順は FORMATION_OUTCOME_SHAPE の平坦化番号）・
+      settled（着順→その券種の結果が決まっているか。2着までなら1・2着が出走表内、3着までなら3着入力済み）。
+    同じ文字列は1回だけ展開する（返す配列は書き換え不可）。
+    """
+    text = str(text).strip()
+    head, _, rest = text.partition(" ")
+    bet_type = head.strip()
+    if bet_type not in FORMATION_BET_TYPES:
+        raise ValueError(f"formation: unknown bet type: {text!r}")
+    ordered = bet_type in _FORMATION_ORDERED
+
+    parts = [_parse_formation_part(bet_type, part.strip()) for part in rest.split("/")]
+    min_field_n = max(m for _, m in parts)
+    tickets: List[Tuple[int, ...]] = []
+    seen = set()
+    for legs, _ in parts:
+        for combo in product(*legs):
+            if len(set(combo)) != len(combo) or combo.count(FINISH_RANK_OFF) > 1:
+                continue
+            ticket = combo if ordered else tuple(sorted(combo))
+            if ticket not in seen:
+                seen.add(ticket)
+                tickets.append(ticket)
+
+    w, s, t = np.meshgrid(*(np.arange(d) for d in FORMATION_OUTCOME_SHAPE), indexing="ij")
+    top = [w.ravel(), s.ravel(), t.ravel()][:FORMATION_BET_TYPES[bet_type]]
+    ksum = np.zeros(FIELD_SIZE + 1, dtype=np.int64)
+    hit = np.zeros((FIELD_SIZE + 1, int(np.prod(FORMATION_OUTCOME_SHAPE))), dtype=bool)
+    for ticket in tickets:
+        if ordered:
+            match = np.logical_and.reduce([pos == r for pos, r in zip(top, ticket)])
+        else:
+            # 着順は同じ評価を2回含まないので、全員が買い目に入っていれば一致。
+            match = np.logical_and.reduce([np.isin(pos, ticket) for pos in top])
+            match &= np.logical_and.reduce([pos != FINISH_RANK_NONE for pos in top])
+            if len(top) == 3:
+                match &= (top[0] != top[1]) & (top[0] != top[2]) & (top[1] != top[2])
+            else:
+                match &= top[0] != top[1]
+        known = [r for r in ticket if r != FINISH_RANK_OFF]
+        first_n = max(max(known), int(min_field_n), len(ticket))
+        for n in range(first_n, FIELD_SIZE + 1):
+            hit[n] |= match
+            if len(known) == len(ticket):
+                ksum[n] += 1
+
+    if len(top) == 2:
+        settled = (top[0] >= 1) & (top[0] <= FIELD_SIZE) & (top[1] >= 1) & (top[1] <= FIELD_SIZE)
+    else:
+        settled = top[2] != FINISH_RANK_NONE
+    ksum.setflags(write=False)
+    hit.setflags(write=False)
+    settled.setflags(write=False)
+    return {
+        "formation": text,
+        "券種": bet_type,
+        "tickets": [tk for tk in tickets if FINISH_RANK_OFF not in tk],
+        "ksum": ksum,
+        "hit": hit,
+        "settled": settled,
+    }
+
+
+def formation_keys(formation: str | Dict) -> List[str]:
+    """展開後の買い目キー（"1-2-4" / 2車単は "1→2"）。"""
+    f = compile_formation(formation) if isinstance(formation, str) else formation
+    sep = "→" if f["券種"] in _FORMATION_ORDERED else "-"
+    return [sep.join(str(r) for r in tk) for tk in f["tickets"]]
+
+
+def race_outcome_index(races: Dict[str, np.ndarray]) -> np.ndarray:
+    """レース配列の着順を、フォーメーションの的中表の列番号にする。"""
+    fin = races["finish"].astype(np.intp)
+    return np.ravel_multi_index((fin[:, 0], fin[:, 1], fin[:, 2]), FORMATION_OUTCOME_SHAPE)
+
+
+def batch_formation(races: Dict[str, np.ndarray], formation: str | Dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    フォーメーションの (ksum, hit)。点数も的中も表を引くだけ。
+
+    着順が決まっていないレース（2着までの券種は1・2着、3着までの券種は3着が未入力）は
+    買わない（ksum=0）。日次集計の対象と同じ。
+    """
+    f = compile_formation(formation) if isinstance(formation, str) else formation
+    fn = np.clip(races["field_n"].astype(np.intp), 0, FIELD_SIZE)
+    outcome = race_outcome_index(races)
+    settled = f["settled"][outcome]
+    return f["ksum"][fn] * settled, f["hit"][fn, outcome] & settled
+
+
+def formation_counts_from_tensor(tensor: np.ndarray, formation: str | Dict) -> Dict[str, int]:
+    """
+    着順テンソルからフォーメーションの N（点数>0のレース数）・KSUM・H（払戻を問わない的中数）。
+    頭数軸は評価の桁数（入力検証で頭数と一致させている）。着順が決まっていないレースは数えない。
+    """
+    f = compile_formation(formation) if isinstance(formation, str) else formation
+    flat = np.asarray(tensor).reshape(FIELD_SIZE + 1, -1)
+    races_by_n = (flat * f["settled"]).sum(axis=1)
+    return {
+        "N": int(races_by_n[f["ksum"] > 0].sum()),
+        "KSUM": int(np.dot(races_by_n, f["ksum"])),
+        "H": int((flat * f["hit"]).sum()),
+    }
+
+
+def formation_payout_rows(
+    races: Dict[str, np.ndarray],
+    formations: List[str],
+    labels: List[str] | None = None,
+) -> pd.DataFrame:
+    """
+    フォーメーション文字列の並びを、既存の払戻表と同じ列（payout_row）で集計する。
+
+    払戻は券種の払戻列（2車複 pay_2f・2車単 pay_2t・3連複 pay_3f）で、
+    払戻0の的中は日次集計と同じく的中に数えない。3連単は払戻列がないので的中数だけ。
+    """
+    pay_cols = {"2車複": "pay_2f", "2車単": "pay_2t", "3連複": "pay_3f"}
+    rows = []
+    for i, text in enumerate(formations):
+        f = compile_formation(text)
+        ksum, hit = batch_formation(races, f)
+        pay = races.get(pay_cols.get(f["券種"], ""))
+        rec = _batch_payout_rec(ksum, np.ones(len(ksum), dtype=bool), hit, pay)
+        label = labels[i] if labels is not None else f["formation"]
+        row = payout_row(label, rec)
+        if pay is None:
+            row.update({"平均配当": None, "回収率%": None})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+# =========================
+# フォーメーション探索（全列挙・分枝限定）
+# =========================
+# 評価順位の2車複・3連複の買い目を、点数上限までの全組み合わせで履歴に当てる。
+# 買い目ごとに「買えたレース」「的中レース」をビット集合（Python int）にしておけば、
+# フォーメーションの評価はビットORとpopcountだけで済む。
+# 同じ券種の買い目は同じレースで2つ当たらないので、投資・払戻は買い目ごとの和になる。
+FORMATION_SEARCH_BET_TYPES = ("2車複", "3連複")
+
+
+def _mask_to_int(mask: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(mask.astype(bool), bitorder="little").tobytes(), "little")
+
+
+def formation_ticket_table(races: Dict[str, np.ndarray], bet_type: str, max_rank: int = FIELD_SIZE) -> List[Dict]:
+    """
+    探索の元になる買い目ごとの成績（ビット集合つき）。
+
+    2車複は評価 a-b、3連複は a-b-c の全キー（評価 max_rank まで）。
+    払戻0の的中（払戻未入力）は払戻不明的中として数え、払戻には入れない。
+    """
+    if bet_type == "2車複":
+        combos = [(a, b) for a in range(1, max_rank + 1) for b in range(a + 1, max_rank + 1)]
+        pay = races["pay_2f"]
+    elif bet_type == "3連複":
+        combos = [(a, b, c) for a in range(1, max_rank + 1)
+                  for b in range(a + 1, max_rank + 1) for c in range(b + 1, max_rank + 1)]
+        pay = races["pay_3f"]
+    else:
+        raise ValueError(f"unsupported bet type: {bet_type}")
+
+    tickets = []
+    for combo in combos:
+        key = "-".join(str(x) for x in combo)
+        if bet_type == "2車複":
+            ksum, hit = batch_nishafuku_pair(races, *combo)
+        else:
+            ksum, hit = batch_sanrenpuku_key(races, key)
+        played = ksum > 0
+        tickets.append({
+            "目": key,
+            "played": _mask_to_int(played),
+            "hit": _mask_to_int(hit),
+            "投資": int(ksum.sum()) * 100,
+            "的中R": int(np.count_nonzero(hit)),
+            "払戻": int(pay[hit & (pay > 0)].sum()),
+            "払戻不明的中": int(np.count_nonzero(hit & (pay <= 0))),
+        })
+    return tickets
+
+
+def _dominates(a: Tuple[float, float], b: Tuple[float, float]) -> bool:
+    return a[0] >= b[0] and a[1] >= b[1] and (a[0] > b[0] or a[1] > b[1])
+
+
+def search_formations(
+    races: Dict[str, np.ndarray],
+    bet_type: str,
+    max_points: int = 4,
+    max_rank: int = FIELD_SIZE,
+    min_hits: int = 5,
+) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """
+    点数 max_points までの全フォーメーションから、的中率と回収率のパレート前線を探す。
+
+    深さ優先で買い目を1つずつ足し、「この先どう足しても今の前線に負ける」枝は切る。
+    上限は、的中率＝(今の的中R＋残り買い目の最大的中R×残り点数)／今のR数
+    （R数は足すほど増えるだけ）、回収率＝max(今の回収率, 残り買い目の最大回収率)
+    （比の和は各比の最大を超えない）。
+    min_hits 未満の的中しかないフォーメーションは前線に入れない（少数の偶然を拾わないため）。
+    払戻が1件も記録されていない券種（入力欄のない3連複など）は回収率がすべて0になり、
+    前線が的中率だけの並びになるので ValueError にする。
+    返り値は (前線の表, {"評価数", "枝刈り数", "買い目数"})。
+    """
+    pay_col = {"2車複": "pay_2f", "3連複": "pay_3f"}.get(bet_type)
+    if pay_col is not None and not (races[pay_col] > 0).any():
+        raise ValueError(f"no {bet_type} payouts recorded ({pay_col} is 0 for every race); ROI cannot be searched")
+    tickets = formation_ticket_table(races, bet_type, max_rank=max_rank)
+    # 回収率の高い順に並べると、良い前線が早く見つかって枝刈りが効く。
+    roi = [t["払戻"] / t["投資"] if t["投資"] > 0 else 0.0 for t in tickets]
+    order = sorted(range(len(tickets)), key=lambda i: roi[i], reverse=True)
+    tickets = [tickets[i] for i in order]
+    roi = [roi[i] for i in order]
+    n = len(tickets)
+    # suffix[i]：i番目以降の買い目の最大回収率・最大的中R
+    suffix_roi = [0.0] * (n + 1)
+    suffix_hits = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        suffix_roi[i] = max(roi[i], suffix_roi[i + 1])
+        suffix_hits[i] = max(tickets[i]["的中R"], suffix_hits[i + 1])
+
+    front: List[Dict] = []
+    stats = {"評価数": 0, "枝刈り数": 0, "買い目数": n}
+
+    def _consider(point: Tuple[float, float], rec: Dict) -> None:
+        if any(_dominates(f["_point"], point) or f["_point"] == point for f in front):
+            return
+        front[:] = [f for f in front if not _dominates(point, f["_point"])]
+        rec["_point"] = point
+        front.append(rec)
+
+    def _visit(start: int, chosen: List[int], played: int, hit: int, invest: int, paid: int, unknown: int) -> None:
+        for i in range(start, n):
+            t = tickets[i]
+            c_played = played | t["played"]
+            c_hit = hit | t["hit"]
+            c_invest = invest + t["投資"]
+            c_paid = paid + t["払戻"]
+            c_unknown = unknown + t["払戻不明的中"]
+            c_chosen = chosen + [i]
+            n_played = c_played.bit_count()
+            n_hit = c_hit.bit_count()
+            stats["評価数"] += 1
+            hit_rate = n_hit / n_played if n_played else 0.0
+            c_roi = c_paid / c_invest if c_invest else 0.0
+            if n_hit >= int(min_hits):
+                _consider((hit_rate, c_roi), {
+                    "券種": bet_type,
+                    "点数": len(c_chosen),
+                    "買い目": " / ".join(sorted((tickets[j]["目"] for j in c_chosen), key=_ticket_ranks)),
+                    "R数": n_played,
+                    "投資": c_invest,
+                    "的中R": n_hit,
+                    "払戻": c_paid,
+                    "払戻不明的中": c_unknown,
+                })
+            left = int(max_points) - len(c_chosen)
+            if left <= 0 or i + 1 >= n:
+                continue
+            bound = (
+                min(1.0, (n_hit + left * suffix_hits[i + 1]) / n_played) if n_played else 1.0,
+                max(c_roi, suffix_roi[i + 1]),
+            )
+            if any(_dominates(f["_point"], bound) for f in front):
+                stats["枝刈り数"] += 1
+                continue
+            _visit(i + 1, c_chosen, c_played, c_hit, c_invest, c_paid, c_unknown)
+
+    _visit(0, [], 0, 0, 0, 0, 0)
+
+    rows = []
+    for f in sorted(front, key=lambda r: r["_point"]):
+        rec = {k: v for k, v in f.items() if k != "_point"}
+        rec["的中率%"] = round(100.0 * f["_point"][0], 1)
+        rec["回収率%"] = round(100.0 * f["_point"][1], 1)
+        rows.append(rec)
+    columns = ["券種", "点数", "買い目", "R数", "投資", "的中R", "的中率%", "払戻", "払戻不明的中", "回収率%"]
+    return pd.DataFrame(rows, columns=columns), stats
+
+
+# =========================
+# 履歴ストア（SQLite・追記のみ）
+# =========================
+# 日次入力の byrace_rows をレース日付きでそのまま保存する。
+# 前日までの累積は、手入力の転記ではなくこのストアの全レースから作り直す。
+# 同じ日・同じRの再保存は上書きせずに無視する（追記のみ）。着順未入力のレースは保存しない。
+HISTORY_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "perfect4_history.sqlite3")
+# 複数セッション・複数プロセスで同じストアを開く前提。WAL なので読み手は書き手を待たない。
+# 書き込みは history_write で1本ずつ（プロセス内はロック、プロセス間は BEGIN IMMEDIATE）。
+HISTORY_BUSY_TIMEOUT_SEC = 30.0
+_HISTORY_WRITE_LOCK = threading.Lock()
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS races (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    race_date TEXT NOT NULL,
+    race TEXT NOT NULL,
+    field_n INTEGER NOT NULL,
+    vorder TEXT NOT NULL,
+    finish TEXT NOT NULL,
+    pay_2t INTEGER NOT NULL DEFAULT 0,
+    pay_2f INTEGER NOT NULL DEFAULT 0,
+    pay_3f INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    UNIQUE (race_date, race)
+);
+CREATE INDEX IF NOT EXISTS idx_races_date ON races (race_date);
+CREATE TABLE IF NOT EXISTS zone_sketches (
+    race_date TEXT NOT NULL,
+    zone_key TEXT NOT NULL,
+    sketch TEXT NOT NULL,
+    PRIMARY KEY (race_date, zone_key)
+);
+CREATE TABLE IF NOT EXISTS odds_2f (
+    race_date TEXT NOT NULL,
+    race TEXT NOT NULL,
+    odds BLOB NOT NULL,
+    captured_at TEXT NOT NULL,
+    PRIMARY KEY (race_date, race)
+);
+CREATE TABLE IF NOT EXISTS odds_imports (
+    file TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    races INTEGER NOT NULL,
+    imported_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS carryover (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+"""
+
+
+def history_connect(path: str | None = None) -> sqlite3.Connection:
+    """履歴ストアを開く。ファイルとテーブルがなければ作る。"""
+    conn = sqlite3.connect(path or HISTORY_DB_PATH, timeout=HISTORY_BUSY_TIMEOUT_SEC)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_HISTORY_SCHEMA)
+    # ゾーン別スケッチ導入前に保存された日は、ここで1回だけ作り直す。
+    missing = [
+        d for (d,) in conn.execute(
+            "SELECT DISTINCT race_date FROM races "
+            "WHERE race_date NOT IN (SELECT DISTINCT race_date FROM zone_sketches)"
+        )
+    ]
+    for race_date in missing:
+        history_rebuild_zone_sketches(conn, race_date)
+    return conn
+
+
+@contextmanager
+def history_write(conn: sqlite3.Connection):
+    """
+    書き込み1回分のトランザクション。書き手は常に1本だけにする。
+
+    BEGIN IMMEDIATE で最初に書き込みロックを取るので、途中で別の書き手とぶつかって
+    失敗することがない。読み手（スナップショット）は途中の状態を見ない。
+    """
+    with _HISTORY_WRITE_LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+def _write_zone_sketches(conn: sqlite3.Connection, race_date: str) -> None:
+    rows = history_load_races(conn, since=race_date, until=race_date)
+    sketches = aggregate_byrace_rows(rows)["zone_sketches"]
+    for zkey in ZONE_KEYS_ORDER:
+        conn.execute(
+            "INSERT OR REPLACE INTO zone_sketches (race_date, zone_key, sketch) VALUES (?, ?, ?)",
+            (str(race_date), zkey, payout_sketch_to_json(sketches.get(zkey, {}))),
+        )
+
+
+def history_rebuild_zone_sketches(conn: sqlite3.Connection, race_date: str) -> None:
+    """
+    1日分のゾーン別払戻スケッチを、その日の保存済みレースから作り直す。
+
+    レース本体は追記のみ。スケッチはレースから導く派生データなので日単位で置き換える。
+    対象ペアは NISHAFUKU_PAIRS（分析結果のゾーン中央値と同じ）。
+    """
+    with history_write(conn):
+        _write_zone_sketches(conn, race_date)
+
+
+def history_load_zone_sketches(conn: sqlite3.Connection, before: str | None = None) -> Dict[str, Dict[int, int]]:
+    """保存済みの日別スケッチを足し合わせた、ゾーン別の累積スケッチ。"""
+    sql = "SELECT zone_key, sketch FROM zone_sketches"
+    params: List = []
+    if before:
+        sql += " WHERE race_date < ?"
+        params.append(str(before))
+    merged = new_zone_sketches()
+    for zkey, text in conn.execute(sql, params):
+        if zkey in merged:
+            merge_payout_sketches(merged[zkey], payout_sketch_from_json(text))
+    return merged
+
+
+def history_append_races(conn: sqlite3.Connection, race_date: str, byrace_rows: List[Dict]) -> tuple[int, int, int]:
+    """
+    1日分の byrace_rows を追記する。
+
+    着順が未入力のレース（事前計算だけの出走表）は保存しない。保存すると同じ日・同じRの
+    再保存が無視されて、結果を入れても着順なしのまま残るため。
+    以前の版で着順なしのまま保存されたレースは、着順を入れて保存し直せば置き換える。
+    レースとその日のゾーン別スケッチは同じトランザクションで書くので、
+    ほかのセッションが途中の状態（レースだけ増えてスケッチが古い）を読むことはない。
+    戻り値は（保存件数, 既存のため無視した件数, 着順未入力で保存しなかった件数）。
+    """
+    created_at = datetime.now().isoformat(timespec="seconds")
+    saved = 0
+    skipped = 0
+    pending = 0
+    with history_write(conn):
+        for row in byrace_rows or []:
+            finish = "".join(str(x) for x in row.get("finish", []) or [])
+            if not finish:
+                pending += 1
+                continue
+            cur = conn.execute(
+                "INSERT INTO races "
+                "(race_date, race, field_n, vorder, finish, pay_2t, pay_2f, pay_3f, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (race_date, race) DO UPDATE SET "
+                "field_n = excluded.field_n, vorder = excluded.vorder, finish = excluded.finish, "
+                "pay_2t = excluded.pay_2t, pay_2f = excluded.pay_2f, pay_3f = excluded.pay_3f, "
+                "created_at = excluded.created_at "
+                "WHERE races.finish = ''",
+                (
+                    str(race_date),
+                    str(row.get("race", "")),
+                    int(row.get("field_n", 0) or 0),
+                    "".join(str(x) for x in row.get("vorder", []) or []),
+                    finish,
+                    int(row.get("pay_2t", 0) or 0),
+                    int(row.get("pay_2f", 0) or 0),
+                    int(row.get("pay_3f", 0) or 0),
+                    created_at,
+                ),
+            )
+            if cur.rowcount > 0:
+                saved += 1
+            else:
+                skipped += 1
+        if saved > 0:
+            _write_zone_sketches(conn, race_date)
+    return saved, skipped, pending
+
+
+def _history_race_query(
+    before: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+) -> tuple[str, List]:
+    sql = "SELECT race_date, race, field_n, vorder, finish, pay_2t, pay_2f, pay_3f FROM races"
+    where = []
+    params: List = []
+    if before:
+        where.append("race_date < ?")
+        params.append(str(before))
+    if since:
+        where.append("race_date >= ?")
+        params.append(str(since))
+    if until:
+        where.append("race_date <= ?")
+        params.append(str(until))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY race_date, id"
+    return sql, params
+
+
+def history_load_races(
+    conn: sqlite3.Connection,
+    before: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+) -> List[Dict]:
+    """
+    保存済みレースを byrace_rows と同じ形で読む。"date" 列を追加で持つ。
+
+    before：この日付より前（当日を含まない）。since：この日付以降。until：この日付まで（当日を含む）。
+    """
+    sql, params = _history_race_query(before=before, since=since, until=until)
+    rows = []
+    for race_date, race, field_n, vorder, finish, pay_2t, pay_2f, pay_3f in conn.execute(sql, params):
+        rows.append({
+            "date": race_date,
+            "race": race,
+            "field_n": int(field_n),
+            "vorder": list(vorder or ""),
+            "finish": list(finish or ""),
+            "pay_2t": int(pay_2t),
+            "pay_2f": int(pay_2f),
+            "pay_3f": int(pay_3f),
+        })
+    return rows
+
+
+def history_load_race_records(
+    conn: sqlite3.Connection,
+    before: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+) -> np.ndarray:
+    """
+    保存済みレースを構造化配列（RACE_RECORD_DTYPE）で読む。日付順。
+
+    行ごとのdictを作らずに、SQLの行から直接1レース1行へ詰める。
+    引数の意味は history_load_races と同じ。
+    """
+    sql, params = _history_race_query(before=before, since=since, until=until)
+    return _race_record_columns(
+        (race_date, race, int(field_n), vorder, finish or "", pay_2t, pay_2f, pay_3f)
+        for race_date, race, field_n, vorder, finish, pay_2t, pay_2f, pay_3f in conn.execute(sql, params)
+        if vorder
+    )
+
+
+def history_date_summary(conn: sqlite3.Connection) -> pd.DataFrame:
+    """保存済みの日付とレース数。"""
+    rows = conn.execute(
+        "SELECT race_date, COUNT(*) FROM races GROUP BY race_date ORDER BY race_date"
+    ).fetchall()
+    return pd.DataFrame(rows, columns=["日付", "R数"])
+
+
+# -------------------------
+# 手入力の引継ぎ（共有）
+# -------------------------
+# 履歴ストア導入前の累積（*_manual）を1人が入力して保存すれば、ほかのセッションはそれを読む。
+# 値は build_cumulative_totals の manual と同じ形の辞書。タプルのキー（評価ペア）はJSONで
+# リストになるので、[キー, 値] の並びとして保存して読み戻す。
+def _carryover_encode(value):
+    if isinstance(value, dict):
+        return {"items": [[list(k) if isinstance(k, tuple) else k, _carryover_encode(v)] for k, v in value.items()]}
+    return value
+
+
+def _carryover_decode(value):
+    if isinstance(value, dict) and "items" in value:
+        return {tuple(k) if isinstance(k, list) else k: _carryover_decode(v) for k, v in value["items"]}
+    return value
+
+
+def carryover_digest(manual: Dict) -> str:
+    """
+    手入力の引継ぎの内容ハッシュ（結果キャッシュの版に使う）。
+
+    画面の引継ぎは lambda を持つ defaultdict なのでそのままでは pickle できない。
+    保存と同じ形（ふつうの dict・list）にしてからハッシュする。
+    """
+    return content_hash(_carryover_encode(manual or {}))
+
+
+def history_save_carryover(conn: sqlite3.Connection, manual: Dict) -> None:
+    """手入力の引継ぎを保存する（キーごとに置き換え）。"""
+    updated_at = datetime.now().isoformat(timespec="seconds")
+    with history_write(conn):
+        for name, value in manual.items():
+            conn.execute(
+                "INSERT OR REPLACE INTO carryover (name, data, updated_at) VALUES (?, ?, ?)",
+                (str(name), json.dumps(_carryover_encode(value), ensure_ascii=False), updated_at),
+            )
+
+
+def history_load_carryover(conn: sqlite3.Connection) -> Dict:
+    """保存済みの手入力の引継ぎ。何もなければ空の辞書。"""
+    return {name: _carryover_decode(json.loads(data)) for name, data in conn.execute("SELECT name, data FROM carryover")}
+
+
+# -------------------------
+# 共有スナップショット（プロセス全体で1つ）
+# -------------------------
+# Streamlit のセッションごとに履歴を読み直して集計すると、セッション数だけメモリと時間を使う。
+# ここで (ストア, 基準日) ごとに1つだけ作り、全セッションが同じものを読む。
+# ストアの版（SQLite の data_version）が変わった時だけ、最初に来たセッションが作り直す。
+# スナップショットは読み出し専用（配列は書き込み不可）。書き換えずに合算の材料として使う。
+HISTORY_SNAPSHOT_MAXSIZE = 8
+
+_HISTORY_READERS: Dict[str, sqlite3.Connection] = {}
+_HISTORY_SNAPSHOTS: Dict[Tuple[str, str | None], Dict] = OrderedDict()
+_HISTORY_SNAPSHOT_LOCK = threading.Lock()
+
+
+def _history_reader(path: str) -> sqlite3.Connection:
+    conn = _HISTORY_READERS.get(path)
+    if conn is None:
+        history_connect(path).close()  # 初回はここでテーブルを作る
+        conn = sqlite3.connect(path, timeout=HISTORY_BUSY_TIMEOUT_SEC, check_same_thread=False)
+        _HISTORY_READERS[path] = conn
+    return conn
+
+
+def history_store_version(conn: sqlite3.Connection) -> int:
+    """ストアの版。ほかの接続がコミットするたびに変わる。"""
+    return int(conn.execute("PRAGMA data_version").fetchone()[0])
+
+
+def _freeze_arrays(obj) -> None:
+    if isinstance(obj, np.ndarray):
+        obj.setflags(write=False)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _freeze_arrays(v)
+
+
+@perf_timed
+def history_snapshot(path: str | None = None, before: str | None = None) -> Dict:
+    """
+    履歴ストアの共有スナップショット。
+
+    {"version", "before", "races", "agg"（aggregate_race_arrays と同じ形）, "zone_sketches",
+    "carryover", "dates", "odds"（オッズ記録のあるレースの {"records", "rank_odds"}）,
+    "token"（ストア・基準日・版の組。結果キャッシュのキーに使う）} を返す。版が同じ間は、どのセッションにも同じオブジェクトを返す。
+    """
+    path = os.path.abspath(path or HISTORY_DB_PATH)
+    key = (path, str(before) if before else None)
+    with _HISTORY_SNAPSHOT_LOCK:
+        conn = _history_reader(path)
+        version = history_store_version(conn)
+        snap = _HISTORY_SNAPSHOTS.get(key)
+        if snap is not None and snap["version"] == version:
+            _HISTORY_SNAPSHOTS.move_to_end(key)
+            return snap
+        # 1つの読み取りトランザクションで読むので、途中で書き込みがあっても各表の版はそろう。
+        with closing(conn.cursor()) as cur:
+            cur.execute("BEGIN")
+            try:
+                records = history_load_race_records(conn, before=before)
+                agg = aggregate_race_arrays(race_arrays_from_records(records))
+                zone_sketches = history_load_zone_sketches(conn, before=before)
+                carryover = history_load_carryover(conn)
+                dates = history_date_summary(conn)
+                odds = odds_load(conn, before=before)
+            finally:
+                cur.execute("ROLLBACK")
+        _freeze_arrays(agg)
+        # オッズ記録のあるレースだけ、評価順のオッズ行列と組にして持つ（厳密なゾーン別回収率用）。
+        rank_odds = odds_rank_matrix(records, odds)
+        has_odds = ~np.isnan(rank_odds).all(axis=1)
+        odds_view = {"records": records[has_odds], "rank_odds": rank_odds[has_odds]}
+        _freeze_arrays(odds_view)
+        snap = {
+            "version": version,
+            "before": key[1],
+            "races": int(len(records)),
+            "agg": agg,
+            "zone_sketches": zone_sketches,
+            "carryover": carryover,
+            "dates": dates,
+            "odds": odds_view,
+            "token": (path, key[1], version),
+        }
+        _HISTORY_SNAPSHOTS[key] = snap
+        _HISTORY_SNAPSHOTS.move_to_end(key)
+        while len(_HISTORY_SNAPSHOTS) > HISTORY_SNAPSHOT_MAXSIZE:
+            _HISTORY_SNAPSHOTS.popitem(last=False)
+        return snap
+
+
+# =========================
+# 2車複オッズ記録（全ペア・最終オッズ）
+# =========================
+# 外れたレースでも「そのペアがどのオッズ帯だったか」を残すための記録。
+# 1レース＝車番ペア21組の最終オッズを float32 の列にまとめ、SQLiteへ1行（84バイト）で保存する。
+# 車番で持つのは、V評価の入力を後で直しても市場の事実は変わらないため。
+# 評価順位へは、分析のときに履歴ストアのV評価で並べ替える。
+ODDS_CAR_PAIRS = [(a, b) for a in range(1, FIELD_SIZE + 1) for b in range(a + 1, FIELD_SIZE + 1)]
+_ODDS_PAIR_INDEX = {pair: i for i, pair in enumerate(ODDS_CAR_PAIRS)}
+ODDS_DROP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "odds_drop")
+
+_ODDS_CSV_COLUMNS = {
+    "date": ("date", "日付", "race_date"),
+    "race": ("race", "R", "レース"),
+    "pair": ("pair", "組", "買い目"),
+    "odds": ("odds", "オッズ"),
+}
+
+
+def odds_pair_index(pair) -> int | None:
+    """車番ペア（"3-5" / "3=5" / (3, 5)）の列番号。順不同。"""
+    try:
+        if isinstance(pair, str):
+            a, b = [int(x) for x in pair.replace("=", "-").split("-")]
+        else:
+            a, b = [int(x) for x in pair]
+    except Exception:
+        return None
+    return _ODDS_PAIR_INDEX.get((min(a, b), max(a, b)))
+
+
+def new_odds_row() -> np.ndarray:
+    """1レース分の空のオッズ列（全部NaN＝記録なし）。"""
+    return np.full(len(ODDS_CAR_PAIRS), np.nan, dtype=np.float32)
+
+
+def normalize_race_date(text) -> str:
+    """
+    日付の書き方（2026-10-17 / 2026/10/17 / 2026.10.17 / 20261017）を ISO 形式にそろえる。
+
+    履歴ストアのレース日は ISO 形式なので、オッズの日付もそろえないと突き合わせられない。
+    読めない日付は ValueError。
+    """
+    raw = str(text).strip()
+    s = raw.replace("/", "-").replace(".", "-")
+    try:
+        if "-" in s:
+            y, m, d = (int(x) for x in s.split("-"))
+            return date(y, m, d).isoformat()
+        return date.fromisoformat(s).isoformat()
+    except ValueError:
+        raise ValueError(f"bad date: {raw!r}") from None
+
+
+def odds_parse_csv(source) -> Dict[Tuple[str, str], np.ndarray]:
+    """
+    オッズCSV（パスかファイル風オブジェクト）を {(日付, R): オッズ列} にする。
+
+    縦持ち：date,race,pair,odds（1行1ペア。日本語見出し 日付,R,組,オッズ も可）
+    横持ち：date,race,1-2,1-3,...（1行1レース。列名は車番ペア）
+    空欄・0以下・数値でないオッズは記録なしとして扱う。文字コードは UTF-8、読めなければ cp932。
+    日付は normalize_race_date で ISO 形式にそろえ、読めない日付の行があれば ValueError。
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return odds_parse_csv(f)
+    text = source.read()
+    if isinstance(text, bytes):
+        try:
+            text = text.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            text = text.decode("cp932", errors="replace")  # Excel書き出しのShift_JIS
+    reader = csv.DictReader(text.splitlines())
+    header = list(reader.fieldnames or [])
+    col = {key: next((h for h in header if h.strip() in names), None) for key, names in _ODDS_CSV_COLUMNS.items()}
+    if col["date"] is None or col["race"] is None:
+        raise ValueError(f"odds csv needs date and race columns: {header}")
+    long_format = col["pair"] is not None and col["odds"] is not None
+    pair_cols = {h: odds_pair_index(h.strip()) for h in header}
+    pair_cols = {h: i for h, i in pair_cols.items() if i is not None}
+
+    out: Dict[Tuple[str, str], np.ndarray] = {}
+    for row in reader:
+        race_date, race = str(row[col["date"]] or "").strip(), str(row[col["race"]] or "").strip()
+        if not race_date or not race:
+            continue
+        try:
+            key = (normalize_race_date(race_date), race)
+        except ValueError as e:
+            raise ValueError(f"odds csv line {reader.line_num}: {e}") from None
+        odds = out.setdefault(key, new_odds_row())
+        if long_format:
+            items = [(odds_pair_index(str(row[col["pair"]]).strip()), row[col["odds"]])]
+        else:
+            items = [(i, row[h]) for h, i in pair_cols.items()]
+        for i, v in items:
+            x = _safe_float(v, None) if str(v or "").strip() else None
+            if i is not None and x is not None and x > 0:
+                odds[i] = x
+    return out
+
+
+def odds_store_races(conn: sqlite3.Connection, entries: Dict[Tuple[str, str], np.ndarray]) -> int:
+    """
+    オッズ列を保存する。同じレースが既にあれば、新しく値のあるペアだけ上書きする
+    （同じ日に何度取り込んでも最後のオッズが最終オッズになる）。日付は ISO 形式にそろえる。
+    戻り値は保存したレース数。
+    """
+    captured_at = datetime.now().isoformat(timespec="seconds")
+    entries = {(normalize_race_date(d), str(r)): odds for (d, r), odds in entries.items()}
+    with history_write(conn):
+        for (race_date, race), odds in entries.items():
+            odds = np.asarray(odds, dtype=np.float32)
+            prev = conn.execute(
+                "SELECT odds FROM odds_2f WHERE race_date = ? AND race = ?", (str(race_date), str(race))
+            ).fetchone()
+            if prev is not None:
+                merged = np.frombuffer(prev[0], dtype=np.float32).copy()
+                merged[~np.isnan(odds)] = odds[~np.isnan(odds)]
+                odds = merged
+            conn.execute(
+                "INSERT OR REPLACE INTO odds_2f (race_date, race, odds, captured_at) VALUES (?, ?, ?, ?)",
+                (str(race_date), str(race), odds.tobytes(), captured_at),
+            )
+    return len(entries)
+
+
+def odds_import_csv(conn: sqlite3.Connection, source) -> int:
+    """オッズCSVを読んで保存する。戻り値は保存したレース数。"""
+    return odds_store_races(conn, odds_parse_csv(source))
+
+
+def odds_import_dir(
+    conn: sqlite3.Connection, directory: str | None = None
+) -> Tuple[List[Tuple[str, int]], List[Tuple[str, str]]]:
+    """
+    取り込みフォルダ（既定 ODDS_DROP_DIR）の *.csv のうち、未取り込みのものを取り込む。
+
+    ファイルは動かさない。名前・サイズ・更新時刻が同じファイルは2回目以降は読まない
+    （スクレイパーが同じ名前で書き直した場合は取り込み直す）。
+    読めないファイルはそこで止めずに飛ばし、レース数-1で記録して書き直されるまで読まない。
+    戻り値は（[(ファイル名, レース数)], [(ファイル名, 読めなかった理由)]）。
+    """
+    directory = directory or ODDS_DROP_DIR
+    if not os.path.isdir(directory):
+        return [], []
+    done, failed = [], []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.lower().endswith(".csv") or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        seen = conn.execute(
+            "SELECT 1 FROM odds_imports WHERE file = ? AND size = ? AND mtime = ?",
+            (name, int(st.st_size), float(st.st_mtime)),
+        ).fetchone()
+        if seen:
+            continue
+        try:
+            n = odds_import_csv(conn, path)
+        except (ValueError, OSError, csv.Error) as e:
+            n = -1
+            failed.append((name, str(e)))
+        with history_write(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO odds_imports (file, size, mtime, races, imported_at) VALUES (?, ?, ?, ?, ?)",
+                (name, int(st.st_size), float(st.st_mtime), n, datetime.now().isoformat(timespec="seconds")),
+            )
+        if n >= 0:
+            done.append((name, n))
+    return done, failed
+
+
+def odds_load(
+    conn: sqlite3.Connection,
+    before: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+) -> Dict[Tuple[str, str], np.ndarray]:
+    """保存済みのオッズ列 {(日付, R): float32[21]}。日付の絞り込みは history_load_races と同じ。"""
+    sql = "SELECT race_date, race, odds FROM odds_2f"
+    where, params = [], []
+    for op, value in (("<", before), (">=", since), ("<=", until)):
+        if value:
+            where.append(f"race_date {op} ?")
+            params.append(str(value))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return {
+        (race_date, race): np.frombuffer(blob, dtype=np.float32)
+        for race_date, race, blob in conn.execute(sql, params)
+    }
+
+
+@lru_cache(maxsize=None)
+def _rank_pair_car_index(cars: int, vperm: int) -> np.ndarray:
+    """V評価（車番集合・順列番号）での、評価ペア21組→車番ペアの列番号（評価が頭数外なら-1）。"""
+    vorder = _vorder_decode(cars, vperm)
+    idx = np.full(len(ODDS_CAR_PAIRS), -1, dtype=np.intp)
+    for i, (a, b) in enumerate(ODDS_CAR_PAIRS):
+        if b <= len(vorder):
+            idx[i] = _ODDS_PAIR_INDEX.get(tuple(sorted((int(vorder[a - 1]), int(vorder[b - 1])))), -1)
+    return idx
+
+
+def odds_rank_matrix(records: np.ndarray, odds: Dict[Tuple[str, str], np.ndarray]) -> np.ndarray:
+    """
+    レース記録（RACE_RECORD_DTYPE）に合わせた、評価ペア順のオッズ行列（レース数×21、float32）。
+
+    列は ODDS_CAR_PAIRS と同じ並びを評価順位で読んだもの（列0が評価1-2）。
+    オッズ記録のないレース・存在しない評価はNaN。
+    """
+    out = np.full((len(records), len(ODDS_CAR_PAIRS)), np.nan, dtype=np.float32)
+    if len(records) == 0 or not odds:
+        return out
+    # レースごとのオッズ行（なければ最後の全NaN行）と、V評価ごとの評価ペア→車番ペアの表を引く。
+    keys = list(odds)
+    row_of = {k: i for i, k in enumerate(keys)}
+    stacked = np.vstack([np.asarray(odds[k], dtype=np.float32) for k in keys] + [new_odds_row()])
+    rows = np.array([
+        row_of.get((d, r), len(keys))
+        for d, r in zip(records["date"].astype(str), records["race"].tolist())
+    ], dtype=np.intp)
+    code = records["cars"].astype(np.int64) << 16 | records["vperm"].astype(np.int64)
+    uniq, inverse = np.unique(code, return_inverse=True)
+    table = np.vstack([_rank_pair_car_index(int(u >> 16), int(u & 0xFFFF)) for u in uniq])
+    idx = table[inverse]
+    ok = idx >= 0
+    out[ok] = stacked[np.broadcast_to(rows[:, None], idx.shape)[ok], idx[ok]]
+    return out
+
+
+@perf_timed
+def build_exact_zone_roi_table(
+    records: np.ndarray,
+    rank_odds: np.ndarray,
+    pairs: List[Tuple[int, int]],
+) -> pd.DataFrame:
+    """
+    個別2車複ゾーン別 実回収率表（build_virtual_zone_roi_table の厳密版）。
+
+    ゾーンは外れも含めて、そのレースのそのペアの最終オッズで決める。
+    各ゾーンセルは「的中本数・対象R / 回収率」で、対象Rは着順（1・2着）が分かり、
+    オッズの記録があるレース。払戻は2車複払戻、未入力なら最終オッズ×100円で補う。
+    """
+    races = race_arrays_from_records(records)
+    known = _top2_known(races)
+    pay = races["pay_2f"]
+    rows = []
+    for a, b in pairs:
+        col = _ODDS_PAIR_INDEX.get((min(a, b), max(a, b)))
+        if col is None:
+            continue
+        ksum, hit = batch_nishafuku_pair(races, a, b)
+        odds = rank_odds[:, col].astype(np.float64)
+        use = (ksum > 0) & known & ~np.isnan(odds)
+        yen = np.round(np.nan_to_num(odds) * 100.0)
+        zone = np.digitize(yen, _PAYOUT_ZONE_EDGES_YEN, right=True)
+        paid = np.where(pay > 0, pay, np.round(yen / PAYOUT_SKETCH_BIN_YEN) * PAYOUT_SKETCH_BIN_YEN)
+
+        n_all = int(np.count_nonzero(use))
+        ret_all = float(paid[use & hit].sum())
+        total_roi = round(100.0 * ret_all / (n_all * 100.0), 1) if n_all > 0 else None
+        row = {
+            "ペア": f"{a}-{b}",
+            "オッズ記録N": n_all,
+            "合計回収率%": total_roi,
+            "判定": _virtual_roi_judgement(total_roi),
+        }
+        for z, zone_key in enumerate(ZONE_KEYS_ORDER):
+            in_zone = use & (zone == z)
+            n = int(np.count_nonzero(in_zone))
+            h = int(np.count_nonzero(in_zone & hit))
+            roi = 100.0 * float(paid[in_zone & hit].sum()) / (n * 100.0) if n > 0 else None
+            row[ZONE_LABELS[zone_key]] = f"{h}本・{n}R / —" if roi is None else f"{h}本・{n}R / {roi:.1f}%"
+        rows.append(row)
+    return pd.DataFrame(rows)
+
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+ライブ2車複オッズの取り込みと、最低必要オッズ到達の通知。
+
+自前のフィーダーからオッズを受け取り、レースごとの最新オッズをメモリに持つ。
+1件届くたびに、そのレースの候補だけを採点し直し、現在オッズが最低必要オッズを
+上回った（到達）／下回った（割れ）買い目を1行1JSONで通知する。
+候補と最低必要オッズは、履歴ストアの --date より前の累積（保存済みの引継ぎ込み。画面・API と同じ）から
+個別2車複のEV診断で作る。
+
+    python perfect4_live.py --card card.csv --date 2025-06-01 --listen 127.0.0.1:8766
+    python perfect4_live.py --card card.csv --date 2025-06-01 --watch odds_feed.jsonl
+
+出走表（--card）は一括入力と同じ形式（R, 頭数, V評価, 着順）で、着順は空欄でよい。
+フィードは1行1JSONで、ペアは車番：
+    {"race": "5", "pair": "3-5", "odds": 7.2}
+    {"race": "5", "odds": {"3-5": 7.2, "1-3": 4.1}}
+"ts"（送信時刻, UNIX秒）があれば、通知に送信からの遅延も載せる。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from contextlib import closing
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+from perfect4_core import (
+    ODDS_CAR_PAIRS,
+    build_cumulative_totals,
+    build_df_pairs,
+    history_connect,
+    history_snapshot,
+    new_daily_aggregates,
+    new_odds_row,
+    normalize_race_date,
+    odds_pair_index,
+    odds_store_races,
+    parse_bulk_races,
+)
+
+# ファイル監視の間隔（秒）。通知までの遅延の上限はほぼこの値になる。
+WATCH_INTERVAL_SEC = 0.05
+# フィードを受ける既定のポート（perfect4_api.DEFAULT_API_PORT とずらす）。
+DEFAULT_LIVE_PORT = 8766
+
+
+def live_candidates(df_pairs: pd.DataFrame) -> pd.DataFrame:
+    """最低必要オッズが出ている個別2車複（着順ペア）だけを、通知の候補にする。"""
+    if df_pairs is None or df_pairs.empty or "最低必要オッズ" not in df_pairs.columns:
+        return pd.DataFrame(columns=["ペアキー", "p_safe%", "最低必要オッズ"])
+    need = pd.to_numeric(df_pairs["最低必要オッズ"], errors="coerce")
+    return df_pairs.loc[need.notna() & (need > 0), ["ペアキー", "p_safe%", "最低必要オッズ"]].reset_index(drop=True)
+
+
+def build_live_card(byrace_rows: List[Dict], candidates: pd.DataFrame) -> Dict[str, Dict]:
+    """
+    出走表と候補から、レースごとの採点状態を作る。
+
+    着順ペア→車番ペアの対応はここで1回だけ引いておき、ティックごとの採点は
+    そのレースの候補配列（最大21本）を見るだけにする。
+    """
+    keys = candidates["ペアキー"].astype(str).tolist()
+    p_safe = pd.to_numeric(candidates["p_safe%"], errors="coerce").fillna(0.0).to_numpy(dtype=float) / 100.0
+    need = pd.to_numeric(candidates["最低必要オッズ"], errors="coerce").to_numpy(dtype=float)
+    rank_pairs = [tuple(int(x) for x in k.split("-")) for k in keys]
+
+    card: Dict[str, Dict] = {}
+    for row in byrace_rows:
+        vorder = [str(c) for c in row.get("vorder", [])]
+        take, cars, col = [], [], []
+        for i, (a, b) in enumerate(rank_pairs):
+            if b > len(vorder):
+                continue
+            idx = odds_pair_index((vorder[a - 1], vorder[b - 1]))
+            if idx is None:
+                continue
+            take.append(i)
+            lo, hi = sorted((int(vorder[a - 1]), int(vorder[b - 1])))
+            cars.append(f"{lo}={hi}")
+            col.append(idx)
+        take_idx = np.asarray(take, dtype=np.intp)
+        card[str(row["race"])] = {
+            "vorder": vorder,
+            "keys": [keys[i] for i in take],
+            "cars": cars,
+            "col": np.asarray(col, dtype=np.intp),
+            "p_safe": p_safe[take_idx],
+            "need": need[take_idx],
+            "odds": new_odds_row(),
+            "above": np.zeros(len(take), dtype=bool),
+            "ticks": 0,
+        }
+    return card
+
+
+def parse_odds_message(line) -> Dict | None:
+    """フィード1行を {"race", "odds": {列番号: オッズ}, "ts"} にする。読めない行は None。"""
+    try:
+        msg = json.loads(line) if isinstance(line, (str, bytes)) else line
+        race = str(msg["race"])
+        if "pair" in msg:
+            items = {msg["pair"]: msg["odds"]}
+        else:
+            items = dict(msg["odds"])
+    except Exception:
+        return None
+    updates: Dict[int, float] = {}
+    for pair, odds in items.items():
+        idx = odds_pair_index(pair)
+        try:
+            value = float(odds)
+        except Exception:
+            continue
+        if idx is not None and np.isfinite(value) and value > 0:
+            updates[idx] = value
+    if not updates:
+        return None
+    ts = msg.get("ts")
+    return {"race": race, "odds": updates, "ts": float(ts) if isinstance(ts, (int, float)) else None}
+
+
+def apply_odds_update(card: Dict[str, Dict], update: Dict) -> List[Dict]:
+    """
+    オッズ更新を1件反映し、そのレースの候補だけを採点し直す。
+
+    戻り値は状態が変わった買い目の通知（到達／割れ）。出走表にないレースは無視する。
+    """
+    state = card.get(update["race"])
+    if state is None:
+        return []
+    odds = state["odds"]
+    for idx, value in update["odds"].items():
+        odds[idx] = value
+    state["ticks"] += 1
+    if len(state["col"]) == 0:
+        return []
+
+    live = odds[state["col"]].astype(float)
+    above = live >= state["need"]  # NaN（未着）は到達しない
+    changed = np.flatnonzero(above != state["above"])
+    state["above"] = above
+    alerts = []
+    for i in changed:
+        alerts.append({
+            "race": update["race"],
+            "目": state["keys"][i],
+            "車番": state["cars"][i],
+            "状態": "到達" if above[i] else "割れ",
+            "現在オッズ": round(float(live[i]), 1) if np.isfinite(live[i]) else None,
+            "最低必要オッズ": round(float(state["need"][i]), 2),
+            "参考EV": round(float(state["p_safe"][i] * live[i]), 3) if np.isfinite(live[i]) else None,
+        })
+    return alerts
+
+
+def handle_feed_line(card: Dict[str, Dict], line, on_alert: Callable[[Dict], None], received: float | None = None) -> int:
+    """フィード1行を反映して通知する。通知には受信からの遅延（と送信からの遅延）を付ける。"""
+    received = time.perf_counter() if received is None else received
+    update = parse_odds_message(line)
+    if update is None:
+        return 0
+    alerts = apply_odds_update(card, update)
+    if not alerts:
+        return 0
+    latency_ms = round((time.perf_counter() - received) * 1000.0, 3)
+    sent_ms = round((time.time() - update["ts"]) * 1000.0, 3) if update["ts"] is not None else None
+    for alert in alerts:
+        alert["遅延ms"] = latency_ms
+        if sent_ms is not None:
+            alert["送信からms"] = sent_ms
+        on_alert(alert)
+    return len(alerts)
+
+
+def print_alert(alert: Dict) -> None:
+    """通知を1行1JSONで標準出力へ。"""
+    print(json.dumps(alert, ensure_ascii=False), flush=True)
+
+
+async def serve_socket(card: Dict[str, Dict], host: str, port: int, on_alert: Callable[[Dict], None]) -> None:
+    """TCPでフィードを受ける（接続ごとに1行1JSON）。止めるまで戻らない。"""
+
+    async def _client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                handle_feed_line(card, line, on_alert)
+        except ConnectionError:
+            pass  # フィーダー側の切断。次の接続を待つ
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(_client, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def watch_file(
+    card: Dict[str, Dict],
+    path: str,
+    on_alert: Callable[[Dict], None],
+    interval: float = WATCH_INTERVAL_SEC,
+) -> None:
+    """
+    フィーダーが追記するファイルを末尾から読む。止めるまで戻らない。
+
+    起動時点の中身も読む（途中から起動しても最新オッズがそろう）。
+    ファイルが縮んだら作り直されたとみなして先頭から読み直す。
+    """
+    offset = 0
+    pending = b""
+    while True:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        if size is not None and size < offset:
+            offset, pending = 0, b""
+        if size is not None and size > offset:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                chunk = f.read(size - offset)
+            offset += len(chunk)
+            received = time.perf_counter()
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()  # 書きかけの行は次回へ
+            for line in lines:
+                if line.strip():
+                    handle_feed_line(card, line, on_alert, received)
+        await asyncio.sleep(interval)
+
+
+def card_final_odds(card: Dict[str, Dict], race_date: str) -> Dict:
+    """メモリ上の最新オッズを odds_store_races の形にする（記録のあるレースだけ）。"""
+    return {
+        (race_date, race): state["odds"]
+        for race, state in card.items()
+        if not np.isnan(state["odds"]).all()
+    }
+
+
+def load_live_card(db_path: str | None, card_text: str, race_date: str) -> tuple[Dict[str, Dict], List[Dict]]:
+    """
+    出走表と、race_date より前の累積から採点状態を作る。戻り値は（状態, 出走表の確認一覧）。
+
+    累積は画面・API と同じく、履歴ストアの共有スナップショットに保存済みの引継ぎを足したもの。
+    """
+    rows, issues = parse_bulk_races(card_text)
+    snap = history_snapshot(db_path, before=normalize_race_date(race_date))
+    totals = build_cumulative_totals(new_daily_aggregates(), snap["agg"], snap["carryover"])
+    return build_live_card(rows, live_candidates(build_df_pairs(totals))), issues
+
+
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="ライブ2車複オッズを取り込み、最低必要オッズ到達を通知する")
+    ap.add_argument("--card", required=True, help="出走表（R, 頭数, V評価, 着順は空欄可）")
+    ap.add_argument("--date", required=True, help="開催日（YYYY-MM-DD）。この日より前の履歴で候補を作る")
+    ap.add_argument("--db", default=None, help="履歴ストアのパス（既定：perfect4_history.sqlite3）")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument(
+        "--listen", default=None, help=f"TCPで受ける（HOST:PORT、PORT 省略時は {DEFAULT_LIVE_PORT}）"
+    )
+    src.add_argument("--watch", default=None, help="フィーダーが追記するファイルを監視する")
+    ap.add_argument("--interval", type=float, default=WATCH_INTERVAL_SEC, help="ファイル監視の間隔（秒）")
+    ap.add_argument("--store", action="store_true", help="終了時に最新オッズを最終オッズとして履歴ストアへ保存する")
+    args = ap.parse_args(argv)
+
+    with open(args.card, encoding="utf-8-sig") as f:
+        card_text = f.read()
+    card, issues = load_live_card(args.db, card_text, args.date)
+    for issue in issues:
+        print(f"出走表 {issue['行']}行目 R{issue['R']}: {issue['内容']}", file=sys.stderr)
+    if not card:
+        print("出走表にレースがありません。", file=sys.stderr)
+        return 1
+    n_cand = sum(len(s["keys"]) for s in card.values())
+    print(f"{len(card)}R・候補{n_cand}点で待ち受けます（2車複 {len(ODDS_CAR_PAIRS)}ペア）。", file=sys.stderr)
+
+    if args.listen:
+        host, sep, port = args.listen.rpartition(":")
+        if not sep:
+            host, port = args.listen, ""  # "127.0.0.1" のようにポートなし
+        feed = serve_socket(card, host or "127.0.0.1", int(port or DEFAULT_LIVE_PORT), print_alert)
+    else:
+        feed = watch_file(card, args.watch, print_alert, args.interval)
+    try:
+        asyncio.run(feed)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.store:
+            with closing(history_connect(args.db)) as conn:
+                n = odds_store_races(conn, card_final_odds(card, args.date))
+            print(f"最新オッズを{n}R分保存しました。", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
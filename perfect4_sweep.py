@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+EV診断・ワイド切替の定数を、履歴ストアで総当たり／ランダム探索する。
+
+対象の定数：
+  ・ev_k / ev_n0 / ev_h0   … EV_K_MAP / EV_N0_MAP / EV_H0_MAP の2車複の値
+  ・condition_margin       … calculate_ev_metrics の条件割引
+  ・wide12_target_ev       … WIDE12_TARGET_EV
+  ・wide12_safety_factor   … WIDE12_SAFETY_FACTOR
+
+評価はウォークフォワード（各日の判断はその日より前の累積だけ）で、次の2つの買い方の成績を合算する：
+  ・2車複EV推奨：個別2車複のうち、EV判定ラベルが「強推奨／推奨」のペアをその日の全レースで買う
+  ・ワイド切替：推奨流れ 1-2 / 1-3 / 2-3 の a-b-全 三連複を、それまでの的中時の平均合成オッズが
+    安全係数込みの推奨下限合成オッズ以上の日だけ買う
+定数に依存しない日ごとの累積は最初に1回だけ作り、パラメータごとの評価はプロセスプールで並列に回す。
+
+    python perfect4_sweep.py --db perfect4_history.sqlite3 --random 200 --out sweep.csv
+"""
+
+import argparse
+import itertools
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from typing import List, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from perfect4_core import (
+    EV_H0_MAP,
+    EV_K_MAP,
+    EV_N0_MAP,
+    WIDE12_SAFETY_FACTOR,
+    WIDE12_TARGET_EV,
+    _single_ev_label,
+    aggregate_race_arrays,
+    batch_nishafuku_pair,
+    batch_sanrenpuku_pair_all,
+    build_nishafuku_pairs_frame,
+    calculate_ev_metrics,
+    history_connect,
+    history_load_race_records,
+    merge_daily_aggregates,
+    new_daily_aggregates,
+    pair_counts_from_tensor,
+    race_array_count,
+    race_arrays_from_records,
+    wide_pair_switch_stats,
+)
+from perfect4_backtest import _max_drawdown, load_history_days, score_bet_masks
+
+# 日×パラメータごとに入力が変わり命中しないので、画面用の結果キャッシュは通さない。
+_calculate_ev_metrics = calculate_ev_metrics.__wrapped__
+
+WIDE_SWITCH_PAIRS = [(1, 2), (1, 3), (2, 3)]
+EV_BUY_LABELS = ("強推奨", "推奨")
+
+# 現行の定数。探索結果の比較基準として必ず1行入れる。
+CURRENT_PARAMS = {
+    "ev_k": float(EV_K_MAP["2車複"]),
+    "ev_n0": float(EV_N0_MAP["2車複"]),
+    "ev_h0": float(EV_H0_MAP["2車複"]),
+    "condition_margin": 0.90,
+    "wide12_target_ev": float(WIDE12_TARGET_EV),
+    "wide12_safety_factor": float(WIDE12_SAFETY_FACTOR),
+}
+
+DEFAULT_GRID = {
+    "ev_k": [50, 75, 100, 150],
+    "ev_n0": [30, 50, 80],
+    "ev_h0": [3, 5, 8],
+    "condition_margin": [0.80, 0.85, 0.90, 0.95],
+    "wide12_target_ev": [1.00, 1.10, 1.20],
+    "wide12_safety_factor": [1.00, 1.15, 1.30],
+}
+
+# ランダム探索の範囲（下限, 上限）。ev_k/ev_n0/ev_h0 は整数に丸める。
+DEFAULT_SPACE = {
+    "ev_k": (20, 250),
+    "ev_n0": (10, 150),
+    "ev_h0": (1, 15),
+    "condition_margin": (0.70, 1.00),
+    "wide12_target_ev": (0.95, 1.40),
+    "wide12_safety_factor": (1.00, 1.50),
+}
+_INT_PARAMS = ("ev_k", "ev_n0", "ev_h0")
+# ワイド切替だけが読む定数。3連複の払戻が記録されていない履歴では結果を変えない。
+WIDE_PARAMS = ("wide12_target_ev", "wide12_safety_factor")
+
+
+def param_grid(grid: Dict[str, List] | None = None) -> List[Dict[str, float]]:
+    """総当たりのパラメータ列。EV側が同じものが連続する順に並べる（ワーカー内キャッシュが効く）。"""
+    grid = grid or DEFAULT_GRID
+    keys = list(CURRENT_PARAMS)
+    values = [list(grid.get(k, [CURRENT_PARAMS[k]])) for k in keys]
+    return [dict(zip(keys, combo)) for combo in itertools.product(*values)]
+
+
+def random_param_sets(n: int, seed: int = 0, space: Dict[str, Tuple[float, float]] | None = None) -> List[Dict[str, float]]:
+    space = space or DEFAULT_SPACE
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(int(n)):
+        p = {}
+        for k in CURRENT_PARAMS:
+            lo, hi = space.get(k, (CURRENT_PARAMS[k], CURRENT_PARAMS[k]))
+            v = rnd.uniform(lo, hi)
+            p[k] = float(round(v)) if k in _INT_PARAMS else round(v, 3)
+        out.append(p)
+    return out
+
+
+# =========================
+# 定数に依存しない日ごとの準備
+# =========================
+def prepare_sweep_days(
+    days: List[Tuple[str, Dict[str, np.ndarray]]],
+    initial_agg: Dict | None = None,
+    min_history_races: int = 50,
+) -> List[Dict]:
+    """
+    各日について「その日より前の累積」から、定数に依存しない部分だけを作っておく。
+
+    pairs_frame：EV診断列を付ける前の個別2車複 累積表
+    trio_all_odds：a-b-全 三連複の、前日までの的中時の平均合成オッズ（払戻入力ありの的中だけ）
+    """
+    agg = initial_agg if initial_agg is not None else new_daily_aggregates()
+    odds_sum = {pair: 0.0 for pair in WIDE_SWITCH_PAIRS}
+    odds_n = {pair: 0 for pair in WIDE_SWITCH_PAIRS}
+    prepared = []
+
+    for race_date, races in days:
+        tensor = agg["finish_tensor"]
+        if int(tensor.sum()) >= int(min_history_races) and race_array_count(races) > 0:
+            pair12 = pair_counts_from_tensor(tensor, "12")
+            prepared.append({
+                "date": race_date,
+                "races": races,
+                "pairs_frame": build_nishafuku_pairs_frame(agg["payout_nishafuku"], pair12),
+                "pair12": pair12,
+                "pair13": pair_counts_from_tensor(tensor, "13"),
+                "pair23": pair_counts_from_tensor(tensor, "23"),
+                "trio_all_odds": {
+                    pair: (odds_sum[pair] / odds_n[pair] if odds_n[pair] > 0 else None)
+                    for pair in WIDE_SWITCH_PAIRS
+                },
+            })
+
+        for a, b in WIDE_SWITCH_PAIRS:
+            ksum, hit = batch_sanrenpuku_pair_all(races, a, b)
+            paid = hit & (ksum > 0) & (races["pay_3f"] > 0)
+            odds_sum[(a, b)] += float((races["pay_3f"][paid] / (100.0 * ksum[paid])).sum())
+            odds_n[(a, b)] += int(np.count_nonzero(paid))
+        merge_daily_aggregates(agg, aggregate_race_arrays(races))
+
+    return prepared
+
+
+def wide_switch_active(prepared: List[Dict]) -> bool:
+    """
+    ワイド切替が1日でも買う可能性があるか。
+
+    買うかどうかは前日までの平均合成オッズで決まり、それは3連複の払戻（pay_3f）が
+    入った的中からしか作れない。どの日にも平均合成オッズがなければ、ワイド側の定数は
+    どの値でも結果が同じになる。
+    """
+    return any(odds is not None for day in prepared for odds in day["trio_all_odds"].values())
+
+
+def drop_inactive_axes(param_sets: List[Dict[str, float]], prepared: List[Dict]) -> Tuple[List[Dict[str, float]], List[str]]:
+    """
+    結果を変えない定数の軸を現行値に固定し、同じになった組を1つにまとめる。
+
+    戻り値は（パラメータ列, 固定した定数名）。いまはワイド切替が買えない履歴のときの
+    WIDE_PARAMS だけが対象。
+    """
+    if wide_switch_active(prepared):
+        return [dict(p) for p in param_sets], []
+    out, seen = [], set()
+    for p in param_sets:
+        q = {**p, **{k: CURRENT_PARAMS[k] for k in WIDE_PARAMS}}
+        key = tuple(q[k] for k in CURRENT_PARAMS)
+        if key not in seen:
+            seen.add(key)
+            out.append(q)
+    return out, list(WIDE_PARAMS)
+
+
+# =========================
+# パラメータ1組の評価
+# =========================
+def _empty_result() -> Dict[str, int]:
+    return {"R数": 0, "投資": 0, "的中R": 0, "払戻": 0, "払戻不明的中": 0}
+
+
+def _add_result(dst: Dict[str, int], src: Dict[str, int]) -> None:
+    for k in dst:
+        dst[k] += int(src.get(k, 0))
+
+
+def evaluate_ev_pairs_day(day: Dict, params: Dict[str, float]) -> Dict[str, int]:
+    """2車複EV推奨：EV判定が強推奨／推奨のペアを、その日の全レースで1点ずつ買う。"""
+    df = _calculate_ev_metrics(
+        day["pairs_frame"],
+        "2車複",
+        condition_margin=float(params["condition_margin"]),
+        k_map={"2車複": float(params["ev_k"])},
+        n0_map={"2車複": float(params["ev_n0"])},
+        h0_map={"2車複": float(params["ev_h0"])},
+    )
+    res = _empty_result()
+    if df is None or df.empty:
+        return res
+    races = day["races"]
+    for _, row in df.iterrows():
+        label = _single_ev_label(row.get("参考EV"), row.get("Confidence"), row.get("odds_ratio"), bool(row.get("is_anchor")))
+        if label not in EV_BUY_LABELS:
+            continue
+        try:
+            a, b = [int(x) for x in str(row.get("ペアキー", "")).split("-")]
+        except Exception:
+            continue
+        ksum, hit = batch_nishafuku_pair(races, a, b)
+        _add_result(res, score_bet_masks(ksum, hit, races["pay_2f"]))
+    return res
+
+
+def evaluate_wide_switch_day(day: Dict, params: Dict[str, float]) -> Dict[str, int]:
+    """ワイド切替：平均合成オッズが推奨下限合成オッズ以上の a-b-全 三連複だけ買う。"""
+    res = _empty_result()
+    races = day["races"]
+    for a, b in WIDE_SWITCH_PAIRS:
+        odds = day["trio_all_odds"].get((a, b))
+        if odds is None:
+            continue
+        stats = wide_pair_switch_stats(
+            a, b, day["pair12"], day["pair13"], day["pair23"],
+            target_ev=float(params["wide12_target_ev"]),
+            safety_factor=float(params["wide12_safety_factor"]),
+        )
+        min_odds = stats["recommended_min_odds"]
+        if min_odds is None or odds < min_odds:
+            continue
+        ksum, hit = batch_sanrenpuku_pair_all(races, a, b)
+        _add_result(res, score_bet_masks(ksum, hit, races["pay_3f"]))
+    return res
+
+
+def _summary(prefix: str, res: Dict[str, int]) -> Dict:
+    invest = res["投資"]
+    return {
+        f"{prefix}投資": invest,
+        f"{prefix}払戻": res["払戻"],
+        f"{prefix}回収率%": round(100.0 * res["払戻"] / invest, 1) if invest > 0 else None,
+        f"{prefix}的中率%": round(100.0 * res["的中R"] / res["R数"], 1) if res["R数"] > 0 else None,
+    }
+
+
+def evaluate_params(params: Dict[str, float], prepared: List[Dict], ev_cache: Dict | None = None) -> Dict:
+    """
+    パラメータ1組を全日で評価する。
+
+    2車複EV推奨の日別成績はワイド側の定数に依存しないので、ev_cache があれば使い回す。
+    """
+    ev_key = tuple(float(params[k]) for k in ("ev_k", "ev_n0", "ev_h0", "condition_margin"))
+    ev_days = ev_cache.get(ev_key) if ev_cache is not None else None
+    if ev_days is None:
+        ev_days = [evaluate_ev_pairs_day(day, params) for day in prepared]
+        if ev_cache is not None:
+            ev_cache[ev_key] = ev_days
+
+    ev_total, wide_total, total = _empty_result(), _empty_result(), _empty_result()
+    daily_pnl = []
+    for day, ev_res in zip(prepared, ev_days):
+        wide_res = evaluate_wide_switch_day(day, params)
+        _add_result(ev_total, ev_res)
+        _add_result(wide_total, wide_res)
+        _add_result(total, ev_res)
+        _add_result(total, wide_res)
+        daily_pnl.append(ev_res["払戻"] + wide_res["払戻"] - ev_res["投資"] - wide_res["投資"])
+
+    out = dict(params)
+    out.update({
+        "日数": len(prepared),
+        "購入R": total["R数"],
+        "投資": total["投資"],
+        "払戻": total["払戻"],
+        "収支": total["払戻"] - total["投資"],
+        "回収率%": round(100.0 * total["払戻"] / total["投資"], 1) if total["投資"] > 0 else None,
+        "的中率%": round(100.0 * total["的中R"] / total["R数"], 1) if total["R数"] > 0 else None,
+        "最大DD": _max_drawdown(pd.Series(daily_pnl, dtype="int64")),
+        "払戻不明的中": total["払戻不明的中"],
+    })
+    out.update(_summary("2車複EV_", ev_total))
+    out.update(_summary("ワイド切替_", wide_total))
+    return out
+
+
+# =========================
+# プロセスプール
+# =========================
+_WORKER_PREPARED: List[Dict] = []
+_WORKER_EV_CACHE: Dict = {}
+
+
+def _init_worker(prepared: List[Dict]) -> None:
+    global _WORKER_PREPARED
+    _WORKER_PREPARED = prepared
+    _WORKER_EV_CACHE.clear()
+
+
+def _evaluate_in_worker(params: Dict[str, float]) -> Dict:
+    return evaluate_params(params, _WORKER_PREPARED, _WORKER_EV_CACHE)
+
+
+def run_sweep(
+    prepared: List[Dict],
+    param_sets: List[Dict[str, float]],
+    workers: int | None = None,
+) -> pd.DataFrame:
+    """
+    パラメータ列を全コアで評価し、回収率の高い順（同率は最大DDの小さい順）に並べて返す。
+    現行定数の行には「現行」列に印を付ける。workers=1 なら並列にしない。
+    結果を変えない軸（drop_inactive_axes）は現行値に固定し、同じ結果の行を並べない。
+    """
+    param_sets, _ = drop_inactive_axes(param_sets, prepared)
+    if not any(p == CURRENT_PARAMS for p in param_sets):
+        param_sets.insert(0, dict(CURRENT_PARAMS))
+
+    workers = workers or os.cpu_count() or 1
+    # EV側が同じパラメータは同じワーカーへ送りたいので、連続した塊で配る。
+    chunk = max(1, len(param_sets) // (workers * 4))
+    if workers <= 1:
+        cache: Dict = {}
+        rows = [evaluate_params(p, prepared, cache) for p in param_sets]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(prepared,)) as pool:
+            rows = list(pool.map(_evaluate_in_worker, param_sets, chunksize=chunk))
+
+    df = pd.DataFrame(rows)
+    df["現行"] = [p == CURRENT_PARAMS for p in param_sets]
+    df = df.sort_values(["回収率%", "最大DD"], ascending=[False, True], na_position="last")
+    df.insert(0, "順位", range(1, len(df) + 1))
+    return df.reset_index(drop=True)
+
+
+def main(argv: List[str] | None = None) -> None:
+    ap = argparse.ArgumentParser(description="EV診断・ワイド切替の定数を履歴ストアで探索する")
+    ap.add_argument("--db", default=None, help="履歴ストアのパス（既定：perfect4_history.sqlite3）")
+    ap.add_argument("--since", default=None, help="この日付以降で評価（YYYY-MM-DD）。前の履歴は初期累積に使う")
+    ap.add_argument("--until", default=None, help="この日付まで評価（YYYY-MM-DD）")
+    ap.add_argument("--min-history", type=int, default=50, help="評価を始める累積R数")
+    ap.add_argument("--random", type=int, default=0, help="ランダム探索の件数（0なら既定グリッドを総当たり）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--workers", type=int, default=None, help="プロセス数（既定：全コア）")
+    ap.add_argument("--top", type=int, default=20, help="表示する上位件数")
+    ap.add_argument("--out", default=None, help="全結果のCSV出力先")
+    args = ap.parse_args(argv)
+
+    with closing(history_connect(args.db)) as conn:
+        days = load_history_days(conn, since=args.since, until=args.until)
+        initial = None
+        if args.since:
+            initial = aggregate_race_arrays(race_arrays_from_records(history_load_race_records(conn, before=args.since)))
+    prepared = prepare_sweep_days(days, initial_agg=initial, min_history_races=args.min_history)
+
+    param_sets = random_param_sets(args.random, args.seed) if args.random > 0 else param_grid()
+    _, fixed = drop_inactive_axes(param_sets[:1], prepared)
+    if fixed:
+        n_pay3f = sum(int(np.count_nonzero(races["pay_3f"] > 0)) for _, races in days)
+        print(
+            f"3連複の払戻が記録されたレースが{n_pay3f}Rで、ワイド切替の平均合成オッズがどの日にも作れません。"
+            f"ワイド切替は買わないので、{'・'.join(fixed)} は現行値に固定して探索します。",
+            file=sys.stderr,
+        )
+    df = run_sweep(prepared, param_sets, workers=args.workers)
+    if args.out:
+        df.to_csv(args.out, index=False, encoding="utf-8-sig")
+    print(df.head(args.top).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()